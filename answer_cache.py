@@ -0,0 +1,75 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize_message(message):
+    """Lowercase, collapse whitespace and drop trailing punctuation, so near-identical questions share a key"""
+    message = re.sub(r'\s+', ' ', message.strip().lower())
+    return message.rstrip(' ?!.')
+
+
+def history_digest(history):
+    """Stable hash of the exchanges preceding a question"""
+    digest = hashlib.sha1()
+    for msg in history:
+        digest.update(msg['role'].encode())
+        digest.update(b'\x1f')
+        digest.update(msg['content'].encode())
+        digest.update(b'\x1e')
+    return digest.hexdigest()
+
+
+class AnswerCache:
+    """
+    LRU cache of complete tutor answers with TTL expiry.
+
+    Keys are (course_id, normalized message, hash of the preceding history), so the same
+    question only hits when asked in the same course after the same exchanges.
+    """
+
+    def __init__(self, max_entries=1000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # Format: {key: (stored_at, answer)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(course_id, message, history):
+        return (course_id, normalize_message(message), history_digest(history))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, answer):
+        with self._lock:
+            self._entries[key] = (time.time(), answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+            }
@@ -0,0 +1,105 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AnswerLog:
+    """
+    Append-only log of the answers students give to revision questions, in a local SQLite
+    database shared by every worker process.
+
+    Answers are buffered and written in batches by a background thread, one transaction per
+    batch, so recording an answer never waits on the disk. The buffer is flushed every
+    `flush_interval` seconds, as soon as it holds `batch_size` answers, and on close().
+    """
+
+    def __init__(self, path='answers.db', batch_size=100, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+        self._pid = None
+        self._stats = {'recorded': 0, 'written': 0, 'batches': 0, 'errors': 0, 'dropped': 0}
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "answered_at REAL NOT NULL, user_id TEXT NOT NULL, course_id TEXT NOT NULL, "
+                "question TEXT NOT NULL, selected TEXT NOT NULL, correct INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS answers_question ON answers (course_id, question)")
+        conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, user_id, course_id, question, selected, correct):
+        """Queue one answer to be written"""
+        with self._lock:
+            self._pending.append((time.time(), user_id, course_id, question, selected, int(correct)))
+            self._stats['recorded'] += 1
+            full = len(self._pending) >= self.batch_size
+        self._ensure_writer()
+        if full:
+            self._wake.set()
+
+    def _ensure_writer(self):
+        # Started on first use in each process, a writer thread doesn't survive a fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name='answer-log', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        conn = self._connect()
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._write(conn)
+        conn.close()
+
+    def _write(self, conn):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            with conn:
+                conn.executemany("INSERT INTO answers VALUES (?, ?, ?, ?, ?, ?)", batch)
+        except sqlite3.Error as e:
+            logger.error("Error writing %d answers: %s", len(batch), e)
+            with self._lock:
+                self._stats['errors'] += 1
+                # Keep them for the next batch, unless the database has been failing for a while
+                if len(self._pending) + len(batch) <= self.batch_size * 10:
+                    self._pending[:0] = batch
+                else:
+                    self._stats['dropped'] += len(batch)
+            return
+        with self._lock:
+            self._stats['written'] += len(batch)
+            self._stats['batches'] += 1
+
+    def close(self):
+        """Stop the writer and write what is still buffered"""
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout=5)
+        conn = self._connect()
+        self._write(conn)
+        conn.close()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, pending=len(self._pending))
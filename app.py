@@ -1,15 +1,30 @@
 from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response
 import os
+import atexit
 import json
-from datetime import datetime
+import logging
+import threading
+import time
+import importlib.util
 from dotenv import load_dotenv
 import math
 import numpy as np
 
-# Import Langchain components
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
-from openai import OpenAI
+from answer_cache import AnswerCache
+from answer_log import AnswerLog
+from chat_history import HistoryWindow, TokenCounter
+from course_registry import CourseRegistry
+from metrics import Registry
+from question_index import QuestionIndexStore
+from relevance import RelevanceEngine
+from revision_parser import RESPONSE_FORMAT, QuestionStreamParser, parse_revision_response
+from revision_jobs import RevisionCancelled, RevisionFlights, RevisionJobQueue
+from session_records import ChatMessage, RevisionQuestion, question_dicts
+from session_store import SessionKey, create_session_store
+from spaced_repetition import ReviewScheduler
+from stream_encoder import StreamEncoder, sse_frame
+from topic_gate import TopicGate
+from upstream import UpstreamClient, UpstreamUnavailable
 
 ### WE DO NOT USE COSINE SIMILARITY IN THIS CODE, FOR STABILITY WE SET AS A LOW THRESHOLD -10 ###
 RELEVANCE_THRESHOLD = float(os.getenv("RELEVANCE_THRESHOLD", -10))  # Minimum similarity score
@@ -19,29 +34,108 @@ N = int(os.getenv("REVISION_QUESTIONS_N", 5))  # Generate after every N question
 O = int(os.getenv("REVISION_QUESTIONS_O", 2))   # Overlap factor
 MAX_REVISION_QUESTIONS = int(os.getenv("MAX_REVISION_QUESTIONS", 10))  # Maximum number of revision questions
 MAX_ADDED_QUESTIONS = int(os.getenv("MAX_ADDED_QUESTIONS", 2))  # Maximum added revision questions (each time generate)
-CHAT_HISTORY = int(os.getenv("CHAT_HISTORY", 5))  # Maximum chat history size
+CHAT_HISTORY = int(os.getenv("CHAT_HISTORY", 0))  # Maximum chat history pairs kept, 0 for no limit besides the token budget
+CHAT_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", 2000))  # Token budget of the chat history sent with each question
+HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "0") == "1"  # Summarize messages that fall out of the history window
+HISTORY_SUMMARY_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", 200))  # Maximum length of the rolling summary
+REVISION_WORKERS = int(os.getenv("REVISION_WORKERS", 2))  # Background revision generation threads
+REVISION_FORMAT = os.getenv("REVISION_FORMAT", "json")  # Revision completion format: json (structured output) or text
+REVISION_INCREMENTAL = os.getenv("REVISION_INCREMENTAL", "0") == "1"  # Only send new turns when updating revisions
+REVISION_CANCEL_STALE = os.getenv("REVISION_CANCEL_STALE", "0") == "1"  # Cancel revision generations when a new message arrives
+RELEVANCE_BATCH_SIZE = int(os.getenv("RELEVANCE_BATCH_SIZE", 32))  # Messages encoded together for relevance checks
+RELEVANCE_MAX_WAIT_MS = float(os.getenv("RELEVANCE_MAX_WAIT_MS", 10))  # How long a message waits for its batch to fill
+TOPIC_GATE = os.getenv("TOPIC_GATE", "embedding")  # How off-topic messages are caught before answering: embedding, completion or off
+TOPIC_GATE_MODEL = os.getenv("TOPIC_GATE_MODEL", "")  # Model of the completion gate, defaults to MODEL_NAME
+TOPIC_GATE_CACHE_SIZE = int(os.getenv("TOPIC_GATE_CACHE_SIZE", 10000))  # Maximum cached topic decisions
+TOPIC_GATE_CACHE_TTL = int(os.getenv("TOPIC_GATE_CACHE_TTL", 3600))  # Seconds a cached topic decision stays valid
+QUESTION_INDEX = os.getenv("QUESTION_INDEX", "0") == "1"  # Reuse revision questions generated for other students
+QUESTION_INDEX_DIR = os.getenv("QUESTION_INDEX_DIR", "question_index")  # Where the per-course indexes are kept
+QUESTION_INDEX_THRESHOLD = float(os.getenv("QUESTION_INDEX_THRESHOLD", 0.6))  # Minimum similarity to reuse a question
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "0") == "1"  # Reuse tutor answers to repeated questions
+ANSWER_CACHE_FIRST_TURN_ONLY = os.getenv("ANSWER_CACHE_FIRST_TURN_ONLY", "1") == "1"  # Only cache questions without history
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 1000))  # Maximum cached answers
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", 3600))  # Seconds a cached answer stays valid
+STREAM_FLUSH_POLICY = os.getenv("STREAM_FLUSH_POLICY", "word")  # When chat stream frames are sent: token, word, time or bytes
+STREAM_FLUSH_MS = float(os.getenv("STREAM_FLUSH_MS", 50))  # Time window of the time flush policy
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", 256))  # Frame size of the bytes flush policy
+ANSWER_DB_PATH = os.getenv("ANSWER_DB_PATH", "answers.db")  # Append-only log of answers to revision questions
+REVIEW_MIN_DUE = int(os.getenv("REVIEW_MIN_DUE", 3))  # Due questions that replace a revision generation, 0 to always generate
+REVIEW_MAX_CARDS = int(os.getenv("REVIEW_MAX_CARDS", 100))  # Answered questions remembered per session for review
+COURSES_PATH = os.getenv("COURSES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "courses.json"))  # Course data file
+COURSES_RELOAD_SECONDS = float(os.getenv("COURSES_RELOAD_SECONDS", 5))  # How often the course file is checked for changes, 0 to never reload
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "0") == "1"  # Load the clients and sentence model at import instead of first use
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")  # DEBUG also logs every prompt sent for revision questions
 
 # Load environment variables from .env file
 load_dotenv()
 
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+if logger.getEffectiveLevel() > logging.DEBUG:
+    # One line per upstream request otherwise
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
 # Set OpenAI API key 
 api_key = os.getenv("OPENAI_API_KEY")
 model_name = os.getenv("MODEL_NAME", "gpt-4o-mini")
 
-# Initialize OpenAI client for direct API calls
-openai_client = OpenAI(api_key=api_key)
+# The upstream client, sentence model, relevance engine and question indexes are created on first
+# use, so workers boot without loading them. See preload_models() to load them before forking.
+_upstream_client = None
+_sentence_model = None
+_relevance_engine = None
+_question_indexes = None
+_answer_log = None
+_topic_gate = None
+_lazy_lock = threading.RLock()
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "dev-secret-key-change-in-production")
 
-# Initialize SentenceTransformer model globally with error handling
-try:
-    from sentence_transformers import SentenceTransformer
-    sentence_model = SentenceTransformer('all-MiniLM-L6-v2')
-    similarity_enabled = True
-except ImportError:
-    print("SentenceTransformer not installed. Course relevance checks will be disabled.")
-    similarity_enabled = False
+# SentenceTransformer is optional, only check it is installed here, the model loads on first use
+similarity_enabled = importlib.util.find_spec('sentence_transformers') is not None
+if not similarity_enabled:
+    logger.warning("SentenceTransformer not installed. Course relevance checks will be disabled.")
+
+def get_upstream_client():
+    """
+    OpenAI client for direct API calls, created on first use. It is wrapped with deadlines,
+    retries, a circuit breaker and per-model concurrency limits, see upstream.UpstreamSettings.
+    """
+    global _upstream_client
+    if _upstream_client is None:
+        with _lazy_lock:
+            if _upstream_client is None:
+                _upstream_client = UpstreamClient(api_key)
+    return _upstream_client
+
+def get_sentence_model():
+    """
+    The sentence model, loaded on first use.
+    
+    Returns:
+        SentenceTransformer or None: None if it is not installed or failed to load, in which
+        case similarity features are disabled for the life of the process
+    """
+    global _sentence_model, similarity_enabled
+    if _sentence_model is None and similarity_enabled:
+        with _lazy_lock:
+            if _sentence_model is None and similarity_enabled:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                    _sentence_model = SentenceTransformer('all-MiniLM-L6-v2')
+                except Exception as e:
+                    # e.g. OSError when the weights can't be downloaded
+                    logger.error("Error loading SentenceTransformer, course relevance checks will be disabled: %s", e)
+                    similarity_enabled = False
+    return _sentence_model
+
+def embed_texts(texts):
+    """L2-normalized float32 sentence embeddings, one row per text"""
+    sentence_model = get_sentence_model()
+    if sentence_model is None:
+        raise RuntimeError("Sentence model is not available")
+    return np.asarray(sentence_model.encode(texts, normalize_embeddings=True), dtype=np.float32)
 
 # In-memory data storage (would use a database in production)
 users = {
@@ -49,19 +143,146 @@ users = {
     'test': {'password': 'test123'}
 }
 
-courses = [
-    {'id': '1', 'title': 'Mathematics', 'description': 'Algebra, Probability, and Topology etc.'},
-    {'id': '2', 'title': 'Art & Music', 'description': 'Art, Drawing, and Masterpiece etc.'},
-    {'id': '3', 'title': 'Computer Science', 'description': 'Programming, AI, and Data Structures etc.'},
-    {'id': '4', 'title': 'Cybersecurity & Blockchain', 'description': 'Cybersecurity, Blockchain, and Cryptocurrency etc.'},
-    {'id': '5', 'title': 'VietNam', 'description': 'Anything about Vietnam, and other related countries'}
+# Courses from COURSES_PATH, indexed by id with their prompts compiled, reloaded when the file changes
+course_registry = CourseRegistry(COURSES_PATH, lambda course: compile_course_prompts(course), COURSES_RELOAD_SECONDS)
+
+# Per-session state (chat history including AI responses, question count, revision questions),
+# keyed by SessionKey(user_id, course_id). See session_store.new_session_state for the layout.
+session_store = create_session_store()
+
+# Tutor answers keyed by course, normalized question and preceding history
+answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)
+
+def get_relevance_engine():
+    """Relevance checks score batched message encodes against course embeddings computed once"""
+    global _relevance_engine
+    if _relevance_engine is None and similarity_enabled:
+        with _lazy_lock:
+            if _relevance_engine is None and get_sentence_model() is not None:
+                engine = RelevanceEngine(embed_texts, RELEVANCE_BATCH_SIZE, RELEVANCE_MAX_WAIT_MS / 1000)
+                # Course embeddings are recomputed when the registry reloads
+                course_registry.on_load(engine.set_courses)
+                _relevance_engine = engine
+    return _relevance_engine
+
+def topic_gate_enabled():
+    """Whether chat messages are checked for their topic before being answered"""
+    return TOPIC_GATE == 'completion' or (TOPIC_GATE == 'embedding' and similarity_enabled)
 
-]
+def get_topic_gate():
+    """The off-topic gate of chat messages, None if disabled. See begin_chat_turn()"""
+    global _topic_gate
+    if _topic_gate is None and topic_gate_enabled():
+        with _lazy_lock:
+            if _topic_gate is None:
+                classify = classify_topic_completion if TOPIC_GATE == 'completion' else classify_topic_embedding
+                gate = TopicGate(classify, TOPIC_GATE_CACHE_SIZE, TOPIC_GATE_CACHE_TTL)
+                # Decisions were made against the old course descriptions
+                course_registry.on_load(gate.clear)
+                _topic_gate = gate
+    return _topic_gate
 
-# Store full chat history (including AI responses)
-chat_history = {}  # Format: {user_id-course_id: [messages]}
-question_counts = {}  # Format: {user_id-course_id: count}
-revision_questions = {}  # Format: {user_id-course_id: [questions]}
+def get_question_indexes():
+    """Per-course vector index of generated revision questions, None unless enabled and the sentence model loads"""
+    global _question_indexes
+    if _question_indexes is None and QUESTION_INDEX and similarity_enabled:
+        with _lazy_lock:
+            sentence_model = get_sentence_model()
+            if _question_indexes is None and sentence_model is not None:
+                _question_indexes = QuestionIndexStore(QUESTION_INDEX_DIR, sentence_model.get_sentence_embedding_dimension())
+    return _question_indexes
+
+def get_answer_log():
+    """The answer log, its database is created on the first recorded answer"""
+    global _answer_log
+    if _answer_log is None:
+        with _lazy_lock:
+            if _answer_log is None:
+                _answer_log = AnswerLog(ANSWER_DB_PATH)
+                atexit.register(_answer_log.close)
+    return _answer_log
+
+def preload_models():
+    """
+    Create everything that is otherwise loaded on first use.
+    
+    Called at import with PRELOAD_MODELS=1. Together with gunicorn's preload_app (see
+    gunicorn.conf.py) this runs once in the master, and forked workers share the model
+    weights copy-on-write instead of each loading their own copy.
+    """
+    get_upstream_client()
+    get_relevance_engine()
+    get_question_indexes()
+    get_topic_gate()
+
+# Guards the stats dicts below, updated from request threads and the revision and summary executors
+stats_lock = threading.Lock()
+
+# Prompt size of revision generations, estimated tokens (incremental mode reports what it saved)
+revision_prompt_stats = {'calls': 0, 'incremental_calls': 0, 'prompt_tokens': 0, 'prompt_tokens_saved': 0}
+
+# How revision completions parsed: as structured output, recovered from broken JSON, as free text
+# or not at all. Completion tokens of failed or empty parses and dropped questions count as wasted.
+revision_parse_stats = {
+    'responses': 0, 'json': 0, 'recovered': 0, 'text': 0, 'failed': 0,
+    'questions': 0, 'dropped_questions': 0, 'completion_tokens': 0, 'wasted_completion_tokens': 0
+}
+
+# Chat history kept within a token budget, token counts are cached on the messages
+history_window = HistoryWindow(TokenCounter(model_name), CHAT_HISTORY_TOKENS, CHAT_HISTORY)
+
+# Background summaries of messages that fell out of the history window
+summary_jobs = RevisionJobQueue(lambda key: summarize_history(key), max_workers=1)
+
+# Prompt tokens billed per kind of completion, and how many of them the upstream served from its
+# prompt cache. Prompts start with their static per-course part so the cache can match it.
+prompt_cache_stats = {
+    kind: {'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0}
+    for kind in ('chat', 'revision', 'summary', 'gate')
+}
+
+# Latency and size histograms of this process, served in the Prometheus format at /metrics
+metrics = Registry()
+chat_turn_seconds = metrics.histogram(
+    'tutor_chat_turn_seconds', 'Time to check and record a chat message before its answer streams',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
+chat_messages = metrics.counter('tutor_chat_messages_total', 'Chat messages received, by outcome', ['outcome'])
+topic_gate_seconds = metrics.histogram(
+    'tutor_topic_gate_seconds', 'Time to decide whether a chat message is on topic, by decision source', ['source'],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+chat_ttft_seconds = metrics.histogram(
+    'tutor_chat_ttft_seconds', 'Time from the start of an answer stream to its first token', ['source']
+)
+chat_stream_seconds = metrics.histogram('tutor_chat_stream_seconds', 'Duration of answer streams', ['source'])
+chat_stream_chunks = metrics.histogram(
+    'tutor_chat_stream_chunks', 'Upstream deltas received and SSE frames sent per answer stream', ['kind'],
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+)
+chat_stream_errors = metrics.counter('tutor_chat_stream_errors_total', 'Answer streams that failed, by error', ['error'])
+revision_seconds = metrics.histogram(
+    'tutor_revision_generation_seconds', 'Time from a revision prompt to the stored set', ['mode', 'source']
+)
+
+answers_recorded = metrics.counter('tutor_answers_total', 'Answers to revision questions, by result', ['result'])
+reviews_served = metrics.counter('tutor_review_questions_total', 'Questions surfaced for review instead of a revision generation')
+
+# Spaced repetition over the revision questions students answered, see serve_due_reviews()
+review_scheduler = ReviewScheduler(max_cards=REVIEW_MAX_CARDS)
+
+# Revision generations in progress, concurrent requests for the same conversation share one
+revision_flights = RevisionFlights()
+
+# Background revision generation, so chat streams don't wait on the completion
+revision_jobs = RevisionJobQueue(
+    lambda key: generate_revision_questions(key),
+    max_workers=REVISION_WORKERS,
+    on_update=lambda job: record_revision_job(job)
+)
+
+if PRELOAD_MODELS:
+    preload_models()
 
 @app.route('/')
 def index():
@@ -102,7 +323,7 @@ def courses_page():
     if 'user_id' not in session:
         return redirect(url_for('index'))
     
-    return render_template('courses.html', courses=courses)
+    return render_template('courses.html', courses=course_registry.courses)
 
 @app.route('/chat/<course_id>')
 def chat(course_id):
@@ -110,33 +331,24 @@ def chat(course_id):
         return redirect(url_for('index'))
     
     user_id = session['user_id']
-    session_key = f"{user_id}-{course_id}"
     
     # Get course info
-    course = next((c for c in courses if c['id'] == course_id), None)
+    course = course_registry.get(course_id)
     if not course:
         flash('Course not found')
         return redirect(url_for('courses_page'))
+    session_key = SessionKey(user_id, course['id'])
     
-    # Initialize chat history if needed
-    if session_key not in chat_history:
-        chat_history[session_key] = []
-    
-    # Initialize question count if needed
-    if session_key not in question_counts:
-        question_counts[session_key] = 0
-    
-    # Initialize revision questions if needed
-    if session_key not in revision_questions:
-        revision_questions[session_key] = []
+    state = session_store.read(session_key)
     
     return render_template(
         'chat.html', 
         course=course, 
-        chat_history=chat_history[session_key],
-        question_count=question_counts[session_key],
-        revision_questions=revision_questions[session_key],
-        next_revision_at=calculate_next_revision(question_counts[session_key])
+        chat_history=state['chat_history'],
+        question_count=state['question_count'],
+        revision_questions=state['revision_questions'],
+        revision_version=state['revision_version'],
+        next_revision_at=calculate_next_revision(state['question_count'])
     )
 
 @app.route('/api/send_message', methods=['POST'])
@@ -144,69 +356,98 @@ def send_message():
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
-    data = request.json
+    turn, error = begin_chat_turn(session['user_id'], request.json)
+    if error:
+        return jsonify(error[0]), error[1]
+    
+    # Handle irrelevant messages by returning a fixed response
+    if not turn['is_relevant']:
+        return Response(
+            stream_irrelevant_response(turn['course']),
+            content_type='text/event-stream'
+        )
+    
+    # Always use streaming for responses, passing the current question count
+    return Response(
+        generate_ai_stream(turn['user_message'], turn['course_id'], turn['session_key']),
+        content_type='text/event-stream'
+    )
+
+def begin_chat_turn(user_id, data):
+    """
+    Validate a chat request and record the user message, ready for the answer to be streamed.
+    Shared by the Flask view and the asyncio serving mode in asgi.py.
+    
+    Args:
+        user_id: Logged in user
+        data: Decoded JSON body of the request
+    
+    Returns:
+        tuple: (turn, error) where error is a (payload, status) pair if the request was rejected
+    """
+    started = time.perf_counter()
+    data = data or {}
     user_message = data.get('message', '').strip()
     course_id = data.get('course_id', '')
     
     if not user_message or not course_id:
-        return jsonify({'error': 'Message or course ID missing'}), 400
-    
-    user_id = session['user_id']
-    session_key = f"{user_id}-{course_id}"
+        chat_messages.inc(outcome='rejected')
+        return None, ({'error': 'Message or course ID missing'}, 400)
     
     # Get course info
-    course = next((c for c in courses if c['id'] == course_id), None)
+    course = course_registry.get(course_id)
     if not course:
-        return jsonify({'error': 'Course not found'}), 404
+        chat_messages.inc(outcome='rejected')
+        return None, ({'error': 'Course not found'}, 404)
+    # Share the course's id string instead of keeping the request's copy in caches, jobs and session keys
+    course_id = course['id']
+    session_key = SessionKey(user_id, course_id)
     
-    # Check course relevance if similarity module is enabled
-    is_relevant = True
-    if similarity_enabled:
-        try:
-            similarity = check_course_relevance(user_message, course)
-            is_relevant = similarity >= RELEVANCE_THRESHOLD
-        except Exception as e:
-            print(f"Error checking relevance: {str(e)}")
-            # Continue with the message if relevance check fails
-            is_relevant = True
+    turn = {
+        'session_key': session_key,
+        'course_id': course_id,
+        'course': course,
+        'user_message': user_message,
+        'is_relevant': True
+    }
     
-    # Handle irrelevant messages by returning a fixed response
-    if not is_relevant:
-        return Response(
-            stream_irrelevant_response(course),
-            content_type='text/event-stream'
-        )
+    # Turn away off-topic messages before paying for an answer, the gate lets messages through on errors
+    topic_gate = get_topic_gate()
+    if topic_gate is not None:
+        gate_started = time.perf_counter()
+        turn['is_relevant'], cached = topic_gate.check(user_message, course)
+        topic_gate_seconds.observe(time.perf_counter() - gate_started, source='cache' if cached else TOPIC_GATE)
     
-    # Initialize if needed
-    if session_key not in chat_history:
-        chat_history[session_key] = []
-    if session_key not in question_counts:
-        question_counts[session_key] = 0
-    if session_key not in revision_questions:
-        revision_questions[session_key] = []
-    
-    # FIFO implementation for 5 Q&A limit: If already at 5 pairs (10 messages), remove oldest pair
-    if len(chat_history[session_key]) >= CHAT_HISTORY * 2:  # 5 pairs of messages
-        # Remove the oldest Q&A pair (first user message and first AI response)
-        chat_history[session_key].pop(0)  # Remove oldest user message
-        chat_history[session_key].pop(0)  # Remove oldest AI response
-    
-    # Store user message in chat history
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    chat_history[session_key].append({
-        'role': 'user',
-        'content': user_message,
-        'timestamp': timestamp
-    })
+    # Irrelevant messages are answered with a fixed response and not recorded
+    if not turn['is_relevant']:
+        chat_messages.inc(outcome='irrelevant')
+        chat_turn_seconds.observe(time.perf_counter() - started)
+        return turn, None
+    
+    with session_store.session(session_key) as state:
+        # Store user message in chat history, the conversation version doubles as its sequence number
+        state['conversation_version'] += 1
+        history_window.append(state, ChatMessage('user', user_message, state['conversation_version']))
         
-    # Increment question count
-    question_counts[session_key] += 1
+        # Drop the oldest messages once the history is over its token budget
+        dropped = history_window.trim(state)
+        if HISTORY_SUMMARY and dropped:
+            state['summary_backlog'].extend(dropped)
+        summarize = HISTORY_SUMMARY and bool(state['summary_backlog'])
+            
+        # Increment question count
+        state['question_count'] += 1
+        conversation_version = state['conversation_version']
     
-    # Always use streaming for responses, passing the current question count
-    return Response(
-        generate_ai_stream(user_message, course_id, session_key),
-        content_type='text/event-stream'
-    )
+    # Revision sets still being generated for the conversation before this message are stale
+    if REVISION_CANCEL_STALE:
+        revision_flights.cancel(session_key, before_version=conversation_version)
+    # Fold the dropped messages into the rolling summary in the background
+    if summarize:
+        summary_jobs.submit(session_key)
+    chat_messages.inc(outcome='answered')
+    chat_turn_seconds.observe(time.perf_counter() - started)
+    return turn, None
 
 ### WE DONT NEED BELOW FUNCTION, THEY ALWAYS RELEVANCE BECAUSE THRESHOLD IS -10 ###
 def check_course_relevance(message, course):
@@ -220,30 +461,43 @@ def check_course_relevance(message, course):
     Returns:
         float: Cosine similarity score between message and course description
     """
-    # Check if we have enhanced course content
-    course_content = course.get('expanded_description', course.get('description', ''))
     course_title = course.get('title', '')
     
-    # Add course title to make the relevance check more robust
-    course_text = f"{course_title}. {course_content}"
-    
-    # Encode the sentences
+    # The course embedding (title and description) is precomputed, only the message is encoded,
+    # in a batch with messages from concurrent requests
     try:
-        emb1, emb2 = sentence_model.encode([message, course_text])
-        
-        # Compute cosine similarity
-        dot_product = np.dot(emb1, emb2)
-        norm1 = np.linalg.norm(emb1)
-        norm2 = np.linalg.norm(emb2)
-        similarity = dot_product / (norm1 * norm2)
+        similarity = get_relevance_engine().similarity(message, course['id'])
         
-        print(f"Relevance check - Message: '{message}', Course: '{course_title}', Similarity: {similarity}")
+        logger.debug("Relevance check - Message: '%s', Course: '%s', Similarity: %s", message, course_title, similarity)
         return similarity
     except Exception as e:
-        print(f"Error computing similarity: {str(e)}")
+        logger.error("Error computing similarity: %s", e)
         # Default to allowing the message if there's an error
         return 1.0
 
+def classify_topic_embedding(message, course):
+    """Topic gate classifier: the message's similarity to the course embedding against RELEVANCE_THRESHOLD"""
+    return check_course_relevance(message, course) >= RELEVANCE_THRESHOLD
+
+def classify_topic_completion(message, course):
+    """
+    Topic gate classifier: a one-token completion answering Y or N, behind the course's static
+    gate prompt so the upstream prompt cache serves most of it.
+    """
+    response = get_upstream_client().chat_completion(
+        model=TOPIC_GATE_MODEL or model_name,
+        messages=[
+            {"role": "system", "content": course_prompts(course)['topic_gate_system']},
+            {"role": "user", "content": message}
+        ],
+        max_tokens=1,
+        temperature=0
+    )
+    record_prompt_usage('gate', response.usage)
+    answer = (response.choices[0].message.content or '').strip().upper()
+    # Anything but a clear N lets the message through
+    return not answer.startswith('N')
+
 ### WE DONT NEED BELOW FUNCTION, THEY ALWAYS RELEVANCE BECAUSE THRESHOLD IS -10 ###
 def stream_irrelevant_response(course):
     """
@@ -276,114 +530,341 @@ def stream_irrelevant_response(course):
     # Send end of stream marker with is_irrelevant flag
     yield f"data: {json.dumps({'end': True, 'is_irrelevant': True})}\n\n"
 
-def generate_ai_stream(user_message, course_id, session_key):
+def build_chat_messages(user_message, course_id, session_key):
     """
-    Generates a streaming AI response and yields chunks as they become available.
+    Build the message list for a tutor completion: system prompt, prior exchanges and the new question.
     """
     # Get course information for context
-    course = next((c for c in courses if c['id'] == course_id), None)
+    course = course_registry.get(course_id)
+    
+    # Prepare messages including chat history, the compiled system prompt goes first
+    messages = [{"role": "system", "content": course_prompts(course)['chat_system']}]
+    
+    state = session_store.read(session_key)
+    
+    # Earlier turns that fell out of the history window, if summarized
+    if state['history_summary']:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation: {state['history_summary']}"})
+    
+    # Add previous exchanges from chat history
+    history_messages = []
+    for msg in list(state['chat_history'])[:-1]:  # Exclude the most recent user message
+        if msg.role in ['user', 'assistant']:
+            history_messages.append(msg.to_dict())
+    
+    # Add history if there are messages
+    if history_messages:
+        messages.extend(history_messages)
+    
+    # Add the current user message
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+def compile_course_prompts(course):
+    """
+    Build the static system prompts of a course.
+    
+    They are the same for every student of the course, so they are built once and every prompt
+    starts with them, which lets the upstream prompt cache reuse them. Anything specific to a
+    call (history, conversation, existing questions) goes after them.
+    
+    Args:
+        course: Course object, or None for a course that doesn't exist
+    
+    Returns:
+        dict: chat_system, topic_gate_system, revision_full_system and revision_incremental_system prompts
+    """
     course_title = course['title'] if course else "this course"
     course_desc = course['description'] if course else ""
+    revision_desc = course.get('expanded_description', course_desc) if course else ""
     
-    system_message = (
+    chat_system = (
         f"You are an AI tutor specializing in {course_title}. "
         f"Your role is to provide helpful, accurate, and educational responses to student questions about {course_title}: {course_desc}. "
         f"Keep your responses clear, informative, and focused on helping the student. "
         f"If a student asks about unrelated topics, redirect them by message starting with 'ERROR 444: '"
     )
     
-    try:
-        # Prepare messages including chat history
-        messages = [{"role": "system", "content": system_message}]
+    topic_gate_system = (
+        f"You check messages students send to an AI tutor of {course_title}: {course_desc}. "
+        f"Reply Y if the message is about {course_title}, or is a greeting, a follow-up to the tutor "
+        f"or a question about studying. Reply N if it is about an unrelated topic. Reply with Y or N only."
+    )
+    
+    # System prompt for generating or updating multiple-choice questions
+    revision_full_system = f"""You are a tutor specializing in {course_title}.
+    
+    I will provide you with:
+    1. A complete conversation between a student and a tutor about {course_title}: {revision_desc}
+    2. Any existing revision questions (if available)
+    
+    Your task is to create or update a set of multiple-choice questions. If existing questions are provided,
+    review them and:
+    - Keep those that are still relevant to the conversation
+    - Modify any that need updating based on new information
+    - Add new questions to cover important concepts from the latest conversations
+    - Remove any questions that are redundant or too similar to each other
+       
+    Each question should:
+    1. Have exactly 4 options (a, b, c, d)
+    2. Have ONE correct answer
+    3. Be relevant to the topics discussed in the context of {course_title}: {revision_desc}
+    4. Be directly related to the conversation between the student and tutor
+    5. Be clear and straightforward
+    6. Avoid duplication of concepts already covered by other questions
+    7. If no new question can be derived from the conversation, simply return the previous set of questions.
+    
+    {revision_format_instructions()}"""
+    
+    revision_incremental_system = f"""You are a tutor specializing in {course_title}.
+    
+    I will provide you with:
+    1. The latest part of a conversation between a student and a tutor about {course_title}: {revision_desc}
+    2. The topics of the revision questions the student already has
+    
+    Your task is to create new multiple-choice questions covering only the latest part of the conversation.
+    
+    Each question should:
+    1. Have exactly 4 options (a, b, c, d)
+    2. Have ONE correct answer
+    3. Be relevant to the topics discussed in the context of {course_title}: {revision_desc}
+    4. Be directly related to the latest part of the conversation
+    5. Be clear and straightforward
+    6. Not repeat a concept covered by an existing question
+    7. If no new question can be derived from the conversation, return nothing.
+    
+    {revision_format_instructions()}"""
+    
+    return {
+        'course': course,
+        'chat_system': chat_system,
+        'topic_gate_system': topic_gate_system,
+        'revision_full_system': revision_full_system,
+        'revision_incremental_system': revision_incremental_system
+    }
+
+def course_prompts(course):
+    """The prompts of a course, compiled when the course registry loaded it"""
+    prompts = course_registry.prompts(course['id']) if course else None
+    if prompts is None or prompts['course'] is not course:
+        # A course object from before a reload, or no course at all
+        prompts = compile_course_prompts(course)
+    return prompts
+
+def record_prompt_usage(kind, usage):
+    """
+    Count the tokens of a completion, and how many of its prompt tokens the upstream prompt cache served.
+    
+    Args:
+        kind: 'chat', 'revision' or 'summary'
+        usage: The usage field of the response or of the last stream chunk, may be None
+    """
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, 'prompt_tokens', 0) or 0
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = getattr(details, 'cached_tokens', 0) or 0
+    
+    with stats_lock:
+        stats = prompt_cache_stats[kind]
+        stats['calls'] += 1
+        stats['prompt_tokens'] += prompt_tokens
+        stats['cached_tokens'] += cached_tokens
+        stats['completion_tokens'] += getattr(usage, 'completion_tokens', 0) or 0
+    logger.debug("Prompt tokens (%s): %d, %d cached, %d uncached", kind, prompt_tokens, cached_tokens, prompt_tokens - cached_tokens)
+
+def chat_stream_options():
+    """Keyword arguments of a streamed tutor answer besides the model and messages"""
+    return {'stream': True, 'temperature': 0.7, 'stream_options': {'include_usage': True}}
+
+def new_stream_encoder():
+    """Stream encoder for a chat answer, with the configured flush policy"""
+    return StreamEncoder(STREAM_FLUSH_POLICY, STREAM_FLUSH_MS / 1000, STREAM_FLUSH_BYTES)
+
+def answer_cache_key(course_id, messages):
+    """
+    Cache key for the answer to a prompt built by build_chat_messages, or None if it shouldn't be cached.
+    """
+    if not ANSWER_CACHE:
+        return None
+    history = messages[1:-1]
+    if ANSWER_CACHE_FIRST_TURN_ONLY and history:
+        return None
+    return AnswerCache.make_key(course_id, messages[-1]['content'], history)
+
+def replay_cached_answer(answer):
+    """Yield a cached answer as chunk frames, it is all there so there is nothing to wait for"""
+    if answer:
+        yield sse_frame({'chunk': answer})
+
+def finish_chat_stream(session_key, full_response, cache_key=None):
+    """
+    Record a completed tutor answer and work out what the end of stream event should carry.
+    
+    Returns:
+        dict: The end event data, or None if the answer was off-topic and nothing was recorded
+    """
+    with session_store.session(session_key) as state:
+        if 'ERROR 444' in full_response:
+            # Remove the user message this answer was for, the newest in the history unless the chat was cleared.
+            # The verdict isn't cached by the topic gate, the tutor judged the message in its conversation
+            history = history_window.history(state)
+            if history and history[-1].role == 'user':
+                history_window.drop_newest(state)
+                state['question_count'] -= 1
+            state['conversation_version'] += 1
+            return None
         
-        # Add previous exchanges from chat history
-        history_messages = []
-        for msg in chat_history[session_key][:-1]:  # Exclude the most recent user message
-            if msg.get('role') in ['user', 'assistant']:
-                history_messages.append({"role": msg.get('role'), "content": msg.get('content', '')})
+        if cache_key:
+            answer_cache.put(cache_key, full_response)
         
-        # Add history if there are messages
-        if history_messages:
-            messages.extend(history_messages)
+        # Store the full response in chat history
+        state['conversation_version'] += 1
+        history_window.append(state, ChatMessage('assistant', full_response, state['conversation_version']))
+        question_count = state['question_count']
+    
+    # Check if we need to generate revision questions based on question count
+    generate_revisions = False
+    revision_job_id = None
+    next_revision_at = calculate_next_revision(question_count)
+    if question_count == next_revision_at:
+        generate_revisions = True
+        # Questions the student is due to review stand in for a new generation, when there are enough.
+        # Otherwise queue generation in the background so the stream can end right away
+        if not serve_due_reviews(session_key):
+            revision_job_id = revision_jobs.submit(session_key).id
+    
+    # Signal the end of the stream and send any additional data
+    return {
+        'end': True,
+        'question_count': question_count,
+        'generate_revisions': generate_revisions,
+        'revision_job_id': revision_job_id,
+        'next_revision_at': next_revision_at
+    }
+
+def generate_ai_stream(user_message, course_id, session_key):
+    """
+    Generates a streaming AI response and yields chunks as they become available.
+    """
+    started = time.perf_counter()
+    stream = None
+    try:
+        messages = build_chat_messages(user_message, course_id, session_key)
         
-        # Add the current user message
-        messages.append({"role": "user", "content": user_message})
+        # Replay a cached answer to the same question instead of paying for a completion
+        cache_key = answer_cache_key(course_id, messages)
+        cached_answer = answer_cache.get(cache_key) if cache_key else None
+        if cached_answer is not None:
+            yield from replay_cached_answer(cached_answer)
+            observe_chat_stream('cache', started, started)
+            data = finish_chat_stream(session_key, cached_answer)
+            if data:
+                yield f"data: {json.dumps(data)}\n\n"
+            return
         
         # Create streaming response
-        stream = openai_client.chat.completions.create(
+        stream = get_upstream_client().chat_completion(
             model=model_name,
             messages=messages,
-            stream=True,
-            temperature=0.7
+            **chat_stream_options()
         )
         
-        full_response = ""
-        buffer = ""
-        
-        # Process the stream word by word
+        # Send the answer in frames as the flush policy allows, the last chunk carries the usage
+        encoder = new_stream_encoder()
+        first_token_at = None
         for chunk in stream:
-            if chunk.choices[0].delta.content:
-                content = chunk.choices[0].delta.content
-                full_response += content
-                
-                # Add to buffer and check for words
-                buffer += content
-                words = buffer.split(" ")
-                
-                # If we have more than one word or the content ends with space
-                if len(words) > 1 or buffer.endswith(" "):
-                    for i, word in enumerate(words[:-1] if not buffer.endswith(" ") else words):
-                        if word:  # Skip empty words
-                            # Send word with space at the end except for punctuation
-                            word_to_send = word + " "
-                            yield f"data: {json.dumps({'chunk': word_to_send})}\n\n"
-                    
-                    # Keep the last word in buffer if content doesn't end with space
-                    if not buffer.endswith(" ") and words:
-                        buffer = words[-1]
-                    else:
-                        buffer = ""
+            if chunk.usage:
+                record_prompt_usage('chat', chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                yield from encoder.feed(chunk.choices[0].delta.content)
         
-        # Send any remaining buffer
-        if buffer:
-            yield f"data: {json.dumps({'chunk': buffer})}\n\n"
+        # Send whatever is still pending
+        yield from encoder.close()
+        observe_chat_stream('upstream', started, first_token_at, encoder)
         
-        if 'ERROR 444' in full_response:
-            # Remove the last user message from history 
-            chat_history[session_key].pop(0)
-            question_counts[session_key] -= 1
-
-        else:
-            # Store the full response in chat history
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            chat_history[session_key].append({
-                'role': 'assistant',
-                'content': full_response,
-                'timestamp': timestamp
-            })
-            # Check if we need to generate revision questions based on question count
-            generate_revisions = False
-            next_revision_at = calculate_next_revision(question_counts[session_key])
-            if question_counts[session_key] == next_revision_at:
-                generate_revisions = True
-                generate_revision_questions(session_key)
-            
-            # Signal the end of the stream and send any additional data
-            data = {
-                'end': True,
-                'question_count': question_counts[session_key],
-                'generate_revisions': generate_revisions,
-                'next_revision_at': next_revision_at
-            }
+        data = finish_chat_stream(session_key, encoder.text(), cache_key)
+        if data:
             yield f"data: {json.dumps(data)}\n\n"
-
         
     except Exception as e:
-        print("Error in streaming response:", str(e))
-        import traceback
-        traceback.print_exc()
-        error_msg = "I'm sorry, I couldn't process your question due to a technical issue. Please try again later."
-        yield f"data: {json.dumps({'error': error_msg})}\n\n"
+        logger.exception("Error in streaming response: %s", e)
+        chat_stream_errors.inc(error=type(e).__name__)
+        yield f"data: {json.dumps({'error': stream_error_message(e)})}\n\n"
+    finally:
+        if stream is not None:
+            # Also when the client went away mid-answer, frees the model's slot and the connection
+            stream.close()
+
+def observe_chat_stream(source, started, first_token_at, encoder=None):
+    """
+    Record the timing of a finished answer stream.
+    
+    Args:
+        source: 'upstream' or 'cache'
+        started: perf_counter() when the stream started
+        first_token_at: perf_counter() when the first token arrived, None if none did
+        encoder: The stream's StreamEncoder, for its delta and frame counts
+    """
+    now = time.perf_counter()
+    if first_token_at is not None:
+        chat_ttft_seconds.observe(first_token_at - started, source=source)
+    chat_stream_seconds.observe(now - started, source=source)
+    if encoder is not None:
+        chat_stream_chunks.observe(encoder.deltas, kind='deltas')
+        chat_stream_chunks.observe(encoder.frames, kind='frames')
+
+def stream_error_message(error):
+    """What to tell the student when their answer couldn't be generated"""
+    if isinstance(error, UpstreamUnavailable):
+        # Shed by the circuit breaker or the concurrency limit, it is worth trying again soon
+        return "The tutor is very busy right now. Please try again in a moment."
+    return "I'm sorry, I couldn't process your question due to a technical issue. Please try again later."
+
+def summarize_history(session_key):
+    """
+    Fold the messages that fell out of a session's history window into its rolling summary.
+    Runs on the summary worker, the messages are put back if the completion fails.
+    """
+    with session_store.session(session_key) as state:
+        backlog = state['summary_backlog']
+        if not backlog:
+            return
+        state['summary_backlog'] = []
+        summary = state['history_summary']
+        epoch = state['history_epoch']
+
+    prompt = (
+        f"Summarize this tutoring conversation in at most {HISTORY_SUMMARY_TOKENS // 2} words, "
+        f"keeping the topics the student asked about and what they found difficult.\n\n"
+    )
+    if summary:
+        prompt += f"Summary so far: {summary}\n\nConversation since:\n"
+    prompt += format_conversation(backlog)
+
+    try:
+        response = get_upstream_client().chat_completion(
+            model=model_name,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=HISTORY_SUMMARY_TOKENS,
+            temperature=0
+        )
+        record_prompt_usage('summary', response.usage)
+        new_summary = (response.choices[0].message.content or '').strip()
+    except Exception as e:
+        logger.error("Error summarizing chat history for %s: %s", session_key, e)
+        new_summary = None
+
+    with session_store.session(session_key) as state:
+        # The chat was cleared while we waited, the summary is of a conversation that's gone
+        if state['history_epoch'] != epoch:
+            return
+        if new_summary:
+            state['history_summary'] = new_summary
+        else:
+            state['summary_backlog'] = backlog + state['summary_backlog']
 
 # [Rest of the functions remain unchanged]
 
@@ -398,32 +879,42 @@ def manual_revision():
     if not course_id:
         return jsonify({'error': 'Course ID missing'}), 400
     
+    course = course_registry.get(course_id)
+    if not course:
+        return jsonify({'error': 'Course not found'}), 404
+    
     user_id = session['user_id']
-    session_key = f"{user_id}-{course_id}"
+    session_key = SessionKey(user_id, course['id'])
     
-    # Initialize if needed
-    if session_key not in chat_history or not chat_history[session_key]:
+    if not session_store.read(session_key)['chat_history']:
         return jsonify({'error': 'No chat history to generate revisions from'}), 400
     
-    if session_key not in revision_questions:
-        revision_questions[session_key] = []
-    
     try:
-        generate_revision_questions(session_key)
-        # Add this line to include the revision questions in the response
+        # Only pay for a completion when the conversation changed since the last generation
+        regenerated = revision_is_stale(session_key)
+        if regenerated:
+            try:
+                generate_revision_questions(session_key)
+            except RevisionCancelled:
+                # A newer message or a cleared chat superseded it, answer with the stored set
+                regenerated = False
+        state = session_store.read(session_key)
         return jsonify({
             'success': True,
-            'revision_questions': revision_questions[session_key]
+            'regenerated': regenerated,
+            'version': state['revision_version'],
+            'revision_questions': question_dicts(state['revision_questions'])
         })
     except Exception as e:
-        print(f"Error in manual revision API endpoint: {str(e)}")
+        logger.error("Error in manual revision API endpoint: %s", e)
         return jsonify({
             'success': False,
             'error': str(e) or "An error occurred while generating revision questions"
         })
 
-@app.route('/api/clear_chat', methods=['POST'])
-def clear_chat():
+@app.route('/api/generate_revision_stream', methods=['POST'])
+def manual_revision_stream():
+    """Streaming variant of /api/generate_revision, sends each question as soon as it is generated"""
     if 'user_id' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
@@ -433,57 +924,536 @@ def clear_chat():
     if not course_id:
         return jsonify({'error': 'Course ID missing'}), 400
     
+    course = course_registry.get(course_id)
+    if not course:
+        return jsonify({'error': 'Course not found'}), 404
+    
+    user_id = session['user_id']
+    session_key = SessionKey(user_id, course['id'])
+    
+    if not session_store.read(session_key)['chat_history']:
+        return jsonify({'error': 'No chat history to generate revisions from'}), 400
+    
+    return Response(generate_revision_stream(session_key), mimetype='text/event-stream')
+
+@app.route('/api/revision_status', methods=['GET'])
+def revision_status():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    course_id = request.args.get('course_id', '')
+    job_id = request.args.get('job_id', '')
+    
+    if not course_id or not job_id:
+        return jsonify({'error': 'Course ID or job ID missing'}), 400
+    
+    course = course_registry.get(course_id)
+    if not course:
+        return jsonify({'error': 'Course not found'}), 404
+    
+    user_id = session['user_id']
+    session_key = SessionKey(user_id, course['id'])
+    
+    # Jobs are recorded in the session state, so any worker can answer for them
+    job = session_store.read(session_key)['revision_job']
+    if not job or job['job_id'] != job_id:
+        return jsonify({'error': 'Revision job not found'}), 404
+    
+    result = {'success': job['status'] != 'failed', **job}
+    if job['status'] == 'done':
+        result.update(revision_payload(session_key, request.args.get('version', type=int)))
+    return jsonify(result)
+
+@app.route('/api/revision_questions', methods=['GET'])
+def get_revision_questions():
+    """Read-only fetch of the stored revision set, never triggers a generation."""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    course_id = request.args.get('course_id', '')
+    if not course_id:
+        return jsonify({'error': 'Course ID missing'}), 400
+    
+    course = course_registry.get(course_id)
+    if not course:
+        return jsonify({'error': 'Course not found'}), 404
+    
     user_id = session['user_id']
-    session_key = f"{user_id}-{course_id}"
+    session_key = SessionKey(user_id, course['id'])
     
-    # Clear chat data for this course
-    if session_key in chat_history:
-        chat_history[session_key] = []
+    return jsonify({
+        'success': True,
+        **revision_payload(session_key, request.args.get('version', type=int))
+    })
+
+def revision_payload(session_key, known_version=None):
+    """
+    Build the revision part of an API response.
     
-    if session_key in question_counts:
-        question_counts[session_key] = 0
+    The questions are left out when the client already holds the current version.
+    """
+    state = session_store.read(session_key)
+    version = state['revision_version']
+    if known_version is not None and known_version == version:
+        return {'version': version, 'unchanged': True}
+    return {
+        'version': version,
+        'unchanged': False,
+        'revision_questions': question_dicts(state['revision_questions'])
+    }
+
+@app.route('/api/record_answer', methods=['POST'])
+def record_answer():
+    """
+    Record a student's answer to one of their revision questions, for the spaced repetition
+    schedule and the answer log. The answer is checked against the stored question.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
     
-    # Explicitly clear revision questions for this session
-    if session_key in revision_questions:
-        revision_questions[session_key] = []
+    data = request.json or {}
+    course_id = data.get('course_id', '')
+    selected_answer = str(data.get('selected_answer', '')).strip().lower()
+    version = data.get('version')
+    try:
+        question_index = int(data.get('question_index'))
+    except (TypeError, ValueError):
+        question_index = None
+    
+    if not course_id or question_index is None or not selected_answer:
+        return jsonify({'error': 'Course ID, question index or answer missing'}), 400
+    
+    course = course_registry.get(course_id)
+    if not course:
+        return jsonify({'error': 'Course not found'}), 404
+    
+    user_id = session['user_id']
+    session_key = SessionKey(user_id, course['id'])
+    
+    with session_store.session(session_key) as state:
+        # The index is into the set the client rendered, it may have been replaced since
+        if version is not None and version != state['revision_version']:
+            return jsonify({'error': 'The revision questions changed, reload them'}), 409
+        questions = state['revision_questions']
+        if not 0 <= question_index < len(questions):
+            return jsonify({'error': 'Revision question not found'}), 404
+        question = questions[question_index]
+        correct = selected_answer == question.correct
+        card = review_scheduler.record(state['review_cards'], question, correct)
+    
+    get_answer_log().record(user_id, course['id'], question.question, selected_answer, correct)
+    answers_recorded.inc(result='correct' if correct else 'wrong')
+    return jsonify({
+        'success': True,
+        'is_correct': correct,
+        'next_review_at': card.due
+    })
+
+@app.route('/api/clear_chat', methods=['POST'])
+def clear_chat():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    data = request.json
+    course_id = data.get('course_id', '')
+    
+    if not course_id:
+        return jsonify({'error': 'Course ID missing'}), 400
+    
+    course = course_registry.get(course_id)
+    if not course:
+        return jsonify({'error': 'Course not found'}), 404
+    
+    user_id = session['user_id']
+    session_key = SessionKey(user_id, course['id'])
+    
+    revision_jobs.discard(session_key)
+    revision_flights.cancel(session_key)
+    summary_jobs.discard(session_key)
+    with session_store.session(session_key) as state:
+        # Clear chat data for this course
+        history_window.clear(state)
+        state['history_summary'] = ''
+        state['summary_backlog'] = []
+        state['history_epoch'] += 1
+        state['question_count'] = 0
+        
+        # Explicitly clear revision questions for this session, the review cards of the
+        # questions answered so far are kept
+        state['revision_questions'] = []
+        state['revision_job'] = None
+        state['revision_cursor'] = 0
+        
+        # Versions keep counting up so clients holding an older set notice the change
+        state['conversation_version'] += 1
+        state['revision_version'] += 1
+        state['revision_generated_at'] = None
     
     return jsonify({
         'success': True,
         'message': 'Chat cleared successfully'
     })
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Metrics of this worker process in the Prometheus text format"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@metrics.collector
+def collect_stats():
+    """The token, revision prompt and parse, revision flight and answer cache counters kept in the stats dicts, read at scrape time"""
+    token_types = (('prompt', 'prompt_tokens'), ('cached_prompt', 'cached_tokens'), ('completion', 'completion_tokens'))
+    cache_stats = answer_cache.stats()
+    flight_stats = revision_flights.stats()
+    with stats_lock:
+        token_stats = {kind: dict(stats) for kind, stats in prompt_cache_stats.items()}
+        prompt_stats = dict(revision_prompt_stats)
+        parse_stats = dict(revision_parse_stats)
+    return [
+        ('tutor_llm_calls_total', 'counter', 'Completions that reported usage, by kind',
+         [({'kind': kind}, stats['calls']) for kind, stats in token_stats.items()]),
+        ('tutor_llm_tokens_total', 'counter', 'Tokens billed by the upstream, by completion kind and token type',
+         [({'kind': kind, 'type': name}, stats[key]) for kind, stats in token_stats.items() for name, key in token_types]),
+        ('tutor_revision_parse_total', 'counter', 'Revision completions by parse outcome',
+         [({'outcome': outcome}, parse_stats[outcome]) for outcome in ('json', 'recovered', 'text', 'failed')]),
+        ('tutor_revision_questions_total', 'counter', 'Revision questions parsed, and started but dropped as malformed',
+         [({'result': 'parsed'}, parse_stats['questions']), ({'result': 'dropped'}, parse_stats['dropped_questions'])]),
+        ('tutor_revision_wasted_completion_tokens_total', 'counter', 'Completion tokens of failed or empty parses and dropped questions',
+         [({}, parse_stats['wasted_completion_tokens'])]),
+        ('tutor_revision_prompts_total', 'counter', 'Revision generation prompts, full or incremental',
+         [({'mode': 'full'}, prompt_stats['calls'] - prompt_stats['incremental_calls']),
+          ({'mode': 'incremental'}, prompt_stats['incremental_calls'])]),
+        ('tutor_revision_prompt_tokens_total', 'counter', 'Estimated prompt tokens of revision generations, sent and saved by incremental prompts',
+         [({'result': 'sent'}, prompt_stats['prompt_tokens']), ({'result': 'saved'}, prompt_stats['prompt_tokens_saved'])]),
+        ('tutor_revision_requests_total', 'counter', 'Revision generation requests, leading a generation or joining one running',
+         [({'result': 'led'}, flight_stats['leaders']), ({'result': 'joined'}, flight_stats['joined'])]),
+        ('tutor_revision_cancelled_total', 'counter', 'Revision generations cancelled as stale', [({}, flight_stats['cancelled'])]),
+        ('tutor_revision_in_flight', 'gauge', 'Revision generations running', [({}, flight_stats['in_flight'])]),
+        ('tutor_answer_cache_requests_total', 'counter', 'Answer cache lookups, by result',
+         [({'result': 'hit'}, cache_stats['hits']), ({'result': 'miss'}, cache_stats['misses'])]),
+        ('tutor_answer_cache_evictions_total', 'counter', 'Answers dropped from the cache, past its size or expired', [({}, cache_stats['evictions'])]),
+        ('tutor_answer_cache_size', 'gauge', 'Answers in the cache', [({}, cache_stats['size'])]),
+    ]
+
+@metrics.collector
+def collect_answer_log_stats():
+    """Writes of the answer log, once this process recorded an answer"""
+    if _answer_log is None:
+        return []
+    stats = _answer_log.stats()
+    return [
+        ('tutor_answer_log_writes_total', 'counter', 'Answers written to the answer log, and dropped after write errors',
+         [({'result': 'written'}, stats['written']), ({'result': 'dropped'}, stats['dropped'])]),
+        ('tutor_answer_log_batches_total', 'counter', 'Batches written to the answer log', [({}, stats['batches'])]),
+        ('tutor_answer_log_pending', 'gauge', 'Answers waiting to be written', [({}, stats['pending'])]),
+    ]
+
+@metrics.collector
+def collect_session_snapshot_stats():
+    """Sessions saved to and restored from the session snapshot, with SESSION_SNAPSHOT_PATH set"""
+    stats = session_store.snapshot_stats()
+    if stats is None:
+        return []
+    return [
+        ('tutor_session_snapshot_writes_total', 'counter', 'Sessions written to the snapshot, and deleted from it',
+         [({'result': 'written'}, stats['written']), ({'result': 'deleted'}, stats['deleted'])]),
+        ('tutor_session_snapshot_restored_total', 'counter', 'Sessions restored from the snapshot on first access', [({}, stats['loaded'])]),
+        ('tutor_session_snapshot_segments', 'gauge', 'Segments of the snapshot file, the full snapshot and its deltas', [({}, stats['segments'])]),
+        ('tutor_session_snapshot_bytes', 'gauge', 'Size of the snapshot file, and of the deltas appended since it was last rewritten',
+         [({'kind': 'file'}, stats['file_bytes']), ({'kind': 'delta'}, stats['delta_bytes'])]),
+    ]
+
+@metrics.collector
+def collect_topic_gate_stats():
+    """Decisions of the topic gate, once this process checked a message"""
+    if _topic_gate is None:
+        return []
+    stats = _topic_gate.stats()
+    return [
+        ('tutor_topic_gate_checks_total', 'counter', 'Chat messages checked by the topic gate, by decision source',
+         [({'source': 'cache'}, stats['hits']), ({'source': 'classifier'}, stats['checks'] - stats['hits'])]),
+        ('tutor_topic_gate_off_topic_total', 'counter', 'Chat messages the topic gate turned away', [({}, stats['off_topic'])]),
+        ('tutor_topic_gate_errors_total', 'counter', 'Topic checks that failed and let the message through', [({}, stats['errors'])]),
+        ('tutor_topic_gate_cache_size', 'gauge', 'Topic decisions in the cache', [({}, stats['size'])]),
+    ]
+
+# Upstream clients reported at /metrics by label, as functions returning the client or None if it
+# wasn't created. asgi.py adds its async client.
+metric_upstream_clients = {'sync': lambda: _upstream_client}
+
+@metrics.collector
+def collect_upstream_stats():
+    """Counters and breaker state of the upstream clients, see UpstreamClient.stats()"""
+    series = {}
+    for label, get_client in metric_upstream_clients.items():
+        client = get_client()
+        if client is None:
+            continue
+        stats = client.stats()
+        for key, value in stats.items():
+            if key != 'breaker':
+                series.setdefault(key, []).append(({'client': label}, value))
+        series.setdefault('breaker_open', []).append(({'client': label}, int(stats['breaker'] != 'closed')))
+    return [
+        (f'tutor_upstream_{key}' if key == 'breaker_open' else f'tutor_upstream_{key}_total',
+         'gauge' if key == 'breaker_open' else 'counter',
+         f'Upstream client {key.replace("_", " ")}', values)
+        for key, values in series.items()
+    ]
+
 def generate_revision_questions(session_key):
     """
     Generates or updates multiple-choice revision questions using OpenAI API.
     Uses the complete chat history and maintains existing questions where relevant.
+    
+    Concurrent calls for the same session and conversation version, e.g. a double-clicked button
+    or the background job racing the manual endpoint, share one generation and its result.
+    
+    Raises:
+        RevisionCancelled: If the generation was cancelled before its set was stored
     """
-    # Extract course_id from session_key
-    parts = session_key.split('-')
-    if len(parts) < 2:
-        print(f"Invalid session key format: {session_key}")
+    version = session_store.read(session_key)['conversation_version']
+    return revision_flights.run(session_key, version, lambda flight: run_revision_generation(session_key, flight))
+
+def run_revision_generation(session_key, flight):
+    """Generate a session's revision questions as the leader of its flight, see generate_revision_questions()"""
+    prompt = build_revision_prompt(session_key)
+    if not prompt:
         return []
     
-    course_id = parts[1]  # Assuming format is "user_id-course_id"
+    # Questions already generated for other students of the course may cover this conversation
+    if serve_revisions_from_index(session_key, prompt):
+        return
+    
+    try:
+        flight.check()
+        logger.debug("Attempting to generate/update revision questions for %s with OpenAI API...", prompt['course_title'])
+        # Call the OpenAI API
+        response = get_upstream_client().chat_completion(
+            model=model_name,
+            messages=prompt['messages'],
+            **revision_completion_options()
+        )
+        record_prompt_usage('revision', response.usage)
+        # Cancelled while waiting on the completion, the questions are for a conversation that moved on
+        flight.check()
+        store_revision_response(session_key, prompt, response.choices[0].message.content, completion_tokens(response))
+        
+    except RevisionCancelled:
+        raise
+    except Exception as e:
+        logger.error("Error generating/updating revision questions: %s (%s)", e, type(e).__name__)
+        # Re-raise the exception to be handled by the caller
+        raise Exception(f"Error generating/updating revision questions: {str(e)}")
+
+def completion_tokens(response):
+    """Completion tokens a response was billed for, 0 if the server didn't report usage"""
+    return getattr(getattr(response, 'usage', None), 'completion_tokens', 0) or 0
+
+def begin_revision_stream(session_key):
+    """
+    Work out how a streamed revision request is answered.
+    
+    The stream opens with a start event saying whether the questions that follow are added to
+    the student's set or replace it, then has one event per question and a closing end event
+    carrying the stored set.
+    
+    Returns:
+        tuple: (prompt, frames) where prompt is the revision prompt to stream a completion for,
+               or None if the frames answer the request without one
+    """
+    # Only pay for a completion when the conversation changed since the last generation
+    regenerated = revision_is_stale(session_key)
+    prompt = build_revision_prompt(session_key) if regenerated else None
+    if prompt and serve_revisions_from_index(session_key, prompt):
+        prompt = None
+    if prompt:
+        return prompt, [sse_frame({'start': True, 'merge': prompt['mode'] == 'incremental'})]
+    return None, stored_revision_frames(session_key, regenerated)
+
+def stored_revision_frames(session_key, regenerated):
+    """A whole revision stream replaying the stored set"""
+    frames = [sse_frame({'start': True, 'merge': False})]
+    frames.extend(sse_frame({'question': q.to_dict()}) for q in session_store.read(session_key)['revision_questions'])
+    frames.append(revision_stream_end(session_key, regenerated))
+    return frames
+
+def joined_revision_frames(session_key, flight):
+    """
+    Answer a stream request that joined a generation already running: wait for it, then replay
+    the set it stored. Blocks until the leader finishes.
+    """
+    try:
+        flight.wait()
+        regenerated = True
+    except RevisionCancelled:
+        regenerated = False
+    except Exception as e:
+        return [sse_frame({'error': str(e) or "An error occurred while generating revision questions"})]
+    return stored_revision_frames(session_key, regenerated)
+
+def revision_stream_options():
+    """Keyword arguments of a streamed revision completion besides the model and messages"""
+    return {**revision_completion_options(), 'stream': True, 'stream_options': {'include_usage': True}}
+
+def finish_revision_stream(session_key, prompt, response_text, completion_tokens=0):
+    """Store a streamed revision completion like a blocking one. Returns the end frame"""
+    store_revision_response(session_key, prompt, response_text, completion_tokens)
+    return revision_stream_end(session_key, True)
+
+def revision_stream_end(session_key, regenerated):
+    """End event of a revision stream, with the set as stored"""
+    state = session_store.read(session_key)
+    return sse_frame({
+        'end': True,
+        'success': True,
+        'regenerated': regenerated,
+        'version': state['revision_version'],
+        'revision_questions': question_dicts(state['revision_questions'])
+    })
+
+def generate_revision_stream(session_key):
+    """
+    Generates revision questions with a streamed completion and yields an event per question
+    as soon as the model has finished writing it.
+    
+    Leads the session's revision flight like generate_revision_questions(), or joins the one
+    already running and replays what it stored.
+    """
+    flight, leader = revision_flights.begin(session_key, session_store.read(session_key)['conversation_version'])
+    if not leader:
+        yield from joined_revision_frames(session_key, flight)
+        return
+    
+    # Until the set is stored, a closed stream leaves the requests that joined without one
+    error = RevisionCancelled(f"Revision stream for {session_key} was closed")
+    stream = None
+    try:
+        prompt, frames = begin_revision_stream(session_key)
+        if not prompt:
+            error = None
+        yield from frames
+        if not prompt:
+            return
+        
+        logger.debug("Streaming revision questions for %s from OpenAI API...", prompt['course_title'])
+        stream = get_upstream_client().chat_completion(
+            model=model_name,
+            messages=prompt['messages'],
+            **revision_stream_options()
+        )
+        
+        parser = QuestionStreamParser()
+        parts = []
+        tokens = 0
+        for chunk in stream:
+            if flight.cancelled:
+                # Stop the completion early, its questions would not be stored
+                stream.close()
+                flight.check()
+            if chunk.usage:
+                record_prompt_usage('revision', chunk.usage)
+                tokens = chunk.usage.completion_tokens
+            if chunk.choices and chunk.choices[0].delta.content:
+                content = chunk.choices[0].delta.content
+                parts.append(content)
+                for question in parser.feed(content):
+                    yield sse_frame({'question': question})
+        for question in parser.close():
+            yield sse_frame({'question': question})
+        
+        flight.check()
+        end = finish_revision_stream(session_key, prompt, ''.join(parts), tokens)
+        error = None
+        yield end
+    
+    except RevisionCancelled as e:
+        error = e
+        logger.info("Revision stream cancelled for %s", session_key)
+        yield revision_stream_end(session_key, False)
+    except Exception as e:
+        error = e
+        logger.error("Error streaming revision questions: %s", e)
+        yield sse_frame({'error': str(e) or "An error occurred while generating revision questions"})
+    finally:
+        try:
+            if stream is not None:
+                # Also when the client went away mid-stream, frees the model's slot and the connection
+                stream.close()
+        finally:
+            revision_flights.finish(flight, error=error)
+
+def build_revision_prompt(session_key):
+    """
+    Build the revision question prompt for a session from its chat history and existing questions.
+    
+    Returns:
+        dict: course_title, messages for the completion and the conversation_version they were
+              built from, or None if there is nothing to generate from
+    """
+    course_id = session_key.course_id
     
     # Get course information
-    course = next((c for c in courses if c['id'] == course_id), None)
+    course = course_registry.get(course_id)
     if not course:
-        print(f"Course not found for ID: {course_id}")
-        return []
+        logger.warning("Course not found for ID: %s", course_id)
+        return None
     
     course_title = course['title']
-    course_desc = course.get('expanded_description', course.get('description', ''))
+    
+    # Snapshot the session, messages may arrive while we wait on the completion
+    state = session_store.read(session_key)
     
     # Check if we have any chat history
-    if session_key not in chat_history or not chat_history[session_key]:
-        print(f"No chat history found for session: {session_key}")
-        return []
+    if not state['chat_history']:
+        logger.info("No chat history found for session: %s", session_key)
+        return None
     
-    # Format the complete chat history
+    # Remember which conversation this set is built from
+    conversation_version = state['conversation_version']
+    history = list(state['chat_history'])
+    existing_questions = list(state['revision_questions'])
+    cursor = state.get('revision_cursor', 0)
+    
+    full_messages = build_full_revision_messages(course, history, existing_questions)
+    prompt = {
+        'started_at': time.perf_counter(),
+        'course_id': course_id,
+        'course_title': course_title,
+        'conversation_version': conversation_version,
+        'history_epoch': state['history_epoch'],
+        'cursor': history[-1].seq,
+        'mode': 'full',
+        'messages': full_messages
+    }
+    
+    # Incremental mode: once a set exists, only send the turns it hasn't covered yet
+    new_turns = [msg for msg in history if msg.seq > cursor]
+    if REVISION_INCREMENTAL and existing_questions and cursor and new_turns:
+        prompt['mode'] = 'incremental'
+        prompt['messages'] = build_incremental_revision_messages(course, new_turns, existing_questions)
+    
+    # What the student asked about lately, to look up matching questions in the course index
+    prompt['topics'] = " ".join(msg.content for msg in (new_turns or history) if msg.role == 'user')
+    
+    prompt_tokens = estimate_prompt_tokens(prompt['messages'])
+    prompt_tokens_saved = estimate_prompt_tokens(full_messages) - prompt_tokens
+    with stats_lock:
+        revision_prompt_stats['calls'] += 1
+        revision_prompt_stats['prompt_tokens'] += prompt_tokens
+        if prompt['mode'] == 'incremental':
+            revision_prompt_stats['incremental_calls'] += 1
+            revision_prompt_stats['prompt_tokens_saved'] += prompt_tokens_saved
+    if prompt['mode'] == 'incremental':
+        logger.debug("Incremental revision prompt for %s: ~%d tokens, ~%d saved", session_key, prompt_tokens, prompt_tokens_saved)
+    return prompt
+
+def format_conversation(messages):
+    """Format chat messages as a Student/Tutor transcript"""
     formatted_history = []
-    for msg in chat_history[session_key]:
-        role = msg.get('role', '')
-        content = msg.get('content', '')
+    for msg in messages:
+        role = msg.role
+        content = msg.content
         
         if role == 'user':
             formatted_history.append(f"Student: {content}")
@@ -491,128 +1461,268 @@ def generate_revision_questions(session_key):
             formatted_history.append(f"Tutor: {content}")
     
     # Join the formatted history with line breaks
-    complete_conversation = "\n\n".join(formatted_history)
+    return "\n\n".join(formatted_history)
+
+def build_full_revision_messages(course, history, existing_questions):
+    """Prompt that sends the whole conversation and every existing question for review"""
+    course_title = course['title']
+    
+    # Format the complete chat history
+    complete_conversation = format_conversation(history)
     
     # Get the existing questions (if any)
-    existing_questions = []
     existing_questions_formatted = ""
-    question_count = 0
+    question_count = len(existing_questions)
     
-    if session_key in revision_questions and revision_questions[session_key]:
-        existing_questions = revision_questions[session_key]
-        question_count = len(revision_questions[session_key])
-
+    if existing_questions:
         # Format existing questions for the prompt
         existing_questions_formatted = "Current revision questions:\n\n"
         for i, q in enumerate(existing_questions):
-            existing_questions_formatted += f"{i+1}. {q.get('question', '')}\n"
+            existing_questions_formatted += f"{i+1}. {q.question}\n"
             
             # Add options
-            for key, value in q.get('options', {}).items():
+            for key, value in q.option_items():
                 existing_questions_formatted += f"{key}) {value}\n"
             
             # Add correct answer
-            existing_questions_formatted += f"Correct answer: {q.get('correct', '')}\n\n"
+            existing_questions_formatted += f"Correct answer: {q.correct}\n\n"
     
-    # System prompt for generating or updating multiple-choice questions
-    system_message = f"""You are a tutor specializing in {course_title}.
+    # User message content
+    user_message = f"Here is the conversation between the student and tutor about {course_title}:\n\n{complete_conversation}\n\n"
     
-    I will provide you with:
-    1. A complete conversation between a student and a tutor about {course_title}: {course_desc}
-    2. Any existing revision questions (if available)
+    # Add existing questions if available
+    if existing_questions_formatted:
+        user_message += existing_questions_formatted
+        user_message += f"\nPlease review and update these questions based on the entire conversation. Ensure the questions complement each other and avoid redundancy. The new list must have no more than {min(MAX_ADDED_QUESTIONS + question_count, MAX_REVISION_QUESTIONS)} questions.\n"
+    else:
+        user_message += f"\nThere are no existed questions. Please create up to {MAX_ADDED_QUESTIONS + 1} appropriate multiple-choice questions based on this conversation.\n"
     
-    Your task is to create or update a set of multiple-choice questions. If existing questions are provided,
-    review them and:
-    - Keep those that are still relevant to the conversation
-    - Modify any that need updating based on new information
-    - Add new questions to cover important concepts from the latest conversations
-    - Remove any questions that are redundant or too similar to each other
-       
-    Each question should:
-    1. Have exactly 4 options (a, b, c, d)
-    2. Have ONE correct answer
-    3. Be relevant to the topics discussed in the context of {course_title}: {course_desc}
-    4. Be directly related to the conversation between the student and tutor
-    5. Be clear and straightforward
-    6. Avoid duplication of concepts already covered by other questions
-    7. If no new question can be derived from the conversation, simply return the previous set of questions.
+    return [
+        {"role": "system", "content": course_prompts(course)['revision_full_system']},
+        {"role": "user", "content": user_message}
+    ]
+
+def build_incremental_revision_messages(course, new_turns, existing_questions):
+    """
+    Prompt that sends only the turns since the last generation, plus the stems of the existing
+    questions so the model doesn't repeat them. Its questions are merged into the stored set.
+    """
+    course_title = course['title']
     
-    Format each question as:
+    existing_summary = "\n".join(f"- {q.question}" for q in existing_questions)
+    
+    # The existing questions only grow between incremental calls, so they go before the new turns
+    user_message = (
+        f"Existing revision questions:\n{existing_summary}\n\n"
+        f"Here is the latest part of the conversation between the student and tutor about {course_title}:\n\n"
+        f"{format_conversation(new_turns)}\n\n"
+        f"Please create up to {MAX_ADDED_QUESTIONS} new multiple-choice questions based on this part of the conversation.\n"
+    )
+    return [
+        {"role": "system", "content": course_prompts(course)['revision_incremental_system']},
+        {"role": "user", "content": user_message}
+    ]
+
+def build_topic_revision_messages(course, topic, count):
+    """
+    Prompt for questions about a seed topic of the course, with no conversation behind them.
+    Used to pre-generate question banks offline, see pregenerate_questions.py.
+    """
+    user_message = (
+        f"There is no conversation yet, the student is starting on this topic of {course['title']}: {topic}\n\n"
+        f"There are no existed questions. Please create up to {count} appropriate multiple-choice questions "
+        f"about this topic, each covering a different concept.\n"
+    )
+    return [
+        {"role": "system", "content": course_prompts(course)['revision_full_system']},
+        {"role": "user", "content": user_message}
+    ]
+
+def revision_format_instructions():
+    """The output format part of the revision system prompts, for REVISION_FORMAT"""
+    if REVISION_FORMAT == 'json':
+        return (
+            'Respond with a JSON object of the form {"questions": [{"question": "[Question]", '
+            '"options": {"a": "[Option]", "b": "[Option]", "c": "[Option]", "d": "[Option]"}, "correct": "[letter]"}]}'
+        )
+    return """Format each question as:
     1. [Question]
     a) [Option]
     b) [Option]
     c) [Option]
     d) [Option]
     Correct answer: [letter]"""
+
+def revision_completion_options():
+    """Keyword arguments of a revision completion besides the model and messages"""
+    options = {'max_tokens': 1500, 'temperature': 0.7}
+    if REVISION_FORMAT == 'json':
+        options['response_format'] = RESPONSE_FORMAT
+    return options
+
+def estimate_prompt_tokens(messages):
+    """Cheap token estimate for a prompt, about 4 characters per token"""
+    return sum(len(msg['content']) for msg in messages) // 4
+
+def merge_revision_questions(existing_questions, new_questions):
+    """Append new questions to the set, skipping repeated stems and dropping the oldest past the limit"""
+    seen = {q.stem for q in existing_questions}
+    merged = list(existing_questions)
+    for q in new_questions:
+        stem = q.stem
+        if stem and stem not in seen:
+            seen.add(stem)
+            merged.append(q)
+    return merged[-MAX_REVISION_QUESTIONS:]
+
+def store_revision_response(session_key, prompt, response_text, completion_tokens=0):
+    """
+    Parse a revision completion and store it as the session's new revision set.
     
-    # User message content
-    user_message = f"Here is the conversation between the student and tutor about {course_title}:\n\n{complete_conversation}\n\n"
+    A completion no question can be parsed from leaves the current set in place.
+    """
+    # The prompts are long, only dumped with LOG_LEVEL=DEBUG
+    logger.debug(
+        "Revision prompt for %s\nSystem message:\n%s\nUser message:\n%s",
+        session_key, prompt['messages'][0]['content'], prompt['messages'][1]['content']
+    )
+    logger.info("Successfully generated/updated revision questions for %s", prompt['course_title'])
     
-    # Add existing questions if available
-    if existing_questions_formatted:
-        user_message += existing_questions_formatted
-        user_message += f"\nPlease review and update these questions based on the entire conversation. Ensure the questions complement each other and avoid redundancy. The new list must have no more than {min(MAX_ADDED_QUESTIONS + question_count, MAX_REVISION_QUESTIONS)} questions.\n"
-    else:
-        user_message += f"\nThere are no existed questions. Please create up to {MAX_ADDED_QUESTIONS + 1} appropriate multiple-choice questions based on this conversation.\n"
+    questions = parse_revision_completion(response_text, completion_tokens)
+    if questions is None:
+        logger.warning("Could not parse any revision questions for %s, keeping the current set", session_key)
+        return
+    apply_revision_questions(session_key, prompt, questions, merge=prompt['mode'] == 'incremental')
+    
+    # Make the new questions available to other students of the course
+    question_indexes = get_question_indexes() if questions else None
+    if question_indexes:
+        try:
+            question_indexes.get(prompt['course_id']).add(embed_texts([q['question'] for q in questions]), questions)
+        except Exception as e:
+            logger.error("Error indexing revision questions: %s", e)
+
+def parse_revision_completion(response_text, completion_tokens=0):
+    """
+    Parse a revision completion and record how it went in revision_parse_stats.
+    
+    Returns:
+        list: The valid questions, or None if the completion failed to parse or held none
+    """
+    questions, outcome, dropped = parse_revision_response(response_text)
+    with stats_lock:
+        revision_parse_stats['responses'] += 1
+        revision_parse_stats[outcome] += 1
+        revision_parse_stats['questions'] += len(questions)
+        revision_parse_stats['dropped_questions'] += dropped
+        revision_parse_stats['completion_tokens'] += completion_tokens
+        if not questions:
+            revision_parse_stats['wasted_completion_tokens'] += completion_tokens
+        elif dropped:
+            revision_parse_stats['wasted_completion_tokens'] += completion_tokens * dropped // (len(questions) + dropped)
+    if not questions:
+        # A well-formed but empty set, e.g. {"questions": []}, must not replace the student's questions
+        return None
+    if dropped:
+        logger.info("Dropped %d malformed revision questions (%s parse)", dropped, outcome)
+    return questions
+
+def apply_revision_questions(session_key, prompt, questions, merge=False, source='completion'):
+    """
+    Store questions as the session's revision set, or merge them into it.
+    
+    Sets built before the chat was cleared, or from a conversation version no newer than the
+    stored set's, are dropped: another worker or request got there first.
+    
+    Returns:
+        bool: True if the set was stored
+    """
+    revision_seconds.observe(time.perf_counter() - prompt['started_at'], mode=prompt['mode'], source=source)
+    questions = [RevisionQuestion.from_dict(q) for q in questions]
+    # Update revision questions, limiting to MAX_REVISION_QUESTIONS
+    with session_store.session(session_key) as state:
+        generated_at = state['revision_generated_at']
+        if state['history_epoch'] != prompt['history_epoch'] or (
+                generated_at is not None and generated_at >= prompt['conversation_version']):
+            logger.info("Dropped a superseded revision set for %s", session_key)
+            return False
+        if merge:
+            state['revision_questions'] = merge_revision_questions(state['revision_questions'], questions)
+        else:
+            state['revision_questions'] = questions[:MAX_REVISION_QUESTIONS]
+        state['revision_version'] += 1
+        state['revision_generated_at'] = prompt['conversation_version']
+        state['revision_cursor'] = prompt['cursor']
+    return True
+
+def serve_revisions_from_index(session_key, prompt):
+    """
+    Add questions generated for other students of the course when enough of them match
+    what this student asked about.
+    
+    Returns:
+        bool: True if the revision set was updated and the completion can be skipped
+    """
+    question_indexes = get_question_indexes() if prompt['topics'] else None
+    if not question_indexes:
+        return False
     
     try:
-        print(f"Attempting to generate/update revision questions for {course_title} with OpenAI API...")
-        # Call the OpenAI API
-        response = openai_client.chat.completions.create(
-            model=model_name,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ],
-            max_tokens=1500,
-            temperature=0.7
-        )
-        print("System message:")
-        print(system_message)
-        print("User message:")
-        print(user_message)
-        # Parse the response
-        response_text = response.choices[0].message.content
-        print(f"Successfully generated/updated revision questions for {course_title}")
-        
-        # Parse the response to extract structured questions
-        questions = []
-        current_q = {}
-        
-        for line in response_text.strip().split('\n'):
-            line = line.strip()
-            if not line:
-                continue
-                
-            # Check if this is the start of a new question
-            if line[0].isdigit() and '.' in line[:3]:
-                if current_q and 'question' in current_q and 'options' in current_q and 'correct' in current_q:
-                    questions.append(current_q)
-                current_q = {'question': line.split('. ', 1)[1].strip(), 'options': {}}
-            
-            # Check if this is an option (a, b, c, d)
-            elif line.lower().startswith(('a)', 'b)', 'c)', 'd)')):
-                key = line[0].lower()
-                value = line[3:].strip() if len(line) > 3 else ""
-                if value:
-                    current_q.setdefault('options', {})[key] = value
-            
-            # Check if this is the correct answer
-            elif 'correct answer:' in line.lower():
-                current_q['correct'] = line.split(':', 1)[1].strip().lower()
-        
-        # Add the last question if it's complete
-        if current_q and 'question' in current_q and 'options' in current_q and 'correct' in current_q:
-            questions.append(current_q)
-        
-        # Update revision questions, limiting to MAX_REVISION_QUESTIONS
-        revision_questions[session_key] = questions[:MAX_REVISION_QUESTIONS]
+        existing = session_store.read(session_key)['revision_questions']
+        needed = MAX_ADDED_QUESTIONS if existing else MAX_ADDED_QUESTIONS + 1
+        seen = {q.stem for q in existing}
         
+        query = embed_texts([prompt['topics']])[0]
+        matches = []
+        for score, question in question_indexes.get(prompt['course_id']).search(query, k=needed * 4):
+            stem = question.get('question', '').strip().lower()
+            if score >= QUESTION_INDEX_THRESHOLD and stem not in seen:
+                seen.add(stem)
+                matches.append(question)
+        if len(matches) < needed:
+            return False
     except Exception as e:
-        print(f"Error generating/updating revision questions: {str(e)}")
-        print(f"Error type: {type(e).__name__}")
-        # Re-raise the exception to be handled by the caller
-        raise Exception(f"Error generating/updating revision questions: {str(e)}")
+        logger.error("Error searching the question index: %s", e)
+        return False
+    
+    apply_revision_questions(session_key, prompt, matches[:needed], merge=True, source='index')
+    logger.info("Served %d revision questions for %s from the %s question index", needed, session_key, prompt['course_title'])
+    return True
+
+def serve_due_reviews(session_key):
+    """
+    Put the questions the student is due to review at the top of their revision set, when there
+    are at least REVIEW_MIN_DUE of them, followed by the questions of the set not answered yet.
+    
+    Returns:
+        bool: True if the set was updated and no generation is needed
+    """
+    if not REVIEW_MIN_DUE:
+        return False
+    with session_store.session(session_key) as state:
+        cards = state['review_cards']
+        due = review_scheduler.due(cards, limit=MAX_REVISION_QUESTIONS)
+        if len(due) < REVIEW_MIN_DUE:
+            return False
+        unanswered = [q for q in state['revision_questions'] if q.stem not in cards]
+        state['revision_questions'] = (due + unanswered)[:MAX_REVISION_QUESTIONS]
+        state['revision_version'] += 1
+    reviews_served.inc(len(due))
+    logger.info("Served %d questions due for review to %s", len(due), session_key)
+    return True
+
+def revision_is_stale(session_key):
+    """Check whether the conversation changed since the revision set was last generated"""
+    state = session_store.read(session_key)
+    return state['revision_generated_at'] != state['conversation_version']
+
+def record_revision_job(job):
+    """Persist a background job's status in its session, for whichever worker gets polled"""
+    with session_store.session(job.session_key) as state:
+        if job.status != 'pending' and (state['revision_job'] or {}).get('job_id') != job.id:
+            # Cleared or replaced by another worker's job since, leave the session alone
+            return
+        state['revision_job'] = job.to_dict()
 
 def calculate_next_revision(question_count):
     """Calculate at which question count the next revision will be generated"""
@@ -0,0 +1,437 @@
+"""
+Asyncio serving mode for the tutor app.
+
+The chat stream and the revision endpoints are served natively on the event loop with the
+async OpenAI client, so one worker multiplexes many in-flight LLM streams instead of tying
+up a sync worker per chat. Every other route (pages, login, static files) is handed to the
+Flask app.
+
+Run with:
+    uvicorn asgi:application
+    gunicorn asgi:application -k uvicorn.workers.UvicornWorker
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+
+import app as tutor
+from revision_jobs import RevisionCancelled
+from revision_parser import QuestionStreamParser
+from stream_encoder import sse_frame
+from upstream import AsyncUpstreamClient
+
+logger = logging.getLogger(__name__)
+
+_async_upstream_client = None
+_async_client_lock = threading.Lock()
+wsgi_application = WsgiToAsgi(tutor.app)
+
+
+def get_async_upstream_client():
+    """Async OpenAI client with the same upstream protections, created on first use like the sync one in app.py"""
+    global _async_upstream_client
+    if _async_upstream_client is None:
+        with _async_client_lock:
+            if _async_upstream_client is None:
+                _async_upstream_client = AsyncUpstreamClient(tutor.api_key)
+    return _async_upstream_client
+
+
+if tutor.PRELOAD_MODELS:
+    get_async_upstream_client()
+
+tutor.metric_upstream_clients['async'] = lambda: _async_upstream_client
+
+
+def load_flask_session(scope):
+    """Decode the signed Flask session cookie of a request, so both serving modes share logins"""
+    headers = dict(scope.get('headers', []))
+    cookie = SimpleCookie()
+    try:
+        cookie.load(headers.get(b'cookie', b'').decode('latin-1'))
+    except Exception:
+        return {}
+
+    name = tutor.app.config['SESSION_COOKIE_NAME']
+    if name not in cookie:
+        return {}
+
+    serializer = tutor.app.session_interface.get_signing_serializer(tutor.app)
+    max_age = int(tutor.app.permanent_session_lifetime.total_seconds())
+    try:
+        return serializer.loads(cookie[name].value, max_age=max_age)
+    except BadSignature:
+        return {}
+
+
+async def read_json(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    try:
+        return json.loads(body) if body else {}
+    except ValueError:
+        return {}
+
+
+async def send_json(send, payload, status=200):
+    body = json.dumps(payload).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_event_stream(send, events):
+    """Send an async iterator of SSE frames, flushing each one as it is produced"""
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')]
+    })
+    try:
+        async for frame in events:
+            await send({'type': 'http.response.body', 'body': frame.encode(), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        # Run the generator's cleanup now when the client went away, not whenever it is collected
+        await events.aclose()
+
+
+async def iterate(frames):
+    for frame in frames:
+        yield frame
+
+
+async def generate_ai_stream_async(user_message, course_id, session_key):
+    """
+    Async twin of app.generate_ai_stream, awaiting the upstream stream instead of blocking on it.
+    """
+    started = time.perf_counter()
+    stream = None
+    try:
+        # Session store calls run in threads, a SQLite store can wait on other workers' transactions
+        messages = await asyncio.to_thread(tutor.build_chat_messages, user_message, course_id, session_key)
+
+        cache_key = tutor.answer_cache_key(course_id, messages)
+        cached_answer = tutor.answer_cache.get(cache_key) if cache_key else None
+        if cached_answer is not None:
+            for frame in tutor.replay_cached_answer(cached_answer):
+                yield frame
+            tutor.observe_chat_stream('cache', started, started)
+            data = await asyncio.to_thread(tutor.finish_chat_stream, session_key, cached_answer)
+            if data:
+                yield f"data: {json.dumps(data)}\n\n"
+            return
+
+        stream = await get_async_upstream_client().chat_completion(
+            model=tutor.model_name,
+            messages=messages,
+            **tutor.chat_stream_options()
+        )
+
+        encoder = tutor.new_stream_encoder()
+        first_token_at = None
+        async for chunk in stream:
+            if chunk.usage:
+                tutor.record_prompt_usage('chat', chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                for frame in encoder.feed(chunk.choices[0].delta.content):
+                    yield frame
+
+        for frame in encoder.close():
+            yield frame
+        tutor.observe_chat_stream('upstream', started, first_token_at, encoder)
+
+        data = await asyncio.to_thread(tutor.finish_chat_stream, session_key, encoder.text(), cache_key)
+        if data:
+            yield f"data: {json.dumps(data)}\n\n"
+
+    except Exception as e:
+        logger.exception("Error in async streaming response: %s", e)
+        tutor.chat_stream_errors.inc(error=type(e).__name__)
+        yield f"data: {json.dumps({'error': tutor.stream_error_message(e)})}\n\n"
+    finally:
+        if stream is not None:
+            # Also when the client went away mid-answer, frees the model's slot and the connection
+            await close_stream(stream)
+
+
+async def send_message(scope, receive, send, user_id):
+    data = await read_json(receive)
+    # The topic gate encodes on the CPU or waits on a completion, and the session store may wait
+    # on a lock, keep them off the event loop
+    turn, error = await asyncio.to_thread(tutor.begin_chat_turn, user_id, data)
+    if error:
+        return await send_json(send, *error)
+
+    if not turn['is_relevant']:
+        return await send_event_stream(send, iterate(tutor.stream_irrelevant_response(turn['course'])))
+
+    await send_event_stream(
+        send,
+        generate_ai_stream_async(turn['user_message'], turn['course_id'], turn['session_key'])
+    )
+
+
+async def generate_revision_questions_async(session_key):
+    """
+    Async twin of app.generate_revision_questions, leading the session's revision flight or
+    joining the one already running, in this worker's threads or on its event loop.
+    """
+    state = await asyncio.to_thread(tutor.session_store.read, session_key)
+    version = state['conversation_version']
+    flight, leader = tutor.revision_flights.begin(session_key, version)
+    if not leader:
+        return await asyncio.to_thread(flight.wait)
+    try:
+        result = await run_revision_generation_async(session_key, flight)
+    except BaseException as e:
+        tutor.revision_flights.finish(flight, error=e)
+        raise
+    tutor.revision_flights.finish(flight, result)
+    return result
+
+
+async def run_revision_generation_async(session_key, flight):
+    # Reads the session, the store may wait on a lock or the disk
+    prompt = await asyncio.to_thread(tutor.build_revision_prompt, session_key)
+    if prompt and tutor.QUESTION_INDEX and tutor.similarity_enabled:
+        # The index lookup encodes on the CPU, keep it off the event loop
+        if await asyncio.to_thread(tutor.serve_revisions_from_index, session_key, prompt):
+            prompt = None
+    if not prompt:
+        return
+    flight.check()
+    logger.debug("Attempting to generate/update revision questions for %s with async OpenAI API...", prompt['course_title'])
+    response = await get_async_upstream_client().chat_completion(
+        model=tutor.model_name,
+        messages=prompt['messages'],
+        **tutor.revision_completion_options()
+    )
+    tutor.record_prompt_usage('revision', response.usage)
+    flight.check()
+    await asyncio.to_thread(
+        tutor.store_revision_response, session_key, prompt,
+        response.choices[0].message.content, tutor.completion_tokens(response)
+    )
+
+
+async def manual_revision(scope, receive, send, user_id):
+    data = await read_json(receive)
+    course_id = data.get('course_id', '')
+    if not course_id:
+        return await send_json(send, {'error': 'Course ID missing'}, 400)
+
+    course = tutor.course_registry.get(course_id)
+    if not course:
+        return await send_json(send, {'error': 'Course not found'}, 404)
+    session_key = tutor.SessionKey(user_id, course['id'])
+    state = await asyncio.to_thread(tutor.session_store.read, session_key)
+    if not state['chat_history']:
+        return await send_json(send, {'error': 'No chat history to generate revisions from'}, 400)
+
+    try:
+        regenerated = await asyncio.to_thread(tutor.revision_is_stale, session_key)
+        if regenerated:
+            try:
+                await generate_revision_questions_async(session_key)
+            except RevisionCancelled:
+                # A newer message or a cleared chat superseded it, answer with the stored set
+                regenerated = False
+        state = await asyncio.to_thread(tutor.session_store.read, session_key)
+        await send_json(send, {
+            'success': True,
+            'regenerated': regenerated,
+            'version': state['revision_version'],
+            'revision_questions': tutor.question_dicts(state['revision_questions'])
+        })
+    except Exception as e:
+        logger.error("Error in async manual revision endpoint: %s", e)
+        await send_json(send, {
+            'success': False,
+            'error': f"Error generating/updating revision questions: {str(e)}"
+        })
+
+
+async def manual_revision_stream(scope, receive, send, user_id):
+    data = await read_json(receive)
+    course_id = data.get('course_id', '')
+    if not course_id:
+        return await send_json(send, {'error': 'Course ID missing'}, 400)
+
+    course = tutor.course_registry.get(course_id)
+    if not course:
+        return await send_json(send, {'error': 'Course not found'}, 404)
+    session_key = tutor.SessionKey(user_id, course['id'])
+    state = await asyncio.to_thread(tutor.session_store.read, session_key)
+    if not state['chat_history']:
+        return await send_json(send, {'error': 'No chat history to generate revisions from'}, 400)
+
+    await send_event_stream(send, generate_revision_stream_async(session_key))
+
+
+async def generate_revision_stream_async(session_key):
+    """
+    Async twin of app.generate_revision_stream, awaiting the upstream stream instead of blocking on it.
+    """
+    state = await asyncio.to_thread(tutor.session_store.read, session_key)
+    version = state['conversation_version']
+    flight, leader = tutor.revision_flights.begin(session_key, version)
+    if not leader:
+        for frame in await asyncio.to_thread(tutor.joined_revision_frames, session_key, flight):
+            yield frame
+        return
+
+    error = RevisionCancelled(f"Revision stream for {session_key} was closed")
+    stream = None
+    try:
+        # The index lookup encodes on the CPU, keep it off the event loop
+        prompt, frames = await asyncio.to_thread(tutor.begin_revision_stream, session_key)
+        if not prompt:
+            error = None
+        for frame in frames:
+            yield frame
+        if not prompt:
+            return
+
+        logger.debug("Streaming revision questions for %s from async OpenAI API...", prompt['course_title'])
+        stream = await get_async_upstream_client().chat_completion(
+            model=tutor.model_name,
+            messages=prompt['messages'],
+            **tutor.revision_stream_options()
+        )
+
+        parser = QuestionStreamParser()
+        parts = []
+        tokens = 0
+        async for chunk in stream:
+            if flight.cancelled:
+                # Stop the completion early, its questions would not be stored
+                await close_stream(stream)
+                flight.check()
+            if chunk.usage:
+                tutor.record_prompt_usage('revision', chunk.usage)
+                tokens = chunk.usage.completion_tokens
+            if chunk.choices and chunk.choices[0].delta.content:
+                content = chunk.choices[0].delta.content
+                parts.append(content)
+                for question in parser.feed(content):
+                    yield sse_frame({'question': question})
+        for question in parser.close():
+            yield sse_frame({'question': question})
+
+        flight.check()
+        end = await asyncio.to_thread(tutor.finish_revision_stream, session_key, prompt, ''.join(parts), tokens)
+        error = None
+        yield end
+
+    except RevisionCancelled as e:
+        error = e
+        logger.info("Revision stream cancelled for %s", session_key)
+        yield await asyncio.to_thread(tutor.revision_stream_end, session_key, False)
+    except Exception as e:
+        error = e
+        logger.error("Error streaming revision questions: %s", e)
+        yield sse_frame({'error': str(e) or "An error occurred while generating revision questions"})
+    finally:
+        try:
+            if stream is not None:
+                # Also when the client went away mid-stream, frees the model's slot and the connection
+                await close_stream(stream)
+        finally:
+            tutor.revision_flights.finish(flight, error=error)
+
+
+async def close_stream(stream):
+    """Close an upstream stream early, the plain AsyncStream or the wrapper holding its concurrency slot"""
+    close = getattr(stream, 'aclose', None) or stream.close
+    await close()
+
+
+async def get_revision_questions(scope, receive, send, user_id):
+    query = parse_qs(scope.get('query_string', b'').decode())
+    course_id = query.get('course_id', [''])[0]
+    if not course_id:
+        return await send_json(send, {'error': 'Course ID missing'}, 400)
+
+    course = tutor.course_registry.get(course_id)
+    if not course:
+        return await send_json(send, {'error': 'Course not found'}, 404)
+    session_key = tutor.SessionKey(user_id, course['id'])
+    payload = await asyncio.to_thread(tutor.revision_payload, session_key, query_int(query, 'version'))
+    await send_json(send, {'success': True, **payload})
+
+
+async def revision_status(scope, receive, send, user_id):
+    query = parse_qs(scope.get('query_string', b'').decode())
+    course_id = query.get('course_id', [''])[0]
+    job_id = query.get('job_id', [''])[0]
+    if not course_id or not job_id:
+        return await send_json(send, {'error': 'Course ID or job ID missing'}, 400)
+
+    course = tutor.course_registry.get(course_id)
+    if not course:
+        return await send_json(send, {'error': 'Course not found'}, 404)
+    session_key = tutor.SessionKey(user_id, course['id'])
+    state = await asyncio.to_thread(tutor.session_store.read, session_key)
+    job = state['revision_job']
+    if not job or job['job_id'] != job_id:
+        return await send_json(send, {'error': 'Revision job not found'}, 404)
+
+    result = {'success': job['status'] != 'failed', **job}
+    if job['status'] == 'done':
+        result.update(await asyncio.to_thread(tutor.revision_payload, session_key, query_int(query, 'version')))
+    await send_json(send, result)
+
+
+def query_int(query, name):
+    try:
+        return int(query[name][0])
+    except (KeyError, ValueError):
+        return None
+
+
+# Routes served on the event loop, everything else falls through to Flask
+ROUTES = {
+    ('POST', '/api/send_message'): send_message,
+    ('POST', '/api/generate_revision'): manual_revision,
+    ('POST', '/api/generate_revision_stream'): manual_revision_stream,
+    ('GET', '/api/revision_questions'): get_revision_questions,
+    ('GET', '/api/revision_status'): revision_status,
+}
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] == 'http':
+        handler = ROUTES.get((scope['method'], scope['path']))
+        if handler:
+            user_id = load_flask_session(scope).get('user_id')
+            if not user_id:
+                return await send_json(send, {'error': 'Not authenticated'}, 401)
+            return await handler(scope, receive, send, user_id)
+
+    await wsgi_application(scope, receive, send)
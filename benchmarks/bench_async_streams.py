@@ -0,0 +1,204 @@
+"""
+Concurrent chat stream benchmark: sync (gunicorn app:app) vs asyncio (uvicorn asgi:application).
+
+Starts the stub OpenAI server and a single worker of the app, logs in one simulated student per
+stream, then opens N /api/send_message streams at once and reports how many were in flight
+together, how long they took and how much the worker's RSS grew per stream.
+
+    python benchmarks/bench_async_streams.py --mode asgi --concurrency 10,100,500
+    python benchmarks/bench_async_streams.py --mode wsgi --concurrency 10,100
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+
+def process_tree_rss_kb(pid):
+    """Resident memory of a process and all its children, in KiB (Linux only)"""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pending.extend(int(child) for child in f.read().split())
+        except FileNotFoundError:
+            continue
+    return total
+
+
+def start_stub(args):
+    port = free_port()
+    proc = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, 'benchmarks', 'stub_openai.py'),
+        '--port', str(port),
+        '--tokens', str(args.tokens),
+        '--token-delay', str(args.token_delay),
+        '--ttft', str(args.ttft),
+    ])
+    wait_for_port(port)
+    return proc, port
+
+
+def start_server(mode, stub_port, extra_env=None):
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        'OPENAI_API_KEY': 'stub',
+        'OPENAI_BASE_URL': f'http://127.0.0.1:{stub_port}/v1',
+        # Keep revision generation out of the way of the stream measurement
+        'REVISION_QUESTIONS_N': '1000000',
+    })
+    env.update(extra_env or {})
+    if mode == 'asgi':
+        cmd = [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', str(port),
+               '--log-level', 'warning', '--backlog', '4096']
+    else:
+        cmd = [sys.executable, '-m', 'gunicorn', 'app:app', '--workers', '1',
+               '--bind', f'127.0.0.1:{port}', '--backlog', '4096', '--timeout', '300']
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    wait_for_port(port)
+    return proc, port
+
+
+async def login(client, username):
+    response = await client.post('/login', data={'username': username, 'password': 'bench'})
+    return dict(response.cookies)
+
+
+async def run_stream(client, cookies, stats):
+    start = time.perf_counter()
+    first_chunk = None
+    chunks = 0
+    async with client.stream('POST', '/api/send_message',
+                             json={'message': 'What is a derivative?', 'course_id': '1'},
+                             cookies=cookies) as response:
+        stats['open'] += 1
+        stats['max_open'] = max(stats['max_open'], stats['open'])
+        async for line in response.aiter_lines():
+            if line.startswith('data:'):
+                chunks += 1
+                if first_chunk is None:
+                    first_chunk = time.perf_counter() - start
+        stats['open'] -= 1
+    return {'ttft': first_chunk, 'total': time.perf_counter() - start, 'chunks': chunks}
+
+
+async def sample_rss(pid, samples, stop):
+    while not stop.is_set():
+        samples.append(process_tree_rss_kb(pid))
+        await asyncio.sleep(0.05)
+
+
+def percentile(values, pct):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+async def run_level(base_url, server_pid, concurrency):
+    limits = httpx.Limits(max_connections=concurrency + 10, max_keepalive_connections=concurrency + 10)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=600) as client:
+        cookies = await asyncio.gather(*(login(client, f'bench{i}') for i in range(concurrency)))
+
+        rss_idle = process_tree_rss_kb(server_pid)
+        samples, stop = [], asyncio.Event()
+        sampler = asyncio.create_task(sample_rss(server_pid, samples, stop))
+
+        stats = {'open': 0, 'max_open': 0}
+        start = time.perf_counter()
+        results = await asyncio.gather(*(run_stream(client, c, stats) for c in cookies), return_exceptions=True)
+        wall = time.perf_counter() - start
+
+        stop.set()
+        await sampler
+
+    ok = [r for r in results if isinstance(r, dict)]
+    errors = sorted({type(r).__name__ for r in results if not isinstance(r, dict)})
+    rss_peak = max(samples + [rss_idle])
+    return {
+        'concurrency': concurrency,
+        'completed': len(ok),
+        'failed': len(results) - len(ok),
+        'errors': errors,
+        'max_in_flight': stats['max_open'],
+        'wall_seconds': round(wall, 3),
+        'streams_per_second': round(len(ok) / wall, 2) if wall else None,
+        'ttft_p50': percentile([r['ttft'] for r in ok], 50),
+        'ttft_p99': percentile([r['ttft'] for r in ok], 99),
+        'stream_p50': percentile([r['total'] for r in ok], 50),
+        'stream_p99': percentile([r['total'] for r in ok], 99),
+        'rss_idle_kb': rss_idle,
+        'rss_peak_kb': rss_peak,
+        'rss_per_stream_kb': round((rss_peak - rss_idle) / max(stats['max_open'], 1), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['asgi', 'wsgi'], default='asgi')
+    parser.add_argument('--concurrency', default='10,100', help='Comma separated concurrent stream counts')
+    parser.add_argument('--tokens', type=int, default=100)
+    parser.add_argument('--token-delay', type=float, default=0.02)
+    parser.add_argument('--ttft', type=float, default=0.2)
+    parser.add_argument('--output', help='Write the JSON report to this file as well')
+    args = parser.parse_args()
+
+    stub, stub_port = start_stub(args)
+    server, port = start_server(args.mode, stub_port)
+    try:
+        levels = [int(c) for c in args.concurrency.split(',')]
+        report = {
+            'benchmark': 'async_streams',
+            'mode': args.mode,
+            'workers': 1,
+            'tokens_per_stream': args.tokens,
+            'token_delay': args.token_delay,
+            'levels': [asyncio.run(run_level(f'http://127.0.0.1:{port}', server.pid, c)) for c in levels],
+        }
+    finally:
+        server.terminate()
+        stub.terminate()
+        server.wait()
+        stub.wait()
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
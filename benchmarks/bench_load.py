@@ -0,0 +1,275 @@
+"""
+End-to-end load benchmark: simulated students against the app and a stub OpenAI server.
+
+Starts the stub OpenAI server (configurable token rate and latency) and the app under gunicorn
+(sync workers, optionally threaded) or uvicorn, then runs concurrent students. Each logs in,
+asks --messages questions over /api/send_message, pausing --think-time between them, and
+finally asks for revision questions over /api/generate_revision.
+
+Reports p50/p95/p99 time to first token, stream time and revision latency, throughput, how
+saturated the workers were (requests in flight against what the workers can serve at once),
+and the app's RSS per session. The JSON report carries the commit and settings it ran with;
+pass an earlier report with --compare to print the relative change of the headline numbers.
+
+    python benchmarks/bench_load.py --students 50 --output load.json
+    python benchmarks/bench_load.py --mode wsgi --workers 4 --threads 8 --students 100
+    python benchmarks/bench_load.py --students 50 --compare load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_async_streams import ROOT, free_port, percentile, process_tree_rss_kb, wait_for_port  # noqa: E402
+
+# Headline numbers compared by --compare, and whether higher is better
+COMPARED = {
+    'ttft_p50': False, 'ttft_p95': False, 'ttft_p99': False,
+    'stream_p95': False, 'revision_p95': False,
+    'messages_per_second': True, 'rss_per_session_kb': False,
+}
+
+
+def start_stub(args):
+    port = free_port()
+    proc = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, 'benchmarks', 'stub_openai.py'),
+        '--port', str(port),
+        '--tokens', str(args.tokens),
+        '--token-delay', str(args.token_delay),
+        '--ttft', str(args.ttft),
+        '--completion-latency', str(args.completion_latency),
+        '--seed', '0',
+    ])
+    wait_for_port(port)
+    return proc, port
+
+
+def start_app(args, stub_port):
+    port = free_port()
+    env = dict(os.environ)
+    env.update({
+        'OPENAI_API_KEY': 'stub',
+        'OPENAI_BASE_URL': f'http://127.0.0.1:{stub_port}/v1',
+        'LOG_LEVEL': 'WARNING',
+        # Revisions are only generated when a student asks, unless --auto-revisions
+        'REVISION_QUESTIONS_N': str(args.auto_revisions or 1000000),
+    })
+    if args.mode == 'asgi':
+        cmd = [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', str(port),
+               '--workers', str(args.workers), '--log-level', 'warning', '--backlog', '4096']
+    else:
+        cmd = [sys.executable, '-m', 'gunicorn', 'app:app', '--workers', str(args.workers),
+               '--threads', str(args.threads), '--bind', f'127.0.0.1:{port}', '--backlog', '4096',
+               '--timeout', '300']
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    wait_for_port(port)
+    return proc, port
+
+
+class Load:
+    """Requests in flight, sampled while the students run"""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.samples = []
+
+    def start(self):
+        self.in_flight += 1
+
+    def end(self):
+        self.in_flight -= 1
+
+
+async def send_message(client, load, results, message):
+    start = time.perf_counter()
+    first_chunk = None
+    chunks = 0
+    load.start()
+    try:
+        async with client.stream('POST', '/api/send_message', json={'message': message, 'course_id': '1'}) as response:
+            async for line in response.aiter_lines():
+                if line.startswith('data:'):
+                    chunks += 1
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter() - start
+                    if '"error"' in line:
+                        raise RuntimeError(line)
+        results['messages'].append({'ttft': first_chunk, 'total': time.perf_counter() - start, 'chunks': chunks})
+    finally:
+        load.end()
+
+
+async def generate_revision(client, load, results):
+    start = time.perf_counter()
+    load.start()
+    try:
+        response = await client.post('/api/generate_revision', json={'course_id': '1'})
+        if not response.json().get('success'):
+            raise RuntimeError(response.text)
+        results['revisions'].append(time.perf_counter() - start)
+    finally:
+        load.end()
+
+
+async def run_student(base_url, student, args, load, results, messages=None):
+    async with httpx.AsyncClient(base_url=base_url, timeout=600) as client:
+        await client.post('/login', data={'username': f'student{student}', 'password': 'bench'})
+        for i in range(args.messages if messages is None else messages):
+            try:
+                await send_message(client, load, results, f'Question {i}: what is a derivative of x^{i}?')
+            except Exception as e:
+                results['errors'].append(type(e).__name__)
+            await asyncio.sleep(args.think_time)
+        if args.revision:
+            try:
+                await generate_revision(client, load, results)
+            except Exception as e:
+                results['errors'].append(type(e).__name__)
+
+
+async def sample(pid, load, rss, stop):
+    while not stop.is_set():
+        load.samples.append(load.in_flight)
+        rss.append(process_tree_rss_kb(pid))
+        await asyncio.sleep(0.05)
+
+
+async def run(base_url, server_pid, args):
+    # Warm up every worker first, the app loads its clients on first use
+    warmup = {'messages': [], 'revisions': [], 'errors': []}
+    await asyncio.gather(*(
+        run_student(base_url, f'warmup{i}', args, Load(), warmup, messages=1)
+        for i in range(args.workers * args.threads)
+    ))
+
+    results = {'messages': [], 'revisions': [], 'errors': []}
+    load = Load()
+    rss_idle = process_tree_rss_kb(server_pid)
+    rss, stop = [], asyncio.Event()
+    sampler = asyncio.create_task(sample(server_pid, load, rss, stop))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_student(base_url, s, args, load, results) for s in range(args.students)))
+    wall = time.perf_counter() - start
+
+    stop.set()
+    await sampler
+    # Sessions stay in memory after the students leave
+    rss_after = process_tree_rss_kb(server_pid)
+
+    messages = results['messages']
+    ttft = [m['ttft'] for m in messages]
+    totals = [m['total'] for m in messages]
+    capacity = args.workers * args.threads if args.mode == 'wsgi' else None
+    mean_in_flight = sum(load.samples) / len(load.samples) if load.samples else 0
+    errors = {}
+    for error in results['errors']:
+        errors[error] = errors.get(error, 0) + 1
+    return {
+        'messages': len(messages),
+        'revisions': len(results['revisions']),
+        'errors': errors,
+        'wall_seconds': round(wall, 3),
+        'messages_per_second': round(len(messages) / wall, 2),
+        'frames_per_second': round(sum(m['chunks'] for m in messages) / wall, 1),
+        'ttft_p50': seconds(ttft, 50),
+        'ttft_p95': seconds(ttft, 95),
+        'ttft_p99': seconds(ttft, 99),
+        'stream_p50': seconds(totals, 50),
+        'stream_p95': seconds(totals, 95),
+        'stream_p99': seconds(totals, 99),
+        'revision_p50': seconds(results['revisions'], 50),
+        'revision_p95': seconds(results['revisions'], 95),
+        'revision_p99': seconds(results['revisions'], 99),
+        # Time to first token the stub doesn't account for, i.e. queueing in front of the workers
+        'queueing_p95': round(max(0.0, (percentile(ttft, 95) or 0) - args.ttft), 4),
+        'max_in_flight': max(load.samples, default=0),
+        'mean_in_flight': round(mean_in_flight, 2),
+        'worker_capacity': capacity,
+        'worker_saturation': round(min(1.0, mean_in_flight / capacity), 3) if capacity else None,
+        'rss_idle_kb': rss_idle,
+        'rss_peak_kb': max(rss + [rss_idle]),
+        'rss_after_kb': rss_after,
+        'rss_per_session_kb': round((rss_after - rss_idle) / args.students, 1),
+    }
+
+
+def seconds(values, pct):
+    value = percentile(values, pct)
+    return round(value, 4) if value is not None else None
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, path):
+    """Relative change of the headline numbers against an earlier report, positive is better"""
+    with open(path) as f:
+        baseline = json.load(f)
+    changes = {'baseline_commit': baseline.get('commit')}
+    for key, higher_is_better in COMPARED.items():
+        before, after = baseline['results'].get(key), report['results'].get(key)
+        if before and after is not None:
+            change = (after - before) / before
+            changes[key] = round(change if higher_is_better else -change, 3)
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['asgi', 'wsgi'], default='asgi')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=1, help='Threads per gunicorn worker (wsgi mode)')
+    parser.add_argument('--students', type=int, default=20, help='Concurrent simulated students')
+    parser.add_argument('--messages', type=int, default=5, help='Questions per student')
+    parser.add_argument('--think-time', type=float, default=0.5, help='Seconds between a student\'s questions')
+    parser.add_argument('--no-revision', dest='revision', action='store_false', help="Don't ask for revision questions")
+    parser.add_argument('--auto-revisions', type=int, default=0, help='REVISION_QUESTIONS_N for the app, 0 for none')
+    parser.add_argument('--tokens', type=int, default=100, help='Tokens per streamed answer')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='Seconds between streamed tokens')
+    parser.add_argument('--ttft', type=float, default=0.2, help='Seconds before the first streamed token')
+    parser.add_argument('--completion-latency', type=float, default=1.0, help='Seconds per revision completion')
+    parser.add_argument('--compare', help='Earlier JSON report to compare against')
+    parser.add_argument('--output', help='Write the JSON report to this file as well')
+    args = parser.parse_args()
+
+    stub, stub_port = start_stub(args)
+    server, port = start_app(args, stub_port)
+    try:
+        results = asyncio.run(run(f'http://127.0.0.1:{port}', server.pid, args))
+    finally:
+        server.terminate()
+        stub.terminate()
+        server.wait()
+        stub.wait()
+
+    report = {
+        'benchmark': 'load',
+        'commit': git_commit(),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('compare', 'output')},
+        'results': results,
+    }
+    if args.compare:
+        report['compare'] = compare(report, args.compare)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
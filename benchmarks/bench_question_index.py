@@ -0,0 +1,94 @@
+"""
+QuestionIndex benchmark: append, memory-mapped reopen and top-k search at growing sizes.
+
+Uses random unit vectors of the all-MiniLM-L6-v2 dimension, so it needs neither the model
+nor network access.
+
+    python benchmarks/bench_question_index.py --sizes 10000,100000,1000000
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from question_index import QuestionIndex  # noqa: E402
+
+DIM = 384
+BATCH = 10000
+
+
+def random_unit_vectors(rng, n):
+    vectors = rng.standard_normal((n, DIM), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def bench_size(size, queries, k, rng):
+    directory = tempfile.mkdtemp(prefix='question_index_')
+    try:
+        index = QuestionIndex(directory, DIM)
+        start = time.perf_counter()
+        for offset in range(0, size, BATCH):
+            n = min(BATCH, size - offset)
+            questions = [{'question': f'Question {offset + i}', 'options': {}, 'correct': 'a'} for i in range(n)]
+            index.add(random_unit_vectors(rng, n), questions, skip_duplicates=False)
+        build_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = QuestionIndex(directory, DIM)
+        open_seconds = time.perf_counter() - start
+
+        query_vectors = random_unit_vectors(rng, queries)
+        index.search(query_vectors[0], k)  # Fault the mapped pages in once
+        latencies = []
+        for query in query_vectors:
+            start = time.perf_counter()
+            index.search(query, k)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+
+        return {
+            'size': size,
+            'k': k,
+            'build_seconds': round(build_seconds, 3),
+            'open_seconds': round(open_seconds, 4),
+            'matrix_mb': round(size * DIM * 4 / 2 ** 20, 1),
+            'search_ms_p50': round(latencies[len(latencies) // 2] * 1000, 3),
+            'search_ms_p99': round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+            'searches_per_second': round(len(latencies) / sum(latencies), 1),
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='Comma separated index sizes')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--output', help='Write the JSON report to this file as well')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    report = {
+        'benchmark': 'question_index',
+        'dim': DIM,
+        'results': [bench_size(int(size), args.queries, args.k, rng) for size in args.sizes.split(',')],
+    }
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Session state memory benchmark: bytes per session of the slotted records against the dict layout
+they replaced (a dict per message with its formatted timestamp string, a dict of dicts per
+revision question).
+
+Builds --sizes sessions of --messages chat messages and --questions revision questions each,
+every text unique as it would be across students, and measures the heap they hold with
+tracemalloc. The structure figure leaves out the message and question texts, which both layouts
+hold alike, so it is the per-object overhead the records save. Also reports the pickled size of a
+session, what SQLiteSessionStore writes per request.
+
+    python benchmarks/bench_session_memory.py
+    python benchmarks/bench_session_memory.py --sizes 10000,100000 --messages 20 --questions 10
+"""
+import argparse
+import gc
+import json
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from revision_parser import OPTION_KEYS  # noqa: E402
+from session_records import ChatMessage, RevisionQuestion  # noqa: E402
+from session_store import new_session_state  # noqa: E402
+
+
+def texts(session, args):
+    """Unique message and question texts of one session, of typical lengths"""
+    messages = []
+    for i in range(args.messages):
+        if i % 2 == 0:
+            messages.append(('user', f"Student {session} question {i}: how do I differentiate x^{i} times sin(x)?"))
+        else:
+            messages.append(('assistant', f"Answer {i} for student {session}: use the product rule. " * 6))
+    questions = []
+    for i in range(args.questions):
+        questions.append((
+            f"Question {i} for student {session}: what is the derivative of x^{i}?",
+            [f"Option {key} of question {i} for {session}" for key in OPTION_KEYS],
+            OPTION_KEYS[i % len(OPTION_KEYS)],
+        ))
+    return messages, questions
+
+
+def dict_session(session, args):
+    """A session as stored before the records"""
+    messages, questions = texts(session, args)
+    state = new_session_state()
+    for seq, (role, content) in enumerate(messages, 1):
+        state['chat_history'].append({
+            'role': role,
+            'content': content,
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'seq': seq,
+            'tokens': len(content) // 4 + 5,
+        })
+    state['revision_questions'] = [
+        {'question': question, 'options': dict(zip(OPTION_KEYS, options)), 'correct': correct}
+        for question, options, correct in questions
+    ]
+    return state
+
+
+def record_session(session, args):
+    messages, questions = texts(session, args)
+    state = new_session_state()
+    for seq, (role, content) in enumerate(messages, 1):
+        state['chat_history'].append(ChatMessage(role, content, seq, tokens=len(content) // 4 + 5))
+    state['revision_questions'] = [RevisionQuestion(*question) for question in questions]
+    return state
+
+
+def text_bytes(state):
+    """Heap held by the texts of a session, the same in both layouts"""
+    total = sum(sys.getsizeof(m['content'] if isinstance(m, dict) else m.content) for m in state['chat_history'])
+    for q in state['revision_questions']:
+        if isinstance(q, dict):
+            total += sys.getsizeof(q['question']) + sum(sys.getsizeof(o) for o in q['options'].values())
+        else:
+            total += sys.getsizeof(q.question) + sum(sys.getsizeof(o) for o in q.options)
+    return total
+
+
+def measure(build, size, args):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    sessions = {f"student{i}-{i % 8 + 1}": build(i, args) for i in range(size)}
+    built = time.perf_counter() - start
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    sample = list(sessions.values())[:1000]
+    texts_per_session = sum(text_bytes(state) for state in sample) / len(sample)
+    pickled = sum(len(pickle.dumps(state, pickle.HIGHEST_PROTOCOL)) for state in sample) / len(sample)
+    start = time.perf_counter()
+    for state in sample:
+        pickle.loads(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+    roundtrip = (time.perf_counter() - start) / len(sample)
+    del sessions, sample
+    gc.collect()
+    return {
+        'bytes_per_session': round(held / size),
+        'structure_bytes_per_session': round(held / size - texts_per_session),
+        'pickled_bytes_per_session': round(pickled),
+        'pickle_roundtrip_us': round(roundtrip * 1e6, 1),
+        'build_seconds': round(built, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000', help='Comma separated session counts')
+    parser.add_argument('--messages', type=int, default=10, help='Chat messages per session')
+    parser.add_argument('--questions', type=int, default=5, help='Revision questions per session')
+    parser.add_argument('--output', help='Write the JSON report to this file as well')
+    args = parser.parse_args()
+
+    results = []
+    for size in map(int, args.sizes.split(',')):
+        dicts = measure(dict_session, size, args)
+        records = measure(record_session, size, args)
+        results.append({
+            'sessions': size,
+            'dicts': dicts,
+            'records': records,
+            'saved_bytes_per_session': dicts['bytes_per_session'] - records['bytes_per_session'],
+            'structure_ratio': round(records['structure_bytes_per_session'] / dicts['structure_bytes_per_session'], 3),
+        })
+
+    report = {
+        'benchmark': 'session_memory',
+        'settings': {'messages': args.messages, 'questions': args.questions},
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Session snapshot benchmark: how long a restarted worker takes to serve its first request with
+the sessions of the previous one, restoring them lazily from the snapshot against replaying them
+all up front, and what the periodic delta saves cost.
+
+Fills a MemorySessionStore with --sizes sessions (built as in bench_session_memory.py), saves a
+full snapshot, then in a fresh store measures the time to the first served session, the restore
+time of sessions on first access and the delta save after --touched of the sessions changed. The
+eager figure is the time to unpickle every session of the same file, what loading them all at
+start would cost.
+
+    python benchmarks/bench_session_snapshot.py
+    python benchmarks/bench_session_snapshot.py --sizes 10000,100000 --touched 0.01
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_session_memory import record_session  # noqa: E402
+from session_snapshot import SessionSnapshot  # noqa: E402
+from session_store import MemorySessionStore, SessionKey  # noqa: E402
+
+
+def new_store(path, size):
+    return MemorySessionStore(size * 2, ttl=0, snapshot=SessionSnapshot(path), snapshot_interval=0)
+
+
+def run(size, args, directory):
+    path = os.path.join(directory, f'sessions-{size}.snap')
+    keys = [SessionKey(f'student{i}', str(i % 8 + 1)) for i in range(size)]
+
+    store = new_store(path, size)
+    store.read(keys[0])  # Opens the (empty) snapshot
+    for i, key in enumerate(keys):
+        store.put(key, record_session(i, args))
+    start = time.perf_counter()
+    store.save()
+    full_save = time.perf_counter() - start
+    file_bytes = os.path.getsize(path)
+    del store
+
+    # A restarted worker: open the snapshot and serve one session
+    store = new_store(path, size)
+    start = time.perf_counter()
+    first = store.read(keys[size // 2])
+    first_served = time.perf_counter() - start
+    assert first['chat_history'], "Session was not restored"
+
+    restores = []
+    for key in random.Random(0).sample(keys, min(1000, size)):
+        start = time.perf_counter()
+        store.read(key)
+        restores.append(time.perf_counter() - start)
+
+    touched = random.Random(1).sample(keys, max(1, int(size * args.touched)))
+    for key in touched:
+        with store.session(key) as state:
+            state['question_count'] += 1
+    before = os.path.getsize(path)
+    start = time.perf_counter()
+    store.save()
+    delta_save = time.perf_counter() - start
+    delta_bytes = os.path.getsize(path) - before
+
+    # Replaying everything: unpickle every session of the snapshot before serving
+    snapshot = SessionSnapshot(path)
+    start = time.perf_counter()
+    snapshot.open()
+    for text in snapshot.keys():
+        snapshot.load(text)
+    eager = time.perf_counter() - start
+    os.remove(path)
+
+    return {
+        'sessions': size,
+        'file_bytes_per_session': round(file_bytes / size),
+        'full_save_seconds': round(full_save, 3),
+        'first_session_served_ms': round(first_served * 1000, 2),
+        'eager_restore_seconds': round(eager, 3),
+        'restore_on_access_us': {
+            'p50': round(statistics.median(restores) * 1e6, 1),
+            'max': round(max(restores) * 1e6, 1),
+        },
+        'delta_sessions': len(touched),
+        'delta_save_ms': round(delta_save * 1000, 2),
+        'delta_bytes': delta_bytes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000', help='Comma separated session counts')
+    parser.add_argument('--messages', type=int, default=10, help='Chat messages per session')
+    parser.add_argument('--questions', type=int, default=5, help='Revision questions per session')
+    parser.add_argument('--touched', type=float, default=0.01, help='Fraction of sessions changed before the delta save')
+    parser.add_argument('--dir', help='Directory of the snapshot files, a temporary one by default')
+    parser.add_argument('--output', help='Write the JSON report to this file as well')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        results = [run(size, args, directory) for size in map(int, args.sizes.split(','))]
+
+    report = {
+        'benchmark': 'session_snapshot',
+        'settings': {'messages': args.messages, 'questions': args.questions, 'touched': args.touched},
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Worker startup benchmark: lazy loading vs PRELOAD_MODELS=1.
+
+Measures, for each mode:
+  - how long `import app` takes in a fresh interpreter, and its peak RSS
+  - how long a gunicorn server with --workers N takes until it answers its first request,
+    and the memory of the whole process tree once it has (RSS counts pages shared
+    copy-on-write in every worker, PSS splits them between the workers sharing them)
+  - the latency of the first chat message, which is where lazy mode pays for the model
+
+The chat message goes to the stub OpenAI server, so no API key or network access is needed.
+The sentence model is only loaded when sentence-transformers is installed.
+
+    python benchmarks/bench_startup.py --workers 4 --repeats 5
+"""
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_async_streams import ROOT, free_port, wait_for_port, process_tree_rss_kb, start_stub  # noqa: E402
+
+MODES = {'lazy': '0', 'preload': '1'}
+
+IMPORT_SCRIPT = """
+import json, resource, time
+start = time.perf_counter()
+import app
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+"""
+
+
+def process_tree_pss_kb(pid):
+    """Proportional set size of a process and all its children, in KiB (Linux only)"""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/smaps_rollup') as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        total += int(line.split()[1])
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pending.extend(int(child) for child in f.read().split())
+        except FileNotFoundError:
+            continue
+    return total
+
+
+def app_env(preload, stub_port):
+    env = dict(os.environ)
+    env.update({
+        'OPENAI_API_KEY': 'stub',
+        'OPENAI_BASE_URL': f'http://127.0.0.1:{stub_port}/v1',
+        'PRELOAD_MODELS': preload,
+        'REVISION_QUESTIONS_N': '1000000',
+    })
+    return env
+
+
+def bench_import(preload, stub_port, repeats):
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_SCRIPT], cwd=ROOT, env=app_env(preload, stub_port),
+            capture_output=True, text=True, check=True
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        'import_seconds_median': round(statistics.median(r['seconds'] for r in runs), 3),
+        'import_max_rss_mb': round(statistics.median(r['max_rss_kb'] for r in runs) / 1024, 1),
+    }
+
+
+def bench_server(preload, stub_port, workers):
+    port = free_port()
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:app', '--workers', str(workers),
+         '--bind', f'127.0.0.1:{port}', '--timeout', '300'],
+        cwd=ROOT, env=app_env(preload, stub_port), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_for_port(port, timeout=300)
+        with httpx.Client(base_url=f'http://127.0.0.1:{port}', timeout=300) as client:
+            client.get('/')
+            ready_seconds = time.perf_counter() - start
+            time.sleep(1)  # Let the remaining workers finish booting
+            rss_kb, pss_kb = process_tree_rss_kb(proc.pid), process_tree_pss_kb(proc.pid)
+
+            client.post('/login', data={'username': 'bench', 'password': 'bench'})
+            start = time.perf_counter()
+            with client.stream('POST', '/api/send_message',
+                               json={'message': 'What is a derivative?', 'course_id': '1'}) as response:
+                for _ in response.iter_lines():
+                    pass
+            first_message_seconds = time.perf_counter() - start
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    return {
+        'ready_seconds': round(ready_seconds, 3),
+        'first_message_seconds': round(first_message_seconds, 3),
+        'tree_rss_mb': round(rss_kb / 1024, 1),
+        'tree_pss_mb': round(pss_kb / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', default='lazy,preload', help='Comma separated modes: lazy, preload')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=5, help='Fresh imports timed per mode')
+    parser.add_argument('--output', help='Write the JSON report to this file as well')
+    args = parser.parse_args()
+    args.tokens, args.token_delay, args.ttft = 20, 0.0, 0.0
+
+    stub, stub_port = start_stub(args)
+    try:
+        results = []
+        for mode in args.modes.split(','):
+            result = {'mode': mode, 'workers': args.workers}
+            result.update(bench_import(MODES[mode], stub_port, args.repeats))
+            result.update(bench_server(MODES[mode], stub_port, args.workers))
+            results.append(result)
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    report = {
+        'benchmark': 'startup',
+        'sentence_transformers': importlib.util.find_spec('sentence_transformers') is not None,
+        'results': results,
+    }
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
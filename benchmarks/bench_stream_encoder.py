@@ -0,0 +1,191 @@
+"""
+Chat stream encoder microbenchmark: frames, bytes on the wire and encode cost per flush policy.
+
+Replays recorded completion streams through StreamEncoder with every flush policy, and through
+the previous encoder (concatenate, re-split the buffer on spaces, one escaped JSON frame per
+word) as a baseline. Stream timing is replayed on a virtual clock, so the time policy sees the
+recorded gaps between deltas without the benchmark sleeping through them.
+
+A recording is a JSON lines file, one stream per line, each a list of [seconds since the
+request, delta] pairs. Record real answers from any OpenAI compatible server with --record;
+without --streams, synthetic streams of GPT-like deltas are replayed instead.
+
+    python benchmarks/bench_stream_encoder.py
+    python benchmarks/bench_stream_encoder.py --record 20 --streams streams.jsonl
+    python benchmarks/bench_stream_encoder.py --streams streams.jsonl --flush-ms 50 --flush-bytes 256
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stream_encoder  # noqa: E402
+from stream_encoder import POLICIES, StreamEncoder  # noqa: E402
+
+SAMPLE_ANSWERS = [
+    "A derivative measures how a function changes as its input changes. For f(x) = x^2 the "
+    "derivative is f'(x) = 2x, so the slope of the curve at x = 3 is 6. Geometrically it is the "
+    "slope of the tangent line, and physically it is an instantaneous rate of change, such as "
+    "velocity being the derivative of position with respect to time.\n\n1. Power rule\n2. Product "
+    "rule\n3. Chain rule",
+    "Phở là món ăn truyền thống của Việt Nam, gồm bánh phở, nước dùng và thịt bò hoặc gà. "
+    "Hà Nội và Nam Định được xem là cái nôi của phở. Vietnam's capital is Hanoi, and the "
+    "Mekong Delta in the south is one of the largest rice producing regions in Asia.",
+    "A hash table stores key value pairs in an array of buckets. A hash function maps each key "
+    "to a bucket, so lookups take O(1) time on average. Collisions are handled by chaining, "
+    "where each bucket holds a list, or by open addressing, where the next free slot is probed.",
+]
+
+
+class ReplayClock:
+    """Stands in for the time module inside stream_encoder during a replay"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+def synthetic_streams(count, token_delay, rng):
+    """Split sample answers into GPT-like deltas of a few characters, usually starting with a space"""
+    streams = []
+    for i in range(count):
+        text = SAMPLE_ANSWERS[i % len(SAMPLE_ANSWERS)] * rng.randint(1, 4)
+        deltas, position, at = [], 0, 0.3
+        while position < len(text):
+            size = rng.choice((1, 2, 3, 4, 4, 5, 6))
+            deltas.append([round(at, 4), text[position:position + size]])
+            position += size
+            at += token_delay * rng.uniform(0.5, 1.5)
+        streams.append(deltas)
+    return streams
+
+
+def record_streams(count, path):
+    """Record streamed answers with their timing from the server OPENAI_BASE_URL points at"""
+    from openai import OpenAI
+    client = OpenAI()
+    questions = ['What is a derivative?', 'Tell me about Vietnamese food.', 'How does a hash table work?']
+    with open(path, 'w') as f:
+        for i in range(count):
+            start = time.perf_counter()
+            deltas = []
+            stream = client.chat.completions.create(
+                model=os.getenv('MODEL_NAME', 'gpt-4o-mini'),
+                messages=[{'role': 'user', 'content': questions[i % len(questions)]}],
+                stream=True
+            )
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    deltas.append([round(time.perf_counter() - start, 4), chunk.choices[0].delta.content])
+            f.write(json.dumps(deltas) + '\n')
+
+
+def legacy_frames(deltas):
+    """The encoder StreamEncoder replaced, kept here as the baseline"""
+    full_response = ""
+    buffer = ""
+    for _, content in deltas:
+        full_response += content
+        buffer += content
+        *complete, buffer = buffer.split(" ")
+        for word in complete:
+            if word:
+                yield f"data: {json.dumps({'chunk': word + ' '})}\n\n"
+    if buffer:
+        yield f"data: {json.dumps({'chunk': buffer})}\n\n"
+
+
+def policy_frames(policy, deltas, clock, flush_interval, flush_bytes):
+    clock.now = 0.0
+    encoder = StreamEncoder(policy, flush_interval, flush_bytes)
+    for at, content in deltas:
+        clock.now = at
+        yield from encoder.feed(content)
+    yield from encoder.close()
+    encoder.text()
+
+
+def measure(name, replay, streams, repeats):
+    frames = wire_bytes = 0
+    for deltas in streams:
+        for frame in replay(deltas):
+            frames += 1
+            wire_bytes += len(frame.encode())
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for deltas in streams:
+            for _ in replay(deltas):
+                pass
+    seconds = time.perf_counter() - start
+
+    return {
+        'encoder': name,
+        'frames_per_stream': round(frames / len(streams), 1),
+        'bytes_per_stream': round(wire_bytes / len(streams)),
+        'bytes_per_frame': round(wire_bytes / frames, 1),
+        'encode_us_per_stream': round(seconds / (repeats * len(streams)) * 1e6, 1),
+        'frames_per_second': round(frames * repeats / seconds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--streams', help='JSON lines file of recorded streams')
+    parser.add_argument('--record', type=int, default=0, help='Record this many streams into --streams first')
+    parser.add_argument('--synthetic', type=int, default=100, help='Synthetic streams replayed without --streams')
+    parser.add_argument('--token-delay', type=float, default=0.02, help='Mean gap between synthetic deltas, seconds')
+    parser.add_argument('--flush-ms', type=float, default=50)
+    parser.add_argument('--flush-bytes', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--output', help='Write the JSON report to this file as well')
+    args = parser.parse_args()
+
+    if args.record:
+        if not args.streams:
+            parser.error('--record needs --streams to write to')
+        record_streams(args.record, args.streams)
+    if args.streams:
+        with open(args.streams) as f:
+            streams = [json.loads(line) for line in f if line.strip()]
+    else:
+        streams = synthetic_streams(args.synthetic, args.token_delay, random.Random(0))
+
+    clock = ReplayClock()
+    stream_encoder.time = clock
+    try:
+        results = [measure('legacy', legacy_frames, streams, args.repeats)]
+        for policy in POLICIES:
+            results.append(measure(
+                policy,
+                lambda deltas: policy_frames(policy, deltas, clock, args.flush_ms / 1000, args.flush_bytes),
+                streams,
+                args.repeats
+            ))
+    finally:
+        stream_encoder.time = time
+
+    report = {
+        'benchmark': 'stream_encoder',
+        'streams': len(streams),
+        'deltas_per_stream': round(sum(len(s) for s in streams) / len(streams), 1),
+        'flush_ms': args.flush_ms,
+        'flush_bytes': args.flush_bytes,
+        'results': results,
+    }
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
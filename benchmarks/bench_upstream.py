@@ -0,0 +1,153 @@
+"""
+Upstream client benchmark: completions against a stub OpenAI server that injects faults.
+
+Sends the same burst of streamed chat completions through three clients and compares how
+many succeed and how long they take:
+
+    none      OpenAI client without retries
+    sdk       OpenAI client with its default retries and timeouts
+    upstream  upstream.UpstreamClient (deadlines, budgeted jittered retries, breaker, concurrency limit)
+
+    python benchmarks/bench_upstream.py --error-rate 0.2 --stall-rate 0.05
+    python benchmarks/bench_upstream.py --error-rate 1 --requests 100   # breaker trips and sheds load
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_async_streams import ROOT, free_port, percentile, wait_for_port  # noqa: E402
+from upstream import UpstreamClient, UpstreamSettings  # noqa: E402
+
+MODEL = 'gpt-4o-mini'
+MESSAGES = [{'role': 'user', 'content': 'What is a derivative?'}]
+
+
+def start_faulty_stub(args):
+    port = free_port()
+    proc = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, 'benchmarks', 'stub_openai.py'),
+        '--port', str(port),
+        '--tokens', str(args.tokens),
+        '--token-delay', str(args.token_delay),
+        '--ttft', str(args.ttft),
+        '--error-rate', str(args.error_rate),
+        '--latency-jitter', str(args.latency_jitter),
+        '--stall-rate', str(args.stall_rate),
+        '--stall', str(args.stall),
+        '--seed', '0',
+    ])
+    wait_for_port(port)
+    return proc, port
+
+
+def make_client(name, base_url, args):
+    if name == 'none':
+        client = openai.OpenAI(api_key='stub', base_url=base_url, max_retries=0)
+        return client, client.chat.completions.create
+    if name == 'sdk':
+        client = openai.OpenAI(api_key='stub', base_url=base_url)
+        return client, client.chat.completions.create
+    client = UpstreamClient('stub', base_url=base_url, settings=UpstreamSettings(
+        read_timeout=args.read_timeout,
+        total_timeout=args.total_timeout,
+        retries=args.retries,
+        model_concurrency={MODEL: args.model_concurrency} if args.model_concurrency else None,
+    ))
+    return client, client.chat_completion
+
+
+def run_request(create):
+    start = time.perf_counter()
+    try:
+        for _ in create(model=MODEL, messages=MESSAGES, stream=True):
+            pass
+        return {'ok': True, 'seconds': time.perf_counter() - start}
+    except Exception as e:
+        return {'ok': False, 'seconds': time.perf_counter() - start, 'error': type(e).__name__}
+
+
+def bench_client(name, base_url, args):
+    client, create = make_client(name, base_url, args)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(lambda _: run_request(create), range(args.requests)))
+    wall = time.perf_counter() - start
+
+    errors = {}
+    for r in results:
+        if not r['ok']:
+            errors[r['error']] = errors.get(r['error'], 0) + 1
+    ok = [r['seconds'] for r in results if r['ok']]
+    failed = [r['seconds'] for r in results if not r['ok']]
+    report = {
+        'client': name,
+        'success_rate': round(len(ok) / len(results), 3),
+        'latency_p50': round(percentile(ok, 50) or 0, 3),
+        'latency_p95': round(percentile(ok, 95) or 0, 3),
+        'latency_p99': round(percentile(ok, 99) or 0, 3),
+        'failure_latency_p50': round(percentile(failed, 50) or 0, 3),
+        'failure_latency_max': round(max(failed, default=0), 3),
+        'wall_seconds': round(wall, 3),
+        'errors': errors,
+    }
+    if name == 'upstream':
+        report['upstream'] = client.stats()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', default='none,sdk,upstream', help='Comma separated clients: none, sdk, upstream')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--tokens', type=int, default=50)
+    parser.add_argument('--token-delay', type=float, default=0.005)
+    parser.add_argument('--ttft', type=float, default=0.1)
+    parser.add_argument('--error-rate', type=float, default=0.2, help='Share of upstream requests failing with 429/5xx')
+    parser.add_argument('--latency-jitter', type=float, default=0.2)
+    parser.add_argument('--stall-rate', type=float, default=0.02, help='Share of upstream requests stalling')
+    parser.add_argument('--stall', type=float, default=10.0, help='Seconds a stalled request waits')
+    parser.add_argument('--read-timeout', type=float, default=2.0, help='UpstreamClient read timeout')
+    parser.add_argument('--total-timeout', type=float, default=8.0, help='UpstreamClient deadline')
+    parser.add_argument('--retries', type=int, default=2, help='UpstreamClient retries')
+    parser.add_argument('--model-concurrency', type=int, default=0, help='UpstreamClient in-flight limit, 0 for none')
+    parser.add_argument('--output', help='Write the JSON report to this file as well')
+    args = parser.parse_args()
+
+    results = []
+    for name in args.clients.split(','):
+        # A fresh stub per client, so every client sees the same fault sequence
+        stub, port = start_faulty_stub(args)
+        try:
+            results.append(bench_client(name, f'http://127.0.0.1:{port}/v1', args))
+        finally:
+            stub.terminate()
+            stub.wait()
+
+    report = {
+        'benchmark': 'upstream',
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'error_rate': args.error_rate,
+        'stall_rate': args.stall_rate,
+        'results': results,
+    }
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
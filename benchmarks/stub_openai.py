@@ -0,0 +1,269 @@
+"""
+Minimal OpenAI-compatible chat completions server for local benchmarks.
+
+Serves POST /v1/chat/completions, streamed or not, from a single asyncio loop so it is
+never the bottleneck of a load test. Point the app at it with
+OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+
+Faults can be injected to exercise the upstream client: a share of requests answered with
+429/5xx errors, random extra latency, and stalls longer than the client's read timeout.
+
+Usage reports prompt tokens served from a simulated prompt cache: like the real one, prompts of
+at least 1024 tokens have the prefix they share with earlier prompts cached in 128 token blocks.
+
+    python benchmarks/stub_openai.py --port 8900 --tokens 200 --token-delay 0.02
+    python benchmarks/stub_openai.py --port 8900 --error-rate 0.2 --latency-jitter 0.5 --stall-rate 0.05
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+REVISION_QUESTIONS = [
+    {
+        'question': 'What does a derivative measure?',
+        'options': {
+            'a': 'The rate of change of a function',
+            'b': 'The area under a curve',
+            'c': 'The maximum of a function',
+            'd': 'The length of a curve',
+        },
+        'correct': 'a',
+    },
+    {
+        'question': 'Which rule differentiates a product of two functions?',
+        'options': {'a': 'Chain rule', 'b': 'Product rule', 'c': 'Quotient rule', 'd': 'Power rule'},
+        'correct': 'b',
+    },
+]
+
+# The same questions as free text, for requests without a structured output response_format
+REVISION_TEXT = "\n\n".join(
+    f"{i}. {q['question']}\n"
+    + "".join(f"{key}) {value}\n" for key, value in q['options'].items())
+    + f"Correct answer: {q['correct']}"
+    for i, q in enumerate(REVISION_QUESTIONS, 1)
+)
+REVISION_JSON = json.dumps({'questions': REVISION_QUESTIONS})
+
+ANSWER_WORDS = (
+    "A derivative tells you how fast a function changes at a point. "
+    "Geometrically it is the slope of the tangent line, and you compute it as a limit of difference quotients. "
+).split(" ")
+
+CACHE_MIN_TOKENS = 1024  # Shorter prompts are never cached
+CACHE_BLOCK_CHARS = 512  # Cache granularity, 128 tokens at 4 characters per token
+
+
+class StubOpenAI:
+    def __init__(self, tokens=100, token_delay=0.01, ttft=0.2, completion_latency=1.0, error_rate=0.0,
+                 error_statuses=(429, 500, 503), retry_after=None, latency_jitter=0.0, stall_rate=0.0,
+                 stall=30.0, seed=None):
+        self.tokens = tokens
+        self.token_delay = token_delay
+        self.ttft = ttft
+        self.completion_latency = completion_latency
+        self.error_rate = error_rate  # Share of requests answered with one of error_statuses
+        self.error_statuses = error_statuses
+        self.retry_after = retry_after  # Retry-After seconds sent with 429s
+        self.latency_jitter = latency_jitter  # Up to this many extra seconds before answering
+        self.stall_rate = stall_rate  # Share of requests that wait `stall` seconds before answering
+        self.stall = stall
+        self.rng = random.Random(seed)
+        self.served = {'requests': 0, 'errors': 0, 'stalls': 0}
+        self.prompt_blocks = set()  # Hashes of the prompt prefixes seen so far, see usage()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, body = request
+                if method != 'POST' or not path.endswith('/chat/completions'):
+                    await write_response(writer, 404, {'error': {'message': 'not found'}})
+                    continue
+                payload = json.loads(body or b'{}')
+                self.served['requests'] += 1
+                if await self.inject_fault(writer):
+                    continue
+                if payload.get('stream'):
+                    await self.stream_completion(writer, payload)
+                else:
+                    await self.completion(writer, payload)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def inject_fault(self, writer):
+        """Delay the request, or answer it with an error. Returns True if it was answered"""
+        delay = self.rng.uniform(0, self.latency_jitter)
+        if self.rng.random() < self.stall_rate:
+            self.served['stalls'] += 1
+            delay += self.stall
+        if delay:
+            await asyncio.sleep(delay)
+        if self.rng.random() >= self.error_rate:
+            return False
+        self.served['errors'] += 1
+        status = self.rng.choice(self.error_statuses)
+        headers = {'Retry-After': str(self.retry_after)} if status == 429 and self.retry_after is not None else {}
+        await write_response(writer, status, {'error': {'message': f'injected {status}', 'type': 'stub_error'}}, headers)
+        return True
+
+    async def completion(self, writer, payload):
+        await asyncio.sleep(self.completion_latency)
+        await write_response(writer, 200, {
+            'id': 'chatcmpl-stub',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': payload.get('model', 'stub'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': revision_content(payload) or REVISION_TEXT},
+                'finish_reason': 'stop'
+            }],
+            'usage': self.usage(payload, 80)
+        })
+
+    async def stream_completion(self, writer, payload):
+        writer.write(
+            b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: text/event-stream\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n'
+        )
+        await asyncio.sleep(self.ttft)
+        revision = revision_content(payload)
+        if revision:
+            # Revision questions stream in pieces of a few characters, like real tokens
+            pieces = [revision[i:i + 4] for i in range(0, len(revision), 4)]
+        else:
+            pieces = [ANSWER_WORDS[i % len(ANSWER_WORDS)] + ' ' for i in range(self.tokens)]
+        for piece in pieces:
+            chunk = {
+                'id': 'chatcmpl-stub',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': payload.get('model', 'stub'),
+                'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]
+            }
+            write_chunk(writer, f"data: {json.dumps(chunk)}\n\n".encode())
+            await writer.drain()
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+        if (payload.get('stream_options') or {}).get('include_usage'):
+            chunk = {
+                'id': 'chatcmpl-stub',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': payload.get('model', 'stub'),
+                'choices': [],
+                'usage': self.usage(payload, len(pieces))
+            }
+            write_chunk(writer, f"data: {json.dumps(chunk)}\n\n".encode())
+        write_chunk(writer, b"data: [DONE]\n\n")
+        write_chunk(writer, b"")
+        await writer.drain()
+
+
+    def usage(self, payload, completion_tokens):
+        """Usage of a request, with the prompt tokens the simulated prompt cache would have served"""
+        prompt = "".join(m.get('content') or '' for m in payload.get('messages', []))
+        tokens = len(prompt) // 4
+        cached_blocks = 0
+        if tokens >= CACHE_MIN_TOKENS:
+            blocks = [hash(prompt[:end]) for end in range(CACHE_BLOCK_CHARS, len(prompt) + 1, CACHE_BLOCK_CHARS)]
+            while cached_blocks < len(blocks) and blocks[cached_blocks] in self.prompt_blocks:
+                cached_blocks += 1
+            self.prompt_blocks.update(blocks)
+        return {
+            'prompt_tokens': tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': tokens + completion_tokens,
+            'prompt_tokens_details': {'cached_tokens': cached_blocks * CACHE_BLOCK_CHARS // 4}
+        }
+
+
+def revision_content(payload):
+    """The revision questions to answer a revision prompt with, None for chat requests"""
+    if payload.get('response_format'):
+        return REVISION_JSON
+    messages = payload.get('messages') or [{}]
+    if 'multiple-choice questions' in (messages[0].get('content') or ''):
+        return REVISION_TEXT
+    return None
+
+
+async def read_request(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    method, path, _ = line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, body
+
+
+async def write_response(writer, status, payload, headers=None):
+    body = json.dumps(payload).encode()
+    extra = "".join(f"{key}: {value}\r\n" for key, value in (headers or {}).items())
+    writer.write(
+        f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n{extra}"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+
+
+def write_chunk(writer, data):
+    writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+
+async def serve(stub, host, port):
+    server = await asyncio.start_server(stub.handle, host, port, backlog=4096)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--tokens', type=int, default=100, help='Tokens per streamed answer')
+    parser.add_argument('--token-delay', type=float, default=0.01, help='Seconds between streamed tokens')
+    parser.add_argument('--ttft', type=float, default=0.2, help='Seconds before the first streamed token')
+    parser.add_argument('--completion-latency', type=float, default=1.0, help='Seconds per non-streamed completion')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with an error')
+    parser.add_argument('--error-statuses', default='429,500,503', help='Comma separated statuses of injected errors')
+    parser.add_argument('--retry-after', type=float, help='Retry-After seconds sent with injected 429s')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, help='Up to this many extra seconds per request')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='Share of requests stalled for --stall seconds')
+    parser.add_argument('--stall', type=float, default=30.0)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    stub = StubOpenAI(
+        args.tokens, args.token_delay, args.ttft, args.completion_latency,
+        error_rate=args.error_rate,
+        error_statuses=tuple(int(status) for status in args.error_statuses.split(',')),
+        retry_after=args.retry_after,
+        latency_jitter=args.latency_jitter,
+        stall_rate=args.stall_rate,
+        stall=args.stall,
+        seed=args.seed
+    )
+    try:
+        asyncio.run(serve(stub, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
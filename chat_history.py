@@ -0,0 +1,106 @@
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_OVERHEAD = 4  # Tokens a chat message costs beyond its content (role and separators)
+
+
+class TokenCounter:
+    """
+    Counts tokens with the model's tiktoken encoding, or estimates them at about 4 characters
+    per token when tiktoken is not installed or its encoding can't be loaded (it is downloaded
+    on first use). The encoding is loaded on the first count.
+    """
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self._encoding = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            try:
+                import tiktoken
+                try:
+                    self._encoding = tiktoken.encoding_for_model(self.model_name)
+                except KeyError:
+                    self._encoding = tiktoken.get_encoding('o200k_base')
+            except ImportError:
+                pass
+            except Exception as e:
+                logger.warning("Error loading the tiktoken encoding, token counts will be estimated: %s", e)
+            self._loaded = True
+
+    def count(self, text):
+        if not self._loaded:
+            self._load()
+        if self._encoding is None:
+            return len(text) // 4 + 1
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def message_tokens(self, message):
+        """Tokens of a chat message, counted once and cached on the message"""
+        tokens = message.tokens
+        if tokens is None:
+            tokens = message.tokens = self.count(message.content) + MESSAGE_OVERHEAD
+        return tokens
+
+
+class HistoryWindow:
+    """
+    Keeps a session's chat history within a token budget.
+
+    The history is a deque of messages, each carrying its token count, with the running total
+    in state['history_tokens'], so appending and trimming never rescan the history. Trimming
+    drops the oldest messages, and a leading assistant message whose question was dropped,
+    until the history fits `max_tokens` (and at most `max_pairs` exchanges if set). The newest
+    message is always kept. Dropped messages are returned, e.g. to be summarized.
+    """
+
+    def __init__(self, counter, max_tokens=2000, max_pairs=0):
+        self.counter = counter
+        self.max_tokens = max_tokens
+        self.max_pairs = max_pairs
+
+    def history(self, state):
+        """The session's history deque, converting histories stored as lists"""
+        history = state['chat_history']
+        if not isinstance(history, deque):
+            history = state['chat_history'] = deque(history)
+            state['history_tokens'] = sum(self.counter.message_tokens(m) for m in history)
+        return history
+
+    def append(self, state, message):
+        self.history(state).append(message)
+        state['history_tokens'] = state.get('history_tokens', 0) + self.counter.message_tokens(message)
+
+    def drop_oldest(self, state):
+        message = self.history(state).popleft()
+        state['history_tokens'] -= self.counter.message_tokens(message)
+        return message
+
+    def drop_newest(self, state):
+        message = self.history(state).pop()
+        state['history_tokens'] -= self.counter.message_tokens(message)
+        return message
+
+    def trim(self, state):
+        """Drop the oldest messages until the history fits. Returns the dropped messages"""
+        history = self.history(state)
+        dropped = []
+        while len(history) > 1 and (
+            state['history_tokens'] > self.max_tokens
+            or (self.max_pairs and len(history) > self.max_pairs * 2)
+            or history[0].role != 'user'
+        ):
+            dropped.append(self.drop_oldest(state))
+        return dropped
+
+    def clear(self, state):
+        state['chat_history'] = deque()
+        state['history_tokens'] = 0
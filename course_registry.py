@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CourseRegistry:
+    """
+    The courses, loaded from a JSON file of [{"id", "title", "description", ...}] with an index
+    by id and the compiled prompts of every course, so a request looks up its course and
+    prompts in O(1) and never builds a prompt.
+
+    The file is loaded on first use, then checked for changes on lookup at most every
+    `reload_interval` seconds and reloaded when it changed: the new courses, index and prompts
+    replace the old ones in one step, and `on_load` callbacks (e.g. recomputing course
+    embeddings) are run with the new courses. A file that fails to load or validate on reload
+    is logged and the current courses are kept. Every worker process reloads on its own.
+
+    Course ids may not contain '-', which keeps the text form of session keys unambiguous
+    (see session_store.SessionKey).
+    """
+
+    def __init__(self, path, compile_prompts, reload_interval=5.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._compile_prompts = compile_prompts  # course -> dict of prompts
+        self._on_load = []
+        self._snapshot = None  # Format: (courses, {course_id: course}, {course_id: prompts})
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.RLock()
+
+    @property
+    def courses(self):
+        return self._current()[0]
+
+    def get(self, course_id):
+        """The course with this id, or None"""
+        return self._current()[1].get(course_id)
+
+    def prompts(self, course_id):
+        """The compiled prompts of a course, or None if there is no such course"""
+        return self._current()[2].get(course_id)
+
+    def on_load(self, fn):
+        """Call fn(courses) now and after every reload"""
+        self._on_load.append(fn)
+        fn(self.courses)
+        return fn
+
+    def _current(self):
+        if self._snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self.load()
+        elif self.reload_interval and time.monotonic() - self._checked_at >= self.reload_interval:
+            self._maybe_reload()
+        return self._snapshot
+
+    def load(self):
+        """Read, validate and compile the course file, replacing the current courses"""
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, encoding='utf-8') as f:
+            courses = validate_courses(json.load(f))
+        by_id = {course['id']: course for course in courses}
+        prompts = {course['id']: self._compile_prompts(course) for course in courses}
+        self._snapshot = (courses, by_id, prompts)
+        self._mtime = mtime
+        self._checked_at = time.monotonic()
+        for fn in self._on_load:
+            try:
+                fn(courses)
+            except Exception as e:
+                logger.error("Error updating %s after loading the courses: %s", getattr(fn, '__name__', fn), e)
+        logger.info("Loaded %d courses from %s", len(courses), self.path)
+
+    def _maybe_reload(self):
+        with self._lock:
+            if time.monotonic() - self._checked_at < self.reload_interval:
+                return
+            self._checked_at = time.monotonic()
+            try:
+                if os.stat(self.path).st_mtime != self._mtime:
+                    self.load()
+            except Exception as e:
+                logger.error("Error reloading the courses from %s, keeping the current ones: %s", self.path, e)
+
+
+def validate_courses(courses):
+    """Check a loaded course list. Returns it with the ids as strings"""
+    if not isinstance(courses, list):
+        raise ValueError("The course file must hold a list of courses")
+    seen = set()
+    for course in courses:
+        if not isinstance(course, dict) or not course.get('id') or not course.get('title'):
+            raise ValueError(f"Every course needs an id and a title: {course!r}")
+        course['id'] = str(course['id'])
+        course.setdefault('description', '')
+        if '-' in course['id']:
+            raise ValueError(f"Course ids may not contain '-': {course['id']}")
+        if course['id'] in seen:
+            raise ValueError(f"Duplicate course id: {course['id']}")
+        seen.add(course['id'])
+    return courses
@@ -0,0 +1,18 @@
+"""
+Gunicorn settings, picked up automatically by `gunicorn app:app` (and the asgi worker).
+
+With PRELOAD_MODELS=1 the app is imported once in the master, which loads the sentence model
+and course embeddings before the workers are forked. The workers then share the model weights
+copy-on-write instead of each loading its own copy, and new workers boot without loading anything.
+"""
+import gc
+import os
+
+preload_app = os.getenv("PRELOAD_MODELS", "0") == "1"
+
+
+def pre_fork(server, worker):
+    # Move everything loaded so far out of the collector's reach, so collections in the
+    # workers don't write to (and un-share) the pages holding the preloaded objects
+    if preload_app:
+        gc.freeze()
@@ -0,0 +1,193 @@
+"""
+Pre-generate revision question banks offline, so peak-hour revisions are served from the
+course question indexes (QUESTION_INDEX=1) instead of live completions.
+
+Questions are generated from seed topics per course, taken from the course descriptions or a
+JSON file of {course_id: [topic, ...]}, and/or from exported conversations, a JSON lines file of
+{"course_id": ..., "messages": [{"role": ..., "content": ...}, ...]}. Completions run on a
+bounded thread pool through the app's upstream client. Questions are deduplicated by stem and
+then by embedding, and appended to the memory-mapped index of their course under
+QUESTION_INDEX_DIR, which the app opens without loading anything.
+
+Embedding needs sentence-transformers. Without it, write the bank to a file with --bank and
+index it later, on a machine that has it, with --from-bank.
+
+    python pregenerate_questions.py --topics --per-topic 5 --concurrency 8
+    python pregenerate_questions.py --topics-file topics.json --courses 1,3
+    python pregenerate_questions.py --conversations export.jsonl --bank bank.jsonl --no-index
+    python pregenerate_questions.py --from-bank bank.jsonl
+"""
+import argparse
+import json
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import app as tutor
+from revision_parser import validate_question
+from session_records import ChatMessage
+
+
+def seed_topics(course):
+    """Topics listed in a course description, e.g. 'Algebra, Probability, and Topology etc.'"""
+    description = re.sub(r'\betc\.?$', '', course['description'].strip())
+    topics = [t.strip(' .') for t in re.split(r',|\band\b', description)]
+    return [t for t in topics if t] or [course['title']]
+
+
+def build_jobs(args, courses):
+    """(course, label, messages) of every completion to run"""
+    jobs = []
+    if args.topics or args.topics_file:
+        topics = {}
+        if args.topics_file:
+            with open(args.topics_file) as f:
+                topics = json.load(f)
+        for course in courses.values():
+            for topic in topics.get(course['id'], seed_topics(course) if args.topics else []):
+                messages = tutor.build_topic_revision_messages(course, topic, args.per_topic)
+                jobs.append((course, f"topic: {topic}", messages))
+    if args.conversations:
+        with open(args.conversations) as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                course = courses.get(str(record.get('course_id')))
+                messages = [ChatMessage.from_dict(m) for m in record.get('messages', []) if m.get('role') in ('user', 'assistant')]
+                if course and messages:
+                    messages = tutor.build_full_revision_messages(course, messages, [])
+                    jobs.append((course, f"conversation: line {line_number}", messages))
+    return jobs
+
+
+def generate(job):
+    """Run one completion. Returns (questions, completion tokens)"""
+    course, label, messages = job
+    response = tutor.get_upstream_client().chat_completion(
+        model=tutor.model_name,
+        messages=messages,
+        **tutor.revision_completion_options()
+    )
+    tutor.record_prompt_usage('revision', response.usage)
+    tokens = tutor.completion_tokens(response)
+    questions = tutor.parse_revision_completion(response.choices[0].message.content, tokens)
+    return questions or [], tokens
+
+
+def generate_banks(jobs, concurrency):
+    """
+    Run the jobs with at most `concurrency` completions in flight.
+
+    Returns:
+        tuple: ({course_id: [questions]} deduplicated by stem, report counters)
+    """
+    banks = {}
+    seen = set()
+    report = {'jobs': len(jobs), 'failed_jobs': 0, 'questions': 0, 'duplicate_stems': 0, 'completion_tokens': 0}
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='pregenerate') as pool:
+        futures = {pool.submit(generate, job): job for job in jobs}
+        for future in as_completed(futures):
+            course, label, _ = futures[future]
+            try:
+                questions, tokens = future.result()
+            except Exception as e:
+                report['failed_jobs'] += 1
+                print(f"Error generating questions for {course['title']} ({label}): {str(e)}", file=sys.stderr)
+                continue
+            report['completion_tokens'] += tokens
+            for question in questions:
+                stem = ' '.join(question['question'].lower().split())
+                if (course['id'], stem) in seen:
+                    report['duplicate_stems'] += 1
+                    continue
+                seen.add((course['id'], stem))
+                banks.setdefault(course['id'], []).append(question)
+                report['questions'] += 1
+            print(f"{course['title']} ({label}): {len(questions)} questions", file=sys.stderr)
+    return banks, report
+
+
+def write_bank(path, banks):
+    with open(path, 'w') as f:
+        for course_id, questions in banks.items():
+            for question in questions:
+                f.write(json.dumps({'course_id': course_id, **question}, separators=(',', ':')) + '\n')
+
+
+def read_bank(path):
+    banks = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                question = validate_question(record)
+                if question:
+                    banks.setdefault(str(record['course_id']), []).append(question)
+    return banks
+
+
+def index_banks(banks):
+    """Append each course's questions to its index, skipping near-duplicates. Returns questions added"""
+    question_indexes = tutor.get_question_indexes()
+    if question_indexes is None:
+        raise SystemExit("The sentence model failed to load, the questions can't be indexed")
+    added = {}
+    for course_id, questions in banks.items():
+        index = question_indexes.get(course_id)
+        before = len(index)
+        index.add(tutor.embed_texts([q['question'] for q in questions]), questions)
+        added[course_id] = len(index) - before
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--topics', action='store_true', help='Generate from the topics in the course descriptions')
+    parser.add_argument('--topics-file', help='JSON file of {course_id: [topic, ...]}')
+    parser.add_argument('--conversations', help='JSON lines file of exported conversations')
+    parser.add_argument('--from-bank', help='Index a bank written with --bank instead of generating')
+    parser.add_argument('--courses', help='Comma separated course ids, all courses by default')
+    parser.add_argument('--per-topic', type=int, default=5, help='Questions asked for per topic')
+    parser.add_argument('--concurrency', type=int, default=8, help='Completions in flight at once')
+    parser.add_argument('--bank', help='Also write the generated questions to this JSON lines file')
+    parser.add_argument('--no-index', action='store_true', help="Don't add the questions to the course indexes")
+    args = parser.parse_args()
+
+    # Bank questions are indexed on purpose, whatever the app's QUESTION_INDEX setting
+    tutor.QUESTION_INDEX = True
+
+    courses = {c['id']: c for c in tutor.course_registry.courses}
+    if args.courses:
+        course_ids = args.courses.split(',')
+        unknown = [course_id for course_id in course_ids if course_id not in courses]
+        if unknown:
+            parser.error(f"unknown course ids: {', '.join(unknown)}, the courses are {', '.join(courses)}")
+        courses = {course_id: courses[course_id] for course_id in course_ids}
+
+    if not args.no_index and not tutor.similarity_enabled:
+        parser.error('indexing needs sentence-transformers, pass --no-index with --bank to only write a bank file')
+
+    start = time.perf_counter()
+    if args.from_bank:
+        banks = read_bank(args.from_bank)
+        report = {'questions': sum(len(q) for q in banks.values())}
+    else:
+        jobs = build_jobs(args, courses)
+        if not jobs:
+            parser.error('nothing to generate from, pass --topics, --topics-file or --conversations')
+        banks, report = generate_banks(jobs, args.concurrency)
+        report['prompt_cache'] = tutor.prompt_cache_stats['revision']
+        if args.bank:
+            write_bank(args.bank, banks)
+    banks = {course_id: questions for course_id, questions in banks.items() if course_id in courses}
+
+    if not args.no_index and banks:
+        report['indexed'] = index_banks(banks)
+    report['seconds'] = round(time.perf_counter() - start, 2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
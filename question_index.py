@@ -0,0 +1,180 @@
+import json
+import mmap
+import os
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows, appends are then only safe from a single process
+    fcntl = None
+
+REMAP_EVERY = 4096  # Rows appended in memory before the on-disk files are re-mapped
+DUPLICATE_SIMILARITY = 0.97  # Questions this close to an indexed one are not added again
+SCAN_ROWS = 65536  # Indexed rows compared with a batch of new ones at a time, bounds the score matrix
+
+
+class QuestionIndex:
+    """
+    Vector index of revision questions for one course.
+
+    Embeddings are L2-normalized float32 rows, so cosine similarity is a single matrix-vector
+    product. Everything lives in three append-only files under `directory`, which are
+    memory-mapped on open so even a large index opens instantly:
+
+        embeddings.f32   raw float32 rows
+        questions.jsonl  one JSON question per line
+        offsets.i64      byte offset of each line in questions.jsonl
+
+    Appends take an exclusive file lock, so several workers can share a directory. Rows
+    written by other workers become visible the next time the files are re-mapped.
+    """
+
+    def __init__(self, directory, dim):
+        self.directory = directory
+        self.dim = dim
+        self._matrix_path = os.path.join(directory, 'embeddings.f32')
+        self._questions_path = os.path.join(directory, 'questions.jsonl')
+        self._offsets_path = os.path.join(directory, 'offsets.i64')
+        self._lock = threading.Lock()
+        self._base = np.empty((0, dim), dtype=np.float32)  # Mapped rows already on disk
+        self._offsets = np.empty(0, dtype=np.int64)
+        self._questions_map = None
+        self._pending = None  # Rows added since the last map
+        self._pending_questions = []
+        self._map()
+
+    def __len__(self):
+        return len(self._base) + len(self._pending_questions)
+
+    def _map(self):
+        # A fresh buffer, searches may still hold a view of the old one
+        self._pending = np.empty((REMAP_EVERY, self.dim), dtype=np.float32)
+        self._pending_questions = []
+        if not os.path.exists(self._offsets_path):
+            return
+        rows = min(os.path.getsize(self._matrix_path) // (4 * self.dim), os.path.getsize(self._offsets_path) // 8)
+        if not rows:
+            return
+        self._base = np.memmap(self._matrix_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+        self._offsets = np.memmap(self._offsets_path, dtype=np.int64, mode='r', shape=(rows,))
+        with open(self._questions_path, 'rb') as f:
+            self._questions_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _question(self, i, base_rows, questions_map, offsets, pending_questions):
+        if i >= base_rows:
+            return pending_questions[i - base_rows]
+        start = int(offsets[i])
+        return json.loads(questions_map[start:questions_map.find(b'\n', start)])
+
+    def _best_scores(self, embeddings):
+        """Highest similarity of each row to the indexed questions, -1 for an empty index"""
+        with self._lock:
+            base = self._base
+            pending = self._pending[:len(self._pending_questions)]
+        best = np.full(len(embeddings), -1, dtype=np.float32)
+        for start in range(0, len(base), SCAN_ROWS):
+            np.maximum(best, (base[start:start + SCAN_ROWS] @ embeddings.T).max(axis=0), out=best)
+        if len(pending):
+            np.maximum(best, (pending @ embeddings.T).max(axis=0), out=best)
+        return best
+
+    def _novel_rows(self, embeddings):
+        """Indices of the rows that are not near-duplicates of the index or of earlier rows"""
+        novel = self._best_scores(embeddings) < DUPLICATE_SIMILARITY
+        duplicates = (embeddings @ embeddings.T) >= DUPLICATE_SIMILARITY
+        keep = []
+        for i in np.flatnonzero(novel):
+            if not duplicates[i, keep].any():
+                keep.append(int(i))
+        return keep
+
+    def add(self, embeddings, questions, skip_duplicates=True):
+        """
+        Append questions with their (normalized) embeddings.
+
+        Near-duplicates are skipped unless skip_duplicates is False, e.g. for bulk loads
+        that are already deduplicated.
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+        if skip_duplicates:
+            keep = self._novel_rows(embeddings)
+            embeddings = embeddings[keep]
+            questions = [questions[i] for i in keep]
+        if not len(embeddings):
+            return
+        lines = [(json.dumps(q) + '\n').encode() for q in questions]
+
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            with open(self._matrix_path, 'ab') as matrix_file, \
+                    open(self._questions_path, 'ab') as questions_file, \
+                    open(self._offsets_path, 'ab') as offsets_file:
+                if fcntl:
+                    fcntl.flock(offsets_file, fcntl.LOCK_EX)
+                try:
+                    position = questions_file.seek(0, os.SEEK_END)
+                    offsets = np.cumsum([position] + [len(line) for line in lines[:-1]], dtype=np.int64)
+                    matrix_file.write(embeddings.tobytes())
+                    questions_file.write(b''.join(lines))
+                    # Offsets go last, a row only counts once its offset is written
+                    matrix_file.flush()
+                    questions_file.flush()
+                    offsets_file.write(offsets.tobytes())
+                finally:
+                    if fcntl:
+                        fcntl.flock(offsets_file, fcntl.LOCK_UN)
+
+            pending_size = len(self._pending_questions)
+            if pending_size + len(embeddings) > len(self._pending):
+                # Pick up everything on disk, including rows appended by other workers
+                self._map()
+            else:
+                self._pending[pending_size:pending_size + len(embeddings)] = embeddings
+                self._pending_questions = self._pending_questions + questions
+
+    def search(self, query, k=5):
+        """
+        Top-k stored questions by cosine similarity to a normalized query embedding.
+
+        Returns:
+            list: (score, question) pairs, best first
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(self.dim)
+        with self._lock:
+            base, offsets, questions_map = self._base, self._offsets, self._questions_map
+            pending_questions = self._pending_questions
+            pending = self._pending[:len(pending_questions)]
+        if not len(base) and not len(pending):
+            return []
+
+        scores = base @ query
+        if len(pending):
+            scores = np.concatenate([scores, pending @ query])
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (float(scores[i]), self._question(i, len(base), questions_map, offsets, pending_questions))
+            for i in top
+        ]
+
+
+class QuestionIndexStore:
+    """Lazily opened QuestionIndex per course, under one root directory"""
+
+    def __init__(self, root, dim):
+        self.root = root
+        self.dim = dim
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def get(self, course_id):
+        with self._lock:
+            index = self._indexes.get(course_id)
+            if index is None:
+                index = QuestionIndex(os.path.join(self.root, str(course_id)), self.dim)
+                self._indexes[course_id] = index
+            return index
@@ -0,0 +1,96 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+def course_text(course):
+    """Text a course is embedded from for relevance checks"""
+    course_content = course.get('expanded_description', course.get('description', ''))
+    return f"{course.get('title', '')}. {course_content}"
+
+
+class RelevanceEngine:
+    """
+    Scores messages against courses with sentence embeddings.
+
+    Course embeddings are computed once, up front. Message encodes from concurrent requests
+    are micro-batched on a background thread: a batch closes when it reaches `max_batch`
+    messages or `max_wait` seconds after its first message, is encoded in one call, and scored
+    against every course with a single matrix product.
+
+    The batcher thread starts on the first check in each process, so an engine created before
+    a fork (e.g. gunicorn's preload_app) works in the forked workers.
+    """
+
+    def __init__(self, encode_fn, max_batch=32, max_wait=0.01):
+        self._encode = encode_fn  # texts -> L2-normalized float32 matrix
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._course_rows = {}  # Format: {course_id: row in _course_matrix}
+        self._course_matrix = None
+        self._course_embeddings = {}  # Format: {course text: embedding}
+        self._queue = None
+        self._pid = None  # Process the batcher thread runs in
+        self._start_lock = threading.Lock()
+
+    def set_courses(self, courses):
+        """
+        Precompute the embeddings of every course, replacing any previous set. Courses whose
+        text didn't change keep their embedding, so reloading hundreds of courses only encodes
+        the edited ones.
+        """
+        texts = [course_text(c) for c in courses]
+        known = self._course_embeddings
+        new_texts = [text for text in dict.fromkeys(texts) if text not in known]
+        if new_texts:
+            known = dict(known)
+            known.update(zip(new_texts, np.asarray(self._encode(new_texts), dtype=np.float32)))
+        matrix = np.ascontiguousarray(np.stack([known[text] for text in texts]), dtype=np.float32)
+        rows = {c['id']: i for i, c in enumerate(courses)}
+        self._course_embeddings = {text: known[text] for text in texts}
+        self._course_matrix, self._course_rows = matrix, rows
+
+    def similarity(self, message, course_id, timeout=5):
+        """Cosine similarity between a message and a precomputed course, blocking until its batch is scored"""
+        future = Future()
+        self._batch_queue().put((message, future))
+        scores, rows = future.result(timeout=timeout)
+        return float(scores[rows[course_id]])
+
+    def _batch_queue(self):
+        # Threads don't survive a fork, start a batcher in every process that checks relevance
+        if self._pid != os.getpid():
+            with self._start_lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    threading.Thread(target=self._run, args=(self._queue,), name='relevance-batcher', daemon=True).start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def _run(self, requests):
+        while True:
+            batch = [requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                matrix, rows = self._course_matrix, self._course_rows
+                message_matrix = self._encode([message for message, _ in batch])
+                scores = message_matrix @ matrix.T  # One row of course similarities per message
+                for i, (_, future) in enumerate(batch):
+                    future.set_result((scores[i], rows))
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
@@ -0,0 +1,215 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class RevisionCancelled(Exception):
+    """Raised inside a revision generation whose result is no longer wanted"""
+
+
+class RevisionFlight:
+    """One revision generation in progress, shared by every request for the same conversation version"""
+
+    def __init__(self, session_key, version):
+        self.session_key = session_key
+        self.version = version
+        self.cancelled = False
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def check(self):
+        """Raise RevisionCancelled if the generation was cancelled, called between its steps"""
+        if self.cancelled:
+            raise RevisionCancelled(f"Revision generation for {self.session_key} was cancelled")
+
+    def wait(self, timeout=None):
+        """Wait for the leader to finish and return its result, or raise its error"""
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"Revision generation for {self.session_key} did not finish in time")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class RevisionFlights:
+    """
+    Per-session single flight for revision generation.
+
+    The first request for a (session, conversation version) leads and runs the generation,
+    requests arriving while it runs join it and receive its result instead of starting another
+    completion whose set would overwrite the first. Flights of older conversation versions can
+    be cancelled, e.g. when the student sends a new message or clears the chat; the leader
+    notices at its next `check()` and nothing is stored.
+
+    Only coalesces within one process. Across workers the session state itself guards the
+    writes, see app.apply_revision_questions().
+    """
+
+    def __init__(self):
+        self._flights = {}  # Format: {session_key: {version: RevisionFlight}}
+        self._lock = threading.Lock()
+        self._stats = {'leaders': 0, 'joined': 0, 'cancelled': 0}
+
+    def begin(self, session_key, version):
+        """
+        Lead or join the flight for a session's conversation version.
+
+        Returns:
+            tuple: (flight, leader) where a leader must call finish() once done
+        """
+        with self._lock:
+            flights = self._flights.setdefault(session_key, {})
+            flight = flights.get(version)
+            if flight is not None and not flight.cancelled:
+                self._stats['joined'] += 1
+                return flight, False
+            flight = flights[version] = RevisionFlight(session_key, version)
+            self._stats['leaders'] += 1
+            return flight, True
+
+    def finish(self, flight, result=None, error=None):
+        """Publish the leader's result or error to the requests that joined"""
+        if error is not None and not isinstance(error, Exception):
+            # The leader was interrupted, e.g. its client went away, for the others it was cancelled
+            error = RevisionCancelled(f"Revision generation for {flight.session_key} was interrupted")
+        flight.result = result
+        flight.error = error
+        with self._lock:
+            flights = self._flights.get(flight.session_key)
+            if flights and flights.get(flight.version) is flight:
+                del flights[flight.version]
+                if not flights:
+                    del self._flights[flight.session_key]
+        flight._done.set()
+
+    def run(self, session_key, version, fn):
+        """Run fn(flight) as the leader, or wait for the flight already running. Returns its result"""
+        flight, leader = self.begin(session_key, version)
+        if not leader:
+            return flight.wait()
+        try:
+            result = fn(flight)
+        except BaseException as e:
+            self.finish(flight, error=e)
+            raise
+        self.finish(flight, result)
+        return result
+
+    def cancel(self, session_key, before_version=None):
+        """Cancel a session's flights, or only those of conversation versions before before_version"""
+        with self._lock:
+            flights = self._flights.get(session_key, {})
+            for version, flight in flights.items():
+                if before_version is None or version < before_version:
+                    if not flight.cancelled:
+                        flight.cancelled = True
+                        self._stats['cancelled'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, in_flight=sum(len(f) for f in self._flights.values()))
+
+
+class RevisionJob:
+    """A single background revision generation request for one session."""
+
+    def __init__(self, session_key):
+        self.id = uuid.uuid4().hex
+        self.session_key = session_key
+        self.status = 'pending'  # pending -> running -> done | failed | cancelled
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'error': self.error,
+        }
+
+
+class RevisionJobQueue:
+    """
+    Runs revision question generation on a small worker pool so the chat
+    stream can end without waiting for the completion.
+
+    Keeps a per-session job table holding the pending or running job for each
+    session key. Submitting while a job for the same session is still pending or
+    running returns that job instead of queueing another one. `on_update` is
+    called with the job whenever its status changes, e.g. to persist it for other
+    workers, until the job is discarded. A job leaves the table once its final
+    status was passed to `on_update`, so look finished jobs up where that stored them.
+    """
+
+    def __init__(self, generate_fn, max_workers=2, on_update=None):
+        self._generate_fn = generate_fn
+        self._on_update = on_update
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='revision')
+        self._jobs = {}  # Format: {session_key: RevisionJob}
+        self._lock = threading.Lock()
+
+    def submit(self, session_key):
+        with self._lock:
+            job = self._jobs.get(session_key)
+            if job and not job.finished:
+                return job
+            job = RevisionJob(session_key)
+            self._jobs[session_key] = job
+        self._notify(job)
+        self._executor.submit(self._run, job)
+        return job
+
+    def get(self, session_key, job_id=None):
+        """Return the pending or running job for a session, or None if job_id does not match it."""
+        with self._lock:
+            job = self._jobs.get(session_key)
+        if job is None or (job_id and job.id != job_id):
+            return None
+        return job
+
+    def discard(self, session_key):
+        with self._lock:
+            self._jobs.pop(session_key, None)
+
+    def _notify(self, job):
+        with self._lock:
+            if self._jobs.get(job.session_key) is not job:
+                # Discarded, e.g. the chat was cleared, its session must not be written to anymore
+                return
+        if self._on_update:
+            try:
+                self._on_update(job)
+            except Exception as e:
+                logger.error("Error recording revision job %s: %s", job.id, e)
+
+    def _run(self, job):
+        job.status = 'running'
+        self._notify(job)
+        try:
+            self._generate_fn(job.session_key)
+            job.status = 'done'
+        except RevisionCancelled as e:
+            logger.info("Revision job %s cancelled for %s", job.id, job.session_key)
+            job.error = str(e)
+            job.status = 'cancelled'
+        except Exception as e:
+            logger.error("Revision job %s failed for %s: %s", job.id, job.session_key, e)
+            job.error = str(e) or "An error occurred while generating revision questions"
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+            self._notify(job)
+            # Its final status is recorded, keep no entry per session that ever had a job
+            with self._lock:
+                if self._jobs.get(job.session_key) is job:
+                    del self._jobs[job.session_key]
@@ -0,0 +1,287 @@
+import json
+import re
+
+OPTION_KEYS = ('a', 'b', 'c', 'd')
+
+# JSON schema of a revision completion, passed as the structured output response_format
+REVISION_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'questions': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'question': {'type': 'string'},
+                    'options': {
+                        'type': 'object',
+                        'properties': {key: {'type': 'string'} for key in OPTION_KEYS},
+                        'required': list(OPTION_KEYS),
+                        'additionalProperties': False
+                    },
+                    'correct': {'type': 'string', 'enum': list(OPTION_KEYS)}
+                },
+                'required': ['question', 'options', 'correct'],
+                'additionalProperties': False
+            }
+        }
+    },
+    'required': ['questions'],
+    'additionalProperties': False
+}
+
+RESPONSE_FORMAT = {
+    'type': 'json_schema',
+    'json_schema': {'name': 'revision_questions', 'strict': True, 'schema': REVISION_SCHEMA}
+}
+
+_QUESTION_START = re.compile(r'\{\s*"question"\s*:')
+_NUMBERED_LINE = re.compile(r'^(?:Q(?:uestion)?\s*)?(\d+)\s*[.):]\s+(.+)$', re.IGNORECASE)
+_OPTION_LINE = re.compile(r'^\(?([a-d])\s*[).:]\s*(.+)$', re.IGNORECASE)
+# Anchored, so an option mentioning "incorrect - a ..." isn't taken for the answer line
+_CORRECT_LINE = re.compile(r'^\W*correct(?:\s+answer)?\s*[:\-]\s*\(?([a-d])\b', re.IGNORECASE)
+_decoder = json.JSONDecoder()
+
+
+def validate_question(item):
+    """
+    Check one parsed question against the schema and normalize it.
+
+    Options may also come as a list of four, and the correct answer as "A", "a)" or "a) text".
+
+    Returns:
+        dict: {'question', 'options', 'correct'}, or None if the item is not a usable question
+    """
+    if not isinstance(item, dict):
+        return None
+    question = item.get('question')
+    if not isinstance(question, str) or not question.strip():
+        return None
+
+    options = item.get('options')
+    if isinstance(options, list) and len(options) == len(OPTION_KEYS):
+        options = dict(zip(OPTION_KEYS, options))
+    if not isinstance(options, dict):
+        return None
+    options = {str(key).strip().lower().rstrip(')'): value for key, value in options.items()}
+    if set(options) != set(OPTION_KEYS):
+        return None
+    if not all(isinstance(value, str) and value.strip() for value in options.values()):
+        return None
+
+    correct = item.get('correct')
+    if not isinstance(correct, str) or not correct.strip():
+        return None
+    correct = correct.strip().lower()[0]
+    if correct not in options:
+        return None
+
+    return {
+        'question': question.strip(),
+        'options': {key: options[key].strip() for key in OPTION_KEYS},
+        'correct': correct
+    }
+
+
+def parse_json_questions(text):
+    """
+    Parse a structured output completion.
+
+    Returns:
+        tuple: (valid questions, number of items that failed validation), or (None, 0) if the
+               text is not a JSON document
+    """
+    try:
+        document = json.loads(text)
+    except ValueError:
+        return None, 0
+    items = document.get('questions') if isinstance(document, dict) else document
+    if not isinstance(items, list):
+        return None, 0
+    questions = [q for q in map(validate_question, items) if q]
+    return questions, len(items) - len(questions)
+
+
+def recover_json_questions(text):
+    """
+    Pull every well-formed question object out of JSON that doesn't parse as a whole,
+    e.g. a completion cut off by max_tokens.
+
+    Returns:
+        tuple: (valid questions, number of question objects that failed to parse or validate)
+    """
+    questions, dropped = [], 0
+    position = 0
+    while True:
+        match = _QUESTION_START.search(text, position)
+        if not match:
+            break
+        try:
+            item, position = _decoder.raw_decode(text, match.start())
+        except ValueError:
+            dropped += 1
+            position = match.end()
+            continue
+        question = validate_question(item)
+        if question:
+            questions.append(question)
+        else:
+            dropped += 1
+    return questions, dropped
+
+
+def parse_text_questions(text):
+    """
+    Parse numbered multiple-choice questions out of a free text completion.
+
+    Returns:
+        tuple: (valid questions, number of started questions that were incomplete)
+    """
+    parser = QuestionStreamParser('text')
+    questions = parser.feed(text) + parser.close()
+    return questions, parser.dropped
+
+
+class QuestionStreamParser:
+    """
+    Parses revision questions out of a completion while it streams in.
+
+    feed() returns the questions completed by a delta, so each can be sent on as soon as the
+    model has finished writing it: for JSON once its object closes, for free text once its
+    correct answer line ends. The format is detected from the first character unless given.
+    """
+
+    def __init__(self, mode=None):
+        self.mode = mode  # 'json' or 'text'
+        self.dropped = 0  # Questions started but unusable
+        self._parts = []  # Text not consumed yet
+        self._position = 0  # JSON mode: where to look for the next question object
+        self._current = None  # Text mode: question being read, and whether it was sent
+        self._sent = False
+
+    def feed(self, content):
+        """Add a delta. Returns the questions it completed"""
+        if not content:
+            return []
+        self._parts.append(content)
+        if self.mode is None:
+            head = ''.join(self._parts).lstrip()
+            if not head:
+                return []
+            self.mode = 'json' if head[0] in '{[`' else 'text'
+            self._parts = [head]
+
+        if self.mode == 'json':
+            return self._json_questions() if '}' in content else []
+        return self._text_questions(final=False) if '\n' in content else []
+
+    def close(self):
+        """Questions completed by the end of the completion. Unfinished ones count as dropped"""
+        if self.mode == 'json':
+            questions = self._json_questions()
+            text = ''.join(self._parts)
+            self.dropped += len(_QUESTION_START.findall(text, self._position))
+            return questions
+        questions = self._text_questions(final=True)
+        self._finish_text_question(questions)
+        return questions
+
+    def _json_questions(self):
+        text = ''.join(self._parts)
+        self._parts = [text]
+        questions = []
+        while True:
+            match = _QUESTION_START.search(text, self._position)
+            if not match:
+                break
+            try:
+                item, end = _decoder.raw_decode(text, match.start())
+            except ValueError:
+                break  # Not complete yet, or malformed, close() tells the two apart
+            self._position = end
+            question = validate_question(item)
+            if question:
+                questions.append(question)
+            else:
+                self.dropped += 1
+        return questions
+
+    def _text_questions(self, final):
+        text = ''.join(self._parts)
+        lines = text.split('\n')
+        rest = '' if final else lines.pop()
+        self._parts = [rest] if rest else []
+        questions = []
+        for line in lines:
+            self._text_line(line, questions)
+        return questions
+
+    def _text_line(self, line, questions):
+        line = line.strip().replace('**', '').strip('#').strip()
+        if not line:
+            return
+
+        # Check if this is the start of a new question, numbered 1 to 99 and beyond
+        match = _NUMBERED_LINE.match(line)
+        if match:
+            self._finish_text_question(questions)
+            self._current = {'question': match.group(2).strip(), 'options': {}}
+            self._sent = False
+            return
+        if self._current is None:
+            return
+
+        # Check if this is the correct answer, before options since "Correct: a) ..." looks like one
+        match = _CORRECT_LINE.match(line)
+        if match:
+            self._current['correct'] = match.group(1).lower()
+            question = validate_question(self._current)
+            if question and not self._sent:
+                questions.append(question)
+                self._sent = True
+            return
+
+        # Check if this is an option (a, b, c, d)
+        match = _OPTION_LINE.match(line)
+        if match:
+            self._current['options'][match.group(1).lower()] = match.group(2).strip()
+
+    def _finish_text_question(self, questions):
+        if self._current is None or self._sent:
+            return
+        question = validate_question(self._current)
+        if question:
+            questions.append(question)
+        else:
+            self.dropped += 1
+        self._current = None
+
+
+def parse_revision_response(text):
+    """
+    Parse a revision completion of either format.
+
+    Structured output is tried first. JSON that doesn't parse as a whole has its complete
+    question objects recovered, and anything else goes to the free text parser.
+
+    Returns:
+        tuple: (questions, outcome, dropped) where outcome is 'json', 'recovered', 'text' or
+               'failed', and dropped counts questions that were started but unusable
+    """
+    text = (text or '').strip()
+    if text.startswith('```'):
+        # Strip a markdown code fence around the JSON
+        text = text.strip('`')
+        text = text[text.find('\n') + 1:] if text[:4].lower() == 'json' else text
+
+    questions, dropped = parse_json_questions(text)
+    if questions is not None:
+        return questions, 'json' if questions or not dropped else 'failed', dropped
+
+    if _QUESTION_START.search(text):
+        questions, dropped = recover_json_questions(text)
+        if questions:
+            return questions, 'recovered', dropped
+
+    questions, dropped = parse_text_questions(text)
+    return questions, 'text' if questions else 'failed', dropped
@@ -0,0 +1,109 @@
+import sys
+import time
+from datetime import datetime
+
+from revision_parser import OPTION_KEYS
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class ChatMessage:
+    """
+    One message of a session's chat history.
+
+    Slotted, with the creation time kept as integer epoch seconds and only formatted when
+    rendered, so a long history of many sessions costs little beyond the message text.
+    """
+
+    __slots__ = ('role', 'content', 'seq', 'created', 'tokens')
+
+    def __init__(self, role, content, seq=0, created=None, tokens=None):
+        self.role = sys.intern(role)
+        self.content = content
+        self.seq = seq  # Conversation version the message was recorded at
+        self.created = int(time.time()) if created is None else created
+        self.tokens = tokens  # Counted by chat_history.TokenCounter on first use
+
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self.created).strftime(TIMESTAMP_FORMAT)
+
+    def to_dict(self):
+        """The message as sent to the completions API"""
+        return {'role': self.role, 'content': self.content}
+
+    @classmethod
+    def from_dict(cls, message):
+        """Convert a message stored as a dict, e.g. in an exported conversation or an older session"""
+        created = message.get('created')
+        if created is None and message.get('timestamp'):
+            try:
+                created = int(datetime.strptime(message['timestamp'], TIMESTAMP_FORMAT).timestamp())
+            except ValueError:
+                pass
+        return cls(message.get('role', ''), message.get('content', ''), message.get('seq', 0), created, message.get('tokens'))
+
+    def __reduce__(self):
+        # Pickled as constructor arguments, smaller and faster than the generic path for slotted classes
+        return ChatMessage, (self.role, self.content, self.seq, self.created, self.tokens)
+
+    def __repr__(self):
+        return f"ChatMessage({self.role!r}, {self.content[:40]!r}, seq={self.seq})"
+
+
+class RevisionQuestion:
+    """
+    One multiple-choice revision question, with its options as a tuple in OPTION_KEYS order
+    instead of a dict. Converted to the {'question', 'options', 'correct'} dict of the API and
+    the question indexes with to_dict().
+    """
+
+    __slots__ = ('question', 'options', 'correct')
+
+    def __init__(self, question, options, correct):
+        self.question = question
+        self.options = tuple(options)
+        self.correct = sys.intern(correct)
+
+    @property
+    def stem(self):
+        """Normalized question text, to spot repeated questions"""
+        return self.question.strip().lower()
+
+    def option_items(self):
+        """(key, option) pairs, like the items of the API dict"""
+        return zip(OPTION_KEYS, self.options)
+
+    def to_dict(self):
+        return {'question': self.question, 'options': dict(self.option_items()), 'correct': self.correct}
+
+    @classmethod
+    def from_dict(cls, question):
+        """Convert a validated question dict, see revision_parser.validate_question()"""
+        options = question['options']
+        return cls(question['question'], [options[key] for key in OPTION_KEYS], question['correct'])
+
+    def __reduce__(self):
+        return RevisionQuestion, (self.question, self.options, self.correct)
+
+    def __repr__(self):
+        return f"RevisionQuestion({self.question[:40]!r})"
+
+
+def question_dicts(questions):
+    """Revision questions as the dicts the API responses carry"""
+    return [q.to_dict() for q in questions]
+
+
+def upgrade_state(state):
+    """Convert the messages and questions of a state stored as dicts to records, in place"""
+    history = state['chat_history']
+    if history and isinstance(history[0], dict):
+        state['chat_history'] = type(history)(ChatMessage.from_dict(m) for m in history)
+    backlog = state['summary_backlog']
+    if backlog and isinstance(backlog[0], dict):
+        state['summary_backlog'] = [ChatMessage.from_dict(m) for m in backlog]
+    questions = state['revision_questions']
+    if questions and isinstance(questions[0], dict):
+        state['revision_questions'] = [RevisionQuestion.from_dict(q) for q in questions]
+    return state
@@ -0,0 +1,278 @@
+import fcntl
+import mmap
+import os
+import pickle
+import struct
+import threading
+from array import array
+from contextlib import contextmanager
+
+MAGIC = b'TUTSNAP1'
+# Segment header: magic, segment length and offset of its index within the segment
+HEADER = struct.Struct('<8sQQ')
+COUNT = struct.Struct('<Q')
+
+
+class Segment:
+    """
+    Index of one snapshot segment: columns of its sessions sorted by key, the keys back to back
+    in one bytes object. Looked up by binary search, so opening a segment builds no per-session
+    objects.
+    """
+
+    __slots__ = ('start', 'length', 'count', 'key_offsets', 'keys', 'offsets', 'lengths', 'accessed')
+
+    def __init__(self, buffer, start):
+        magic, self.length, index_offset = HEADER.unpack_from(buffer, start)
+        if magic != MAGIC or self.length < HEADER.size or start + self.length > len(buffer):
+            raise ValueError(f"No valid segment at {start}")
+        self.start = start
+        pos = start + index_offset
+        (count,) = COUNT.unpack_from(buffer, pos)
+        pos += COUNT.size
+        self.count = count
+        self.key_offsets, pos = read_column(buffer, pos, 'q', count + 1)
+        self.offsets, pos = read_column(buffer, pos, 'q', count)
+        self.lengths, pos = read_column(buffer, pos, 'q', count)
+        self.accessed, pos = read_column(buffer, pos, 'd', count)
+        self.keys = buffer[pos:pos + self.key_offsets[count]]
+
+    def find(self, key):
+        """Row of a key (utf-8 bytes), or -1"""
+        key_offsets, keys = self.key_offsets, self.keys
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if keys[key_offsets[mid]:key_offsets[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and keys[key_offsets[lo]:key_offsets[lo + 1]] == key:
+            return lo
+        return -1
+
+    def key(self, row):
+        return self.keys[self.key_offsets[row]:self.key_offsets[row + 1]].decode()
+
+
+def read_column(buffer, pos, typecode, count):
+    column = array(typecode)
+    end = pos + count * column.itemsize
+    column.frombytes(buffer[pos:end])
+    return column, end
+
+
+class SessionSnapshot:
+    """
+    Append-only snapshot file of session states, for warm restarts of the in-memory store.
+
+    The file is a sequence of segments: a header, the pickled states back to back, then a
+    columnar index of the segment sorted by key (a zero length marks a deleted session). The
+    first segment holds every session, each later one the sessions changed since (a delta).
+    open() only maps the file and reads the segment indexes, so a worker serves requests right
+    away whatever the number of sessions, and each session is unpickled on first access, see
+    load(). rewrite() replaces the file with a single segment once deltas are as large as it or
+    too many to look through.
+
+    A segment's header is written last, so a segment torn by a crash is ignored and
+    overwritten by the next one. States are pickled, so the file must be trusted. Writers hold
+    an exclusive lock on `<path>.lock` and read the segment indexes again before writing, so
+    processes sharing a path (an old worker saving at exit while its replacement starts, or
+    several workers on one path) never truncate each other's segments. Each process still only
+    serves the sessions it restored or wrote itself, like the in-memory store.
+    """
+
+    MAX_SEGMENTS = 16  # Rewrite when a lookup would search more segments
+
+    def __init__(self, path):
+        self.path = path
+        self._segments = []  # Oldest first
+        self._map = None
+        self._end = 0  # End of the last valid segment
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # Held with the file lock by the thread writing
+        self._stats = {'written': 0, 'deleted': 0, 'rewrites': 0, 'loaded': 0}
+
+    def open(self):
+        """Map the file and read the segment indexes"""
+        with self._lock:
+            self._scan()
+
+    def _scan(self):
+        self._remap()
+        self._segments, pos = [], 0
+        while self._map is not None and pos + HEADER.size <= len(self._map):
+            try:
+                segment = Segment(self._map, pos)
+            except ValueError:
+                break
+            self._segments.append(segment)
+            pos += segment.length
+        self._end = pos
+
+    @contextmanager
+    def _writing(self):
+        """Lock the file against writers of other processes and read its segments as they are now"""
+        with self._write_lock, open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with self._lock:
+                    self._scan()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _lookup(self, key):
+        encoded = key.encode()
+        for segment in reversed(self._segments):
+            row = segment.find(encoded)
+            if row >= 0:
+                if not segment.lengths[row]:
+                    return None
+                return segment.offsets[row], segment.lengths[row], segment.accessed[row]
+        return None
+
+    def raw(self, key):
+        """
+        Returns:
+            tuple: (pickled state, last access) of a session, or None if it isn't in the snapshot
+        """
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                return None
+            offset, length, accessed = entry
+            return self._map[offset:offset + length], accessed
+
+    def load(self, key):
+        """
+        Returns:
+            tuple: (state, last access) of a session, or None if it isn't in the snapshot
+        """
+        raw = self.raw(key)
+        if raw is None:
+            return None
+        with self._lock:
+            self._stats['loaded'] += 1
+        return pickle.loads(raw[0]), raw[1]
+
+    def keys(self):
+        """Keys of the sessions in the snapshot"""
+        seen = set()
+        for segment in reversed(self._segments):
+            for row in range(segment.count):
+                key = segment.key(row)
+                if key not in seen:
+                    seen.add(key)
+                    if segment.lengths[row]:
+                        yield key
+
+    def append(self, records):
+        """
+        Append a delta segment.
+
+        Args:
+            records: (key text, pickled state or None if deleted, last access) of the changed sessions
+
+        Returns:
+            int: Sessions written
+        """
+        with self._writing():
+            with self._lock:
+                records = [r for r in records if r[1] is not None or self._lookup(r[0]) is not None]
+            if not records:
+                return 0
+            with self._lock:
+                mode = 'r+b' if os.path.exists(self.path) else 'w+b'
+                with open(self.path, mode) as f:
+                    # Drop what a crash may have left after the last valid segment
+                    f.truncate(self._end)
+                    start, self._end = self._end, write_segment(f, self._end, records)
+                self._remap()
+                self._segments.append(Segment(self._map, start))
+                deleted = sum(1 for r in records if r[1] is None)
+                self._stats['written'] += len(records) - deleted
+                self._stats['deleted'] += deleted
+        return len(records)
+
+    def should_compact(self):
+        if len(self._segments) < 2:
+            return False
+        base = self._segments[0].length
+        return len(self._segments) > self.MAX_SEGMENTS or self._end - base > base
+
+    def rewrite(self, records):
+        """
+        Replace the file with a single segment of these sessions.
+
+        Args:
+            records: (key text, pickled state, last access) of every live session, consumed
+                while the current file is still readable and its segments are read again
+        """
+        tmp_path = self.path + '.tmp'
+        with self._writing():
+            with open(tmp_path, 'w+b') as f:
+                end = write_segment(f, 0, (r for r in records if r[1] is not None))
+            with self._lock:
+                os.replace(tmp_path, self.path)
+                self._end = end
+                self._remap()
+                self._segments = [Segment(self._map, 0)]
+                self._stats['rewrites'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self._stats,
+                segments=len(self._segments),
+                file_bytes=self._end,
+                delta_bytes=self._end - self._segments[0].length if self._segments else 0
+            )
+
+
+def write_segment(f, start, records):
+    """
+    Write a segment at `start` of an open file, its header last.
+
+    Returns:
+        int: End of the segment
+    """
+    f.seek(start)
+    f.write(bytes(HEADER.size))
+    rows = []
+    pos = start + HEADER.size
+    for key, blob, last_access in records:
+        if blob is None:
+            rows.append((key.encode(), 0, 0, last_access))
+        else:
+            f.write(blob)
+            rows.append((key.encode(), pos, len(blob), last_access))
+            pos += len(blob)
+    rows.sort(key=lambda row: row[0])
+
+    key_offsets = array('q', [0])
+    for row in rows:
+        key_offsets.append(key_offsets[-1] + len(row[0]))
+    f.write(COUNT.pack(len(rows)))
+    f.write(key_offsets.tobytes())
+    f.write(array('q', [row[1] for row in rows]).tobytes())
+    f.write(array('q', [row[2] for row in rows]).tobytes())
+    f.write(array('d', [row[3] for row in rows]).tobytes())
+    f.write(b''.join(row[0] for row in rows))
+    end = f.tell()
+    # The states and index must be on disk before the header makes the segment valid
+    f.flush()
+    os.fsync(f.fileno())
+    f.seek(start)
+    f.write(HEADER.pack(MAGIC, end - start, pos - start))
+    f.flush()
+    os.fsync(f.fileno())
+    return end
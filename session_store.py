@@ -0,0 +1,387 @@
+import atexit
+import copy
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+
+from session_records import upgrade_state
+from session_snapshot import SessionSnapshot
+
+logger = logging.getLogger(__name__)
+LOCK_STRIPES = 256  # Per-session locks are striped so their number stays bounded
+
+
+def new_session_state():
+    """Empty state of one (user, course) chat session"""
+    return {
+        'chat_history': deque(),  # [ChatMessage], within the history window's token budget
+        'history_tokens': 0,  # Tokens of the messages in chat_history
+        'history_summary': '',  # Rolling summary of messages dropped from chat_history
+        'summary_backlog': [],  # [ChatMessage] dropped and not summarized yet
+        'history_epoch': 0,  # Bumped when the chat is cleared
+        'question_count': 0,
+        'revision_questions': [],  # [RevisionQuestion]
+        'conversation_version': 0,  # Bumped whenever the chat history changes
+        'revision_version': 0,  # Bumped whenever the revision set changes
+        'revision_generated_at': None,  # Conversation version the revision set was built from
+        'revision_cursor': 0,  # Sequence number of the last message covered by the revision set
+        'revision_job': None,  # Latest background revision job, as RevisionJob.to_dict()
+        'review_cards': {},  # {question stem: ReviewCard} of the questions answered, for spaced repetition
+    }
+
+
+STATE_KEYS = len(new_session_state())
+# Fields modified in place by the writers of a session
+CONTAINER_FIELDS = ('chat_history', 'summary_backlog', 'revision_questions', 'review_cards')
+
+
+def copy_state(state):
+    """Copy of a state whose containers can be modified without changing the original"""
+    copied = dict(state)
+    for field in CONTAINER_FIELDS:
+        copied[field] = copy.copy(state[field])
+    return copied
+
+
+class SessionKey(namedtuple('SessionKey', ['user_id', 'course_id'])):
+    """(user, course) key of a chat session"""
+
+    __slots__ = ()
+
+    def __str__(self):
+        # Text form kept by the SQLite store and in logs, unambiguous as course ids have no '-'
+        return f"{self.user_id}-{self.course_id}"
+
+
+class SessionStore:
+    """
+    Storage for per-session chat state, keyed by SessionKey.
+
+    Use `session(key)` to read-modify-write a state under the session's lock, and `read(key)`
+    for a lock-free snapshot, which must not be modified. Never hold a session open across an
+    LLM call.
+    """
+
+    def __init__(self):
+        self._locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+
+    def get(self, key):
+        """Return the stored state for a key, or None"""
+        raise NotImplementedError
+
+    def put(self, key, state):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def snapshot_stats(self):
+        """Counters of the store's snapshot, None if it keeps none"""
+        return None
+
+    def read(self, key):
+        state = self.get(key)
+        if state is None:
+            return new_session_state()
+        if len(state) < STATE_KEYS:
+            # Stored before fields were added, fill them in with their defaults
+            for field, value in new_session_state().items():
+                state.setdefault(field, value)
+        # Messages and questions stored as dicts before they became records
+        return upgrade_state(state)
+
+    def lock(self, key):
+        return self._locks[hash(key) % LOCK_STRIPES]
+
+    @contextmanager
+    def session(self, key):
+        with self.lock(key):
+            state = self.read(key)
+            yield state
+            self.put(key, state)
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Process-local store with LRU eviction beyond `max_sessions` and expiry after `ttl` idle seconds.
+    Only consistent within a single worker process.
+
+    States are copied on write: `session(key)` modifies a copy and `put` replaces the stored
+    state, so the state returned by `read(key)` is never changed while a request iterates it.
+
+    With a `snapshot` (see session_snapshot.SessionSnapshot), the sessions changed since the
+    last save are appended to it every `snapshot_interval` seconds and at exit, and a restarted
+    worker serves the snapshot's sessions without loading them up front: each is restored on
+    its first access.
+    """
+
+    def __init__(self, max_sessions=10000, ttl=86400, snapshot=None, snapshot_interval=30):
+        super().__init__()
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._data = OrderedDict()  # Format: {key: (last_access, state)}
+        self._data_lock = threading.Lock()
+        self._snapshot = snapshot
+        self.snapshot_interval = snapshot_interval
+        self._dirty = set()  # Keys changed, deleted or evicted since the last save
+        self._taken = set()  # Text keys whose snapshot copy was restored or replaced in this process
+        self._snapshot_pid = None  # Process the snapshot was opened in
+        self._open_lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def get(self, key):
+        if self._snapshot is not None and self._snapshot_pid != os.getpid():
+            self._open_snapshot()
+        with self._data_lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if self.ttl and time.time() - entry[0] > self.ttl:
+                    del self._data[key]
+                    return None
+                self._data[key] = (time.time(), entry[1])
+                self._data.move_to_end(key)
+                return entry[1]
+        if self._snapshot_pid is not None:
+            return self._restore(key)
+        return None
+
+    @contextmanager
+    def session(self, key):
+        with self.lock(key):
+            state = copy_state(self.read(key))
+            yield state
+            self.put(key, state)
+
+    def put(self, key, state):
+        with self._data_lock:
+            self._data[key] = (time.time(), state)
+            self._data.move_to_end(key)
+            if self._snapshot is not None:
+                self._dirty.add(key)
+                self._taken.add(str(key))
+            while len(self._data) > self.max_sessions:
+                evicted, _ = self._data.popitem(last=False)
+                if self._snapshot is not None:
+                    self._dirty.add(evicted)
+
+    def delete(self, key):
+        with self._data_lock:
+            self._data.pop(key, None)
+            if self._snapshot is not None:
+                self._dirty.add(key)
+                self._taken.add(str(key))
+
+    def __len__(self):
+        """Sessions in memory, not counting those in the snapshot that weren't accessed yet"""
+        return len(self._data)
+
+    def snapshot_stats(self):
+        if self._snapshot is None:
+            return None
+        return self._snapshot.stats()
+
+    def _open_snapshot(self):
+        # Opened on first use in each process, so a worker forked from a preloading master maps
+        # the file as it is then and runs its own save thread
+        with self._open_lock:
+            if self._snapshot_pid == os.getpid():
+                return
+            try:
+                self._snapshot.open()
+            except Exception as e:
+                logger.error("Error opening the session snapshot %s, sessions won't be saved: %s", self._snapshot.path, e)
+                self._snapshot = None
+                return
+            with self._data_lock:
+                # Sessions written before the snapshot was opened are newer than their copy in it
+                self._taken.update(str(key) for key in self._data)
+            self._snapshot_pid = os.getpid()
+            if self.snapshot_interval:
+                threading.Thread(target=self._run_snapshots, name='session-snapshot', daemon=True).start()
+            logger.info("Opened the session snapshot %s: %s", self._snapshot.path, self._snapshot.stats())
+
+    def _restore(self, key):
+        text = str(key)
+        if text in self._taken:
+            return None
+        try:
+            loaded = self._snapshot.load(text)
+        except Exception as e:
+            logger.error("Error restoring session %s from the snapshot: %s", text, e)
+            loaded = None
+        with self._data_lock:
+            if text in self._taken:
+                # Restored or replaced by another thread meanwhile
+                entry = self._data.get(key)
+                return entry[1] if entry is not None else None
+            self._taken.add(text)
+            if loaded is None or (self.ttl and time.time() - loaded[1] > self.ttl):
+                return None
+            self._data[key] = (time.time(), loaded[0])
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_sessions:
+                evicted, _ = self._data.popitem(last=False)
+                self._dirty.add(evicted)
+            return loaded[0]
+
+    def _run_snapshots(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            try:
+                self.save()
+            except Exception as e:
+                logger.error("Error saving the session snapshot %s: %s", self._snapshot.path, e)
+
+    def save(self):
+        """
+        Append the sessions changed since the last save to the snapshot, and rewrite it once
+        its deltas outgrow it.
+
+        Returns:
+            int: Sessions written
+        """
+        if self._snapshot is None or self._snapshot_pid != os.getpid():
+            return 0
+        with self._save_lock:
+            with self._data_lock:
+                dirty, self._dirty = self._dirty, set()
+            try:
+                written = self._snapshot.append(self._snapshot_records(dirty))
+            except BaseException:
+                # Try them again with the next save
+                with self._data_lock:
+                    self._dirty |= dirty
+                raise
+            if self._snapshot.should_compact():
+                self._snapshot.rewrite(self._all_snapshot_records())
+            return written
+
+    def _snapshot_records(self, keys):
+        """(key text, pickled state or None if gone, last access) of these sessions"""
+        for key in keys:
+            # Under the session's lock, a state is only modified while it is held
+            with self.lock(key):
+                with self._data_lock:
+                    entry = self._data.get(key)
+                blob = pickle.dumps(entry[1], pickle.HIGHEST_PROTOCOL) if entry is not None else None
+            yield str(key), blob, entry[0] if entry is not None else time.time()
+
+    def _all_snapshot_records(self):
+        with self._data_lock:
+            keys = list(self._data)
+        yield from self._snapshot_records(keys)
+        # Sessions not accessed since the restart are copied as they are, without unpickling them
+        now = time.time()
+        for text in list(self._snapshot.keys()):
+            if text in self._taken:
+                continue
+            raw = self._snapshot.raw(text)
+            if raw is not None and not (self.ttl and now - raw[1] > self.ttl):
+                yield text, raw[0], raw[1]
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Persistent store shared by every worker process through one SQLite database in WAL mode.
+
+    A session is read and written inside a single IMMEDIATE transaction, which also serializes
+    writers from other processes. States are pickled, so the database must be trusted.
+    """
+
+    PURGE_EVERY = 500  # Writes between sweeps for expired sessions
+
+    def __init__(self, path='sessions.db', ttl=86400):
+        super().__init__()
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "key TEXT PRIMARY KEY, state BLOB NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # Connections must not cross a fork, e.g. a store created in a preloading gunicorn master
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT state, updated_at FROM sessions WHERE key = ?", (str(key),)
+        ).fetchone()
+        if row is None or (self.ttl and time.time() - row[1] > self.ttl):
+            return None
+        return pickle.loads(row[0])
+
+    def put(self, key, state):
+        conn = self._connect()
+        conn.execute(
+            "INSERT INTO sessions (key, state, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+            (str(key), pickle.dumps(state, pickle.HIGHEST_PROTOCOL), time.time())
+        )
+        self._writes += 1
+        if self.ttl and self._writes % self.PURGE_EVERY == 0:
+            conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl,))
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM sessions WHERE key = ?", (str(key),))
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    @contextmanager
+    def session(self, key):
+        with self.lock(key):
+            conn = self._connect()
+            if conn.in_transaction:
+                # Nested in another session on this thread, the outer transaction covers us
+                state = self.read(key)
+                yield state
+                self.put(key, state)
+                return
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                state = self.read(key)
+                yield state
+                self.put(key, state)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+
+def create_session_store():
+    """Build the store selected by the SESSION_STORE environment variable ('memory' or 'sqlite')"""
+    backend = os.getenv("SESSION_STORE", "memory")
+    ttl = int(os.getenv("SESSION_TTL", 86400))
+    if backend == 'sqlite':
+        return SQLiteSessionStore(os.getenv("SESSION_DB_PATH", "sessions.db"), ttl=ttl)
+    if backend == 'memory':
+        snapshot_path = os.getenv("SESSION_SNAPSHOT_PATH", "")
+        if not snapshot_path:
+            return MemorySessionStore(int(os.getenv("SESSION_MAX", 10000)), ttl=ttl)
+        store = MemorySessionStore(
+            int(os.getenv("SESSION_MAX", 10000)), ttl=ttl,
+            snapshot=SessionSnapshot(snapshot_path),
+            snapshot_interval=float(os.getenv("SESSION_SNAPSHOT_SECONDS", 30))
+        )
+        atexit.register(store.save)
+        return store
+    raise ValueError(f"Unknown SESSION_STORE backend: {backend}")
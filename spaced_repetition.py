@@ -0,0 +1,72 @@
+import time
+
+# Seconds until a question in each Leitner box is due again: a wrong answer sends it back to box 0
+DEFAULT_INTERVALS = (60, 600, 3600, 86400, 3 * 86400, 7 * 86400, 21 * 86400)
+
+
+class ReviewCard:
+    """A student's answer history for one revision question, kept in their session state"""
+
+    __slots__ = ('question', 'box', 'due', 'correct', 'wrong', 'answered_at')
+
+    def __init__(self, question, box=0, due=0, correct=0, wrong=0, answered_at=0):
+        self.question = question  # RevisionQuestion
+        self.box = box
+        self.due = due  # Epoch seconds
+        self.correct = correct
+        self.wrong = wrong
+        self.answered_at = answered_at
+
+    def __reduce__(self):
+        return ReviewCard, (self.question, self.box, self.due, self.correct, self.wrong, self.answered_at)
+
+
+class ReviewScheduler:
+    """
+    Leitner-box spaced repetition over the revision questions a student has answered.
+
+    A correct answer moves the question's card up a box and a wrong one back to the first, and
+    the card is due again after its box's interval. Due cards are surfaced most overdue first,
+    questions the student got wrong more often breaking ties, so students review from questions
+    they already have instead of a new completion being generated each time.
+    """
+
+    def __init__(self, intervals=DEFAULT_INTERVALS, max_cards=100):
+        self.intervals = tuple(intervals)
+        self.max_cards = max_cards
+
+    def record(self, cards, question, correct, now=None):
+        """
+        Update the card of an answered question in a session's {stem: ReviewCard} dict.
+
+        Returns:
+            ReviewCard: The updated card
+        """
+        now = int(time.time()) if now is None else now
+        card = cards.get(question.stem)
+        if card is None:
+            card = cards[question.stem] = ReviewCard(question)
+            self._evict(cards)
+        card.question = question
+        if correct:
+            card.correct += 1
+            card.box = min(card.box + 1, len(self.intervals) - 1)
+        else:
+            card.wrong += 1
+            card.box = 0
+        card.answered_at = now
+        card.due = now + self.intervals[card.box]
+        return card
+
+    def due(self, cards, now=None, limit=None):
+        """Questions of the cards due for review, most overdue first"""
+        now = int(time.time()) if now is None else now
+        due = [card for card in cards.values() if card.due <= now]
+        due.sort(key=lambda card: (card.due, -card.wrong))
+        return [card.question for card in due[:limit]]
+
+    def _evict(self, cards):
+        # Past the limit, forget the best known questions, and of those the longest unanswered
+        while len(cards) > self.max_cards:
+            stem = max(cards, key=lambda s: (cards[s].box, -cards[s].answered_at))
+            del cards[stem]
@@ -9,6 +9,10 @@ document.addEventListener('DOMContentLoaded', function() {
     const questionCountElement = document.getElementById('question-count');
     const nextRevisionElement = document.getElementById('next-revision');
     
+    // Version of the revision set currently rendered, so we only download sets we don't have
+    const revisionVersionInput = document.getElementById('revision-version');
+    let revisionVersion = revisionVersionInput ? parseInt(revisionVersionInput.value, 10) : null;
+    
     // Queue for handling multiple messages
     const streamQueue = [];
     let isStreaming = false;
@@ -70,14 +74,17 @@ document.addEventListener('DOMContentLoaded', function() {
         const reader = response.body.getReader();
         const decoder = new TextDecoder();
         let buffer = '';
+        let pending = '';  // Start of a frame split across reads
         
         try {
             while (true) {
                 const { value, done } = await reader.read();
                 if (done) break;
                 
-                const text = decoder.decode(value);
+                // Frames (and multi-byte characters) can span reads, keep the unfinished tail
+                const text = pending + decoder.decode(value, { stream: true });
                 const lines = text.split('\n\n');
+                pending = lines.pop();
                 
                 for (const line of lines) {
                     if (line.startsWith('data:')) {
@@ -136,8 +143,12 @@ document.addEventListener('DOMContentLoaded', function() {
                                     
                                     // Check if we should show revision questions - UPDATE HERE
                                     if (data.generate_revisions) {
-                                        // Instead of reloading, fetch the revision questions
-                                        fetchAndUpdateRevisionQuestions();
+                                        // Revisions are generated in the background, poll the job until it finishes
+                                        if (data.revision_job_id) {
+                                            pollRevisionJob(data.revision_job_id);
+                                        } else {
+                                            fetchAndUpdateRevisionQuestions();
+                                        }
                                     }
                                 }
                                 
@@ -287,6 +298,7 @@ document.addEventListener('DOMContentLoaded', function() {
                         if (revisionQuestionsContainer) {
                             revisionQuestionsContainer.innerHTML = '';
                         }
+                        revisionVersion = null;
                     } else {
                         alert('Failed to clear chat history. Please try again.');
                     }
@@ -305,7 +317,8 @@ document.addEventListener('DOMContentLoaded', function() {
                 generateRevisionBtn.disabled = true;
                 generateRevisionBtn.textContent = 'Generating...';
                 
-                const response = await fetch('/api/generate_revision', {
+                // Questions are streamed and rendered one by one as they are generated
+                const response = await fetch('/api/generate_revision_stream', {
                     method: 'POST',
                     headers: {
                         'Content-Type': 'application/json',
@@ -315,14 +328,33 @@ document.addEventListener('DOMContentLoaded', function() {
                     })
                 });
                 
-                const data = await response.json();
-                
-                if (data.success) {
-                    // Instead of reloading, update the revision questions section
-                    updateRevisionQuestions(data.revision_questions);
-                } else {
+                if (!response.ok) {
+                    const data = await response.json();
                     alert('Failed to generate revision questions: ' + (data.error || 'Unknown error'));
+                    return;
                 }
+                
+                let streamed = [];
+                await readEventStream(response, data => {
+                    if (data.start) {
+                        // Replace the list, or keep it when the new questions are added to it
+                        streamed = [];
+                        if (!data.merge) resetRevisionQuestions();
+                    } else if (data.question) {
+                        streamed.push(data.question);
+                        appendRevisionQuestion(data.question);
+                    } else if (data.end) {
+                        // The stored set is authoritative, re-render only if it differs from what was streamed
+                        const rendered = document.querySelectorAll('#revision-questions-container .revision-question').length;
+                        if (rendered !== data.revision_questions.length ||
+                                JSON.stringify(streamed) !== JSON.stringify(data.revision_questions.slice(-streamed.length))) {
+                            updateRevisionQuestions(data.revision_questions);
+                        }
+                        revisionVersion = data.version;
+                    } else if (data.error) {
+                        alert('Failed to generate revision questions: ' + data.error);
+                    }
+                });
             } catch (error) {
                 console.error('Error generating revision:', error);
                 alert('Error generating revision questions. Please try again.');
@@ -333,8 +365,41 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    // Read a server-sent event stream, calling onEvent with each event's JSON data
+    async function readEventStream(response, onEvent) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let pending = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            
+            const events = (pending + decoder.decode(value, { stream: true })).split('\n\n');
+            pending = events.pop();
+            for (const event of events) {
+                if (event.startsWith('data:')) {
+                    onEvent(JSON.parse(event.slice(5)));
+                }
+            }
+        }
+    }
+
     // Add this new function to update revision questions without page reload
     function updateRevisionQuestions(questions) {
+        const container = resetRevisionQuestions();
+        if (!container) return;
+        
+        // Add questions
+        questions.forEach((question, index) => {
+            container.appendChild(createRevisionQuestion(question, index));
+        });
+        
+        // Setup event handlers for the new buttons
+        setupMultipleChoiceQuestions();
+    }
+
+    // Show the revision section with an empty question list, returns its container
+    function resetRevisionQuestions() {
         // Show the revision section if hidden
         const revisionSection = document.getElementById('revision-section');
         if (revisionSection) {
@@ -343,7 +408,7 @@ document.addEventListener('DOMContentLoaded', function() {
         
         // Get the container for revision questions
         const container = document.getElementById('revision-questions-container');
-        if (!container) return;
+        if (!container) return null;
         
         // Clear the existing content
         container.innerHTML = '';
@@ -352,108 +417,148 @@ document.addEventListener('DOMContentLoaded', function() {
         const heading = document.createElement('h3');
         heading.textContent = 'Revision Questions';
         container.appendChild(heading);
+        return container;
+    }
+
+    // Add one question to the end of the revision list, as it arrives from a stream
+    function appendRevisionQuestion(question) {
+        const container = document.getElementById('revision-questions-container');
+        if (!container) return;
+        const index = container.querySelectorAll('.revision-question').length;
+        const questionDiv = createRevisionQuestion(question, index);
+        container.appendChild(questionDiv);
+        setupMultipleChoiceQuestions(questionDiv);
+    }
+
+    // Build the element of one revision question
+    function createRevisionQuestion(question, index) {
+        const questionDiv = document.createElement('div');
+        questionDiv.className = 'revision-question';
+        questionDiv.id = `question-${index}`;
         
-        // Add questions
-        questions.forEach((question, index) => {
-            const questionDiv = document.createElement('div');
-            questionDiv.className = 'revision-question';
-            questionDiv.id = `question-${index}`;
-            
-            // Question text
-            const questionText = document.createElement('div');
-            questionText.className = 'question-text';
-            questionText.textContent = `${index + 1}. ${question.question}`;
-            questionDiv.appendChild(questionText);
-            
-            // Options container
-            const optionsDiv = document.createElement('div');
-            optionsDiv.className = 'options';
-            
-            // Add each option
-            for (const [key, value] of Object.entries(question.options)) {
-                const optionDiv = document.createElement('div');
-                optionDiv.className = 'option';
-                
-                const label = document.createElement('label');
-                
-                const radio = document.createElement('input');
-                radio.type = 'radio';
-                radio.value = key;
-                radio.name = `question${index}`;
-                radio.setAttribute('data-correct', key === question.correct ? 'true' : 'false');
-                
-                const optionText = document.createTextNode(`${key}) ${value}`);
-                
-                label.appendChild(radio);
-                label.appendChild(optionText);
-                optionDiv.appendChild(label);
-                optionsDiv.appendChild(optionDiv);
-            }
-            
-            questionDiv.appendChild(optionsDiv);
-            
-            // Add answer div
-            const answerDiv = document.createElement('div');
-            answerDiv.className = 'answer';
-            answerDiv.style.display = 'none';
-            answerDiv.textContent = `Correct answer: ${question.correct}`;
-            questionDiv.appendChild(answerDiv);
+        // Question text
+        const questionText = document.createElement('div');
+        questionText.className = 'question-text';
+        questionText.textContent = `${index + 1}. ${question.question}`;
+        questionDiv.appendChild(questionText);
+        
+        // Options container
+        const optionsDiv = document.createElement('div');
+        optionsDiv.className = 'options';
+        
+        // Add each option
+        for (const [key, value] of Object.entries(question.options)) {
+            const optionDiv = document.createElement('div');
+            optionDiv.className = 'option';
             
-            // Add incorrect answer div
-            const incorrectDiv = document.createElement('div');
-            incorrectDiv.className = 'incorrect-answer';
-            incorrectDiv.style.display = 'none';
-            incorrectDiv.textContent = 'Incorrect! Please try again.';
-            questionDiv.appendChild(incorrectDiv);
+            const label = document.createElement('label');
             
-            // Add check answer button
-            const checkBtn = document.createElement('button');
-            checkBtn.className = 'check-answer';
-            checkBtn.setAttribute('data-index', index);
-            checkBtn.textContent = 'Check Answer';
-            questionDiv.appendChild(checkBtn);
+            const radio = document.createElement('input');
+            radio.type = 'radio';
+            radio.value = key;
+            radio.name = `question${index}`;
+            radio.setAttribute('data-correct', key === question.correct ? 'true' : 'false');
             
-            // Add try again button
-            const tryAgainBtn = document.createElement('button');
-            tryAgainBtn.className = 'try-again';
-            tryAgainBtn.setAttribute('data-index', index);
-            tryAgainBtn.style.display = 'none';
-            tryAgainBtn.textContent = 'Try Again';
-            questionDiv.appendChild(tryAgainBtn);
+            const optionText = document.createTextNode(`${key}) ${value}`);
             
-            container.appendChild(questionDiv);
-        });
+            label.appendChild(radio);
+            label.appendChild(optionText);
+            optionDiv.appendChild(label);
+            optionsDiv.appendChild(optionDiv);
+        }
         
-        // Setup event handlers for the new buttons
-        setupMultipleChoiceQuestions();
+        questionDiv.appendChild(optionsDiv);
+        
+        // Add answer div
+        const answerDiv = document.createElement('div');
+        answerDiv.className = 'answer';
+        answerDiv.style.display = 'none';
+        answerDiv.textContent = `Correct answer: ${question.correct}`;
+        questionDiv.appendChild(answerDiv);
+        
+        // Add incorrect answer div
+        const incorrectDiv = document.createElement('div');
+        incorrectDiv.className = 'incorrect-answer';
+        incorrectDiv.style.display = 'none';
+        incorrectDiv.textContent = 'Incorrect! Please try again.';
+        questionDiv.appendChild(incorrectDiv);
+        
+        // Add check answer button
+        const checkBtn = document.createElement('button');
+        checkBtn.className = 'check-answer';
+        checkBtn.setAttribute('data-index', index);
+        checkBtn.textContent = 'Check Answer';
+        questionDiv.appendChild(checkBtn);
+        
+        // Add try again button
+        const tryAgainBtn = document.createElement('button');
+        tryAgainBtn.className = 'try-again';
+        tryAgainBtn.setAttribute('data-index', index);
+        tryAgainBtn.style.display = 'none';
+        tryAgainBtn.textContent = 'Try Again';
+        questionDiv.appendChild(tryAgainBtn);
+        
+        return questionDiv;
     }
 
+    // Apply a revision payload, skipping it when we already render that version
+    function applyRevisionPayload(data) {
+        if (data.unchanged || data.version === revisionVersion) return;
+        revisionVersion = data.version;
+        updateRevisionQuestions(data.revision_questions);
+    }
+
+    // Read-only fetch of the stored revision set, never triggers a generation
     async function fetchAndUpdateRevisionQuestions() {
         try {
-            const response = await fetch('/api/generate_revision', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    course_id: courseId
-                })
-            });
+            const params = new URLSearchParams({ course_id: courseId });
+            if (revisionVersion !== null) params.set('version', revisionVersion);
+            const response = await fetch(`/api/revision_questions?${params}`);
             
             const data = await response.json();
             
             if (data.success) {
-                updateRevisionQuestions(data.revision_questions);
+                applyRevisionPayload(data);
             }
         } catch (error) {
             console.error('Error fetching revision questions:', error);
         }
     }
 
-    // Set up multiple choice questions
-    function setupMultipleChoiceQuestions() {
+    // Poll a background revision job until its questions are ready
+    async function pollRevisionJob(jobId, attempt = 0) {
+        const maxAttempts = 60;
+        try {
+            const params = new URLSearchParams({ course_id: courseId, job_id: jobId });
+            if (revisionVersion !== null) params.set('version', revisionVersion);
+            const response = await fetch(`/api/revision_status?${params}`);
+            const data = await response.json();
+            
+            if (data.status === 'done') {
+                applyRevisionPayload(data);
+                return;
+            }
+            if (data.status === 'cancelled') {
+                // Superseded by a newer message or a cleared chat
+                return;
+            }
+            if (data.status === 'failed' || !response.ok) {
+                console.error('Revision job failed:', data.error);
+                return;
+            }
+        } catch (error) {
+            console.error('Error polling revision job:', error);
+        }
+        
+        if (attempt < maxAttempts) {
+            setTimeout(() => pollRevisionJob(jobId, attempt + 1), 1000);
+        }
+    }
+
+    // Set up multiple choice questions, in the whole page or just under root
+    function setupMultipleChoiceQuestions(root = document) {
         // After page load, find all radio buttons and ensure proper grouping
-        const questionDivs = document.querySelectorAll('.revision-question');
+        const questionDivs = root.querySelectorAll('.revision-question');
         
         // For each question, ensure all its radio buttons have a unique name per question
         questionDivs.forEach(questionDiv => {
@@ -467,7 +572,7 @@ document.addEventListener('DOMContentLoaded', function() {
         });
         
         // Set up check answer buttons
-        document.querySelectorAll('.check-answer').forEach(button => {
+        root.querySelectorAll('.check-answer').forEach(button => {
             button.addEventListener('click', function() {
                 const questionIndex = this.getAttribute('data-index');
                 const questionDiv = document.getElementById(`question-${questionIndex}`);
@@ -525,7 +630,8 @@ document.addEventListener('DOMContentLoaded', function() {
                             course_id: courseId,
                             question_index: questionIndex,
                             selected_answer: selectedRadio.value,
-                            is_correct: isCorrect
+                            is_correct: isCorrect,
+                            version: revisionVersion
                         })
                     });
                 } catch (error) {
@@ -535,7 +641,7 @@ document.addEventListener('DOMContentLoaded', function() {
         });
         
         // Set up try again buttons
-        document.querySelectorAll('.try-again').forEach(button => {
+        root.querySelectorAll('.try-again').forEach(button => {
             button.addEventListener('click', function() {
                 const questionIndex = this.getAttribute('data-index');
                 const questionDiv = document.getElementById(`question-${questionIndex}`);
@@ -0,0 +1,98 @@
+import json
+import time
+
+POLICIES = ('token', 'word', 'time', 'bytes')
+
+_encode_json = json.JSONEncoder(ensure_ascii=False).encode  # Non-ASCII text goes out as UTF-8, not \uXXXX escapes
+
+
+def sse_frame(data):
+    """One server-sent event carrying `data` as JSON"""
+    return f"data: {_encode_json(data)}\n\n"
+
+
+class StreamEncoder:
+    """
+    Turns streamed completion deltas into SSE chunk frames.
+
+    Deltas are kept in lists and only joined when a frame is flushed, so nothing is
+    re-concatenated or re-scanned per delta. When a frame is flushed depends on the policy:
+
+        token  every delta is its own frame
+        word   everything up to the last space of the delta, so frames end on word boundaries
+        time   whatever arrived once `flush_interval` seconds have passed since the last frame
+        bytes  whatever arrived once at least `flush_bytes` bytes are pending
+
+    The time and bytes policies are checked as deltas arrive, close() flushes the rest.
+    """
+
+    def __init__(self, policy='word', flush_interval=0.05, flush_bytes=256):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown stream flush policy {policy!r}, expected one of {', '.join(POLICIES)}")
+        self.policy = policy
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self._parts = []  # Every delta, the full response is joined from these once
+        self._pending = []  # Deltas not sent yet
+        self._pending_size = 0
+        self._last_flush = time.monotonic()
+        self.deltas = 0  # Deltas fed
+        self.frames = 0  # Frames returned
+
+    def feed(self, content):
+        """
+        Add a delta.
+
+        Returns:
+            list: SSE frames to send now, possibly empty
+        """
+        if not content:
+            return []
+        self._parts.append(content)
+        self.deltas += 1
+
+        if self.policy == 'token':
+            self.frames += 1
+            return [sse_frame({'chunk': content})]
+
+        if self.policy == 'word':
+            cut = content.rfind(' ')
+            if cut < 0:
+                self._pending.append(content)
+                return []
+            self._pending.append(content[:cut + 1])
+            frames = self._flush()
+            if cut + 1 < len(content):
+                self._pending.append(content[cut + 1:])
+            return frames
+
+        self._pending.append(content)
+        if self.policy == 'time':
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                return self._flush()
+            return []
+
+        self._pending_size += len(content.encode())
+        if self._pending_size >= self.flush_bytes:
+            return self._flush()
+        return []
+
+    def close(self):
+        """Flush whatever is still pending. Returns a list of SSE frames"""
+        return self._flush()
+
+    def text(self):
+        """The full response so far"""
+        if len(self._parts) > 1:
+            self._parts = [''.join(self._parts)]
+        return self._parts[0] if self._parts else ''
+
+    def _flush(self):
+        if not self._pending:
+            return []
+        text = ''.join(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        self._last_flush = time.monotonic()
+        self.frames += 1
+        return [sse_frame({'chunk': text})]
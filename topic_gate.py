@@ -0,0 +1,79 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from answer_cache import normalize_message
+
+logger = logging.getLogger(__name__)
+
+
+class TopicGate:
+    """
+    Decides whether a chat message is on topic for its course before any answer is generated,
+    so off-topic messages are turned away without paying for a streamed completion.
+
+    Decisions come from `classify` (an embedding similarity or a one-token completion) and are
+    cached per (course id, normalized message) in an LRU with TTL expiry, so the greetings and
+    stray questions students send over and over are decided without classifying them again.
+    A classifier error lets the message through and is not cached.
+    """
+
+    def __init__(self, classify, max_entries=10000, ttl=3600):
+        self._classify = classify  # (message, course) -> True if on topic
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._decisions = OrderedDict()  # Format: {(course_id, normalized message): (decided_at, on_topic)}
+        self._lock = threading.Lock()
+        self._stats = {'checks': 0, 'hits': 0, 'off_topic': 0, 'errors': 0}
+
+    def check(self, message, course):
+        """
+        Returns:
+            tuple: (on_topic, cached) where cached tells whether the decision came from the cache
+        """
+        key = (course['id'], normalize_message(message))
+        with self._lock:
+            self._stats['checks'] += 1
+            entry = self._decisions.get(key)
+            if entry is not None and self.ttl and time.time() - entry[0] > self.ttl:
+                del self._decisions[key]
+                entry = None
+            if entry is not None:
+                self._decisions.move_to_end(key)
+                self._stats['hits'] += 1
+                if not entry[1]:
+                    self._stats['off_topic'] += 1
+                return entry[1], True
+
+        try:
+            on_topic = bool(self._classify(message, course))
+        except Exception as e:
+            logger.error("Error checking the topic of a message, letting it through: %s", e)
+            with self._lock:
+                self._stats['errors'] += 1
+            return True, False
+
+        self._remember(course['id'], message, on_topic)
+        if not on_topic:
+            with self._lock:
+                self._stats['off_topic'] += 1
+        return on_topic, False
+
+    def _remember(self, course_id, message, on_topic):
+        """Cache a decision of the classifier, which only sees the message"""
+        key = (course_id, normalize_message(message))
+        with self._lock:
+            self._decisions[key] = (time.time(), on_topic)
+            self._decisions.move_to_end(key)
+            while len(self._decisions) > self.max_entries:
+                self._decisions.popitem(last=False)
+
+    def clear(self, courses=None):
+        """Forget every decision, e.g. when the course descriptions changed"""
+        with self._lock:
+            self._decisions.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._decisions))
@@ -0,0 +1,432 @@
+import asyncio
+import os
+import random
+import threading
+import time
+
+import httpx
+
+
+class UpstreamUnavailable(Exception):
+    """The upstream call was not attempted, or not retried, to protect the service"""
+
+
+class UpstreamSettings:
+    """Connection pool, deadline, retry, breaker and concurrency settings of the upstream client"""
+
+    def __init__(self, max_connections=100, max_keepalive=20, connect_timeout=5.0, read_timeout=60.0,
+                 total_timeout=120.0, retries=2, retry_budget=0.2, backoff_base=0.25, backoff_max=4.0,
+                 breaker_failures=5, breaker_reset=30.0, model_concurrency=None, queue_timeout=10.0):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout  # Longest wait for a response, or between two chunks of a stream
+        self.total_timeout = total_timeout  # Deadline of a call across all its attempts, up to the first byte of a stream
+        self.retries = retries
+        self.retry_budget = retry_budget  # Retries allowed per request, averaged over recent traffic
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_failures = breaker_failures  # Consecutive failures that open the breaker
+        self.breaker_reset = breaker_reset  # Seconds the breaker stays open before a trial call
+        self.model_concurrency = model_concurrency or {}  # Format: {model: max in-flight calls}, '*' for any model
+        self.queue_timeout = queue_timeout  # Longest wait for a concurrency slot
+
+    @classmethod
+    def from_env(cls):
+        """
+        Settings from UPSTREAM_* environment variables. UPSTREAM_MODEL_CONCURRENCY is a comma
+        separated list of model=limit pairs, or a single limit for every model.
+        """
+        concurrency = {}
+        for item in filter(None, os.getenv("UPSTREAM_MODEL_CONCURRENCY", "").split(',')):
+            model, _, limit = item.rpartition('=')
+            concurrency[model.strip() or '*'] = int(limit)
+        return cls(
+            max_connections=int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 100)),
+            max_keepalive=int(os.getenv("UPSTREAM_MAX_KEEPALIVE", 20)),
+            connect_timeout=float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 5)),
+            read_timeout=float(os.getenv("UPSTREAM_READ_TIMEOUT", 60)),
+            total_timeout=float(os.getenv("UPSTREAM_TOTAL_TIMEOUT", 120)),
+            retries=int(os.getenv("UPSTREAM_RETRIES", 2)),
+            retry_budget=float(os.getenv("UPSTREAM_RETRY_BUDGET", 0.2)),
+            backoff_base=float(os.getenv("UPSTREAM_BACKOFF_BASE", 0.25)),
+            backoff_max=float(os.getenv("UPSTREAM_BACKOFF_MAX", 4)),
+            breaker_failures=int(os.getenv("UPSTREAM_BREAKER_FAILURES", 5)),
+            breaker_reset=float(os.getenv("UPSTREAM_BREAKER_RESET", 30)),
+            model_concurrency=concurrency,
+            queue_timeout=float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", 10)),
+        )
+
+    def limits(self):
+        return httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_keepalive)
+
+    def timeout(self, remaining=None):
+        read = self.read_timeout if remaining is None else max(0.001, min(self.read_timeout, remaining))
+        return httpx.Timeout(read, connect=min(self.connect_timeout, read))
+
+    def concurrency_limit(self, model):
+        return self.model_concurrency.get(model, self.model_concurrency.get('*'))
+
+
+class RetryBudget:
+    """
+    Token bucket capping retries at a fraction of requests, so a struggling upstream isn't
+    hit with a multiple of the normal load. Every request adds `ratio` tokens, a retry costs one.
+    """
+
+    def __init__(self, ratio=0.2, minimum=10):
+        self.ratio = ratio
+        self.capacity = max(minimum, 1)
+        self._tokens = float(self.capacity)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream that keeps failing. Opens after `failures` consecutive failures,
+    rejects calls for `reset` seconds, then lets one trial call through: its success closes the
+    breaker, its failure opens it again.
+    """
+
+    def __init__(self, failures=5, reset=30.0):
+        self.failures = failures
+        self.reset = reset
+        self._consecutive = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self._opened_at >= self.reset else 'open'
+
+    def allow(self):
+        """
+        Returns:
+            True to make the call, 'trial' for the one trial call of a half-open breaker (see
+            end_trial()), False to reject it
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset or self._trial:
+                return False
+            self._trial = True
+            return 'trial'
+
+    def end_trial(self):
+        """Called when the trial call is over. A trial that ended without a result, e.g. cancelled, counts as failed"""
+        with self._lock:
+            if self._trial:
+                self._trial = False
+                self._opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self._trial or (self._opened_at is None and self._consecutive >= self.failures):
+                if self._opened_at is None:
+                    self.trips += 1
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+
+class _UpstreamPolicy:
+    """Retry, budget and breaker decisions shared by the sync and async clients"""
+
+    def __init__(self, settings):
+        import openai  # Imported with the first client, it is slow to import
+        self.retryable = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+        self.timeout_error = openai.APITimeoutError  # One of the APIConnectionErrors
+        self.settings = settings
+        self.breaker = CircuitBreaker(settings.breaker_failures, settings.breaker_reset)
+        self.budget = RetryBudget(settings.retry_budget)
+        self.stats = {
+            'requests': 0, 'retries': 0, 'failures': 0, 'timeouts': 0,
+            'budget_exhausted': 0, 'breaker_rejections': 0, 'queue_timeouts': 0,
+        }
+
+    def begin(self):
+        """Count a call, returns its deadline"""
+        self.stats['requests'] += 1
+        return time.monotonic() + self.settings.total_timeout
+
+    def admit(self):
+        """
+        Let a call through the breaker, once it holds its concurrency slot.
+
+        Returns:
+            bool: Whether it is the breaker's trial call, end_trial() must follow it
+        """
+        allowed = self.breaker.allow()
+        if not allowed:
+            self.stats['breaker_rejections'] += 1
+            raise UpstreamUnavailable("The upstream model is failing, calls are paused for a moment")
+        self.budget.deposit()
+        return allowed == 'trial'
+
+    def retry_delay(self, error, attempt, deadline):
+        """
+        Seconds to wait before retrying after `error`, or None to give up and raise it.
+        Server errors and timeouts also count against the breaker.
+        """
+        if isinstance(error, self.timeout_error):
+            self.stats['timeouts'] += 1
+        if not isinstance(error, self.retryable):
+            # e.g. 400 or 401, retrying won't help but the upstream answered
+            self.breaker.record_success()
+            return None
+        self.breaker.record_failure()
+        if attempt >= self.settings.retries or self.breaker.state != 'closed':
+            return None
+
+        # Full jitter: anywhere between 0 and the exponential backoff, or what Retry-After asks for
+        delay = random.uniform(0, min(self.settings.backoff_max, self.settings.backoff_base * 2 ** attempt))
+        retry_after = getattr(getattr(error, 'response', None), 'headers', {}).get('retry-after')
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        if time.monotonic() + delay >= deadline:
+            return None
+        if not self.budget.withdraw():
+            self.stats['budget_exhausted'] += 1
+            return None
+        self.stats['retries'] += 1
+        return delay
+
+    def failed(self):
+        self.stats['failures'] += 1
+
+    def snapshot(self):
+        return {**self.stats, 'breaker': self.breaker.state, 'breaker_trips': self.breaker.trips}
+
+
+class UpstreamClient:
+    """
+    OpenAI client wrapped with a pooled HTTP client, deadlines, budgeted jittered retries,
+    a circuit breaker and per-model concurrency limits.
+
+    Streams are only retried until they start: once the first chunk is out a failure is
+    passed on, and the concurrency slot is held until the stream is consumed, closed or
+    garbage collected, see SlotStream.
+    """
+
+    def __init__(self, api_key, settings=None, base_url=None):
+        import openai
+        self.settings = settings or UpstreamSettings.from_env()
+        self._policy = _UpstreamPolicy(self.settings)
+        self._client = openai.OpenAI(
+            api_key=api_key,
+            base_url=base_url,  # None reads OPENAI_BASE_URL
+            max_retries=0,  # Retries are ours, with a budget
+            http_client=httpx.Client(limits=self.settings.limits(), timeout=self.settings.timeout())
+        )
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return self._policy.snapshot()
+
+    def _semaphore(self, model):
+        limit = self.settings.concurrency_limit(model)
+        if not limit:
+            return None
+        with self._lock:
+            if model not in self._semaphores:
+                self._semaphores[model] = threading.BoundedSemaphore(limit)
+            return self._semaphores[model]
+
+    def chat_completion(self, **kwargs):
+        """Same arguments and result as client.chat.completions.create"""
+        deadline = self._policy.begin()
+        # The slot comes first, so a call shed here never takes the breaker's trial
+        semaphore = self._semaphore(kwargs.get('model'))
+        if semaphore and not semaphore.acquire(timeout=min(self.settings.queue_timeout, deadline - time.monotonic())):
+            self._policy.stats['queue_timeouts'] += 1
+            raise UpstreamUnavailable(f"Too many concurrent calls to {kwargs.get('model')}")
+        try:
+            trial = self._policy.admit()
+            try:
+                result = self._call(kwargs, deadline)
+            finally:
+                if trial:
+                    self._policy.breaker.end_trial()
+        except BaseException:
+            if semaphore:
+                semaphore.release()
+            raise
+        if semaphore and kwargs.get('stream'):
+            return SlotStream(result, semaphore)
+        if semaphore:
+            semaphore.release()
+        return result
+
+    def _call(self, kwargs, deadline):
+        attempt = 0
+        while True:
+            try:
+                result = self._client.chat.completions.create(
+                    timeout=self.settings.timeout(deadline - time.monotonic()), **kwargs
+                )
+                self._policy.breaker.record_success()
+                return result
+            except Exception as e:
+                delay = self._policy.retry_delay(e, attempt, deadline)
+                if delay is None:
+                    self._policy.failed()
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+
+class SlotStream:
+    """
+    A stream holding a concurrency slot, released once: when the stream is consumed, closed or
+    garbage collected, also if it was never iterated.
+    """
+
+    def __init__(self, stream, semaphore):
+        self._stream = stream
+        self._semaphore = semaphore
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        finally:
+            self.close()
+
+    def close(self):
+        semaphore, self._semaphore = self._semaphore, None
+        if semaphore is not None:
+            try:
+                self._stream.close()
+            finally:
+                semaphore.release()
+
+    def __del__(self):
+        semaphore, self._semaphore = self._semaphore, None
+        if semaphore is not None:
+            semaphore.release()
+
+
+class AsyncUpstreamClient:
+    """Async twin of UpstreamClient around AsyncOpenAI, for use from a single event loop"""
+
+    def __init__(self, api_key, settings=None, base_url=None):
+        import openai
+        self.settings = settings or UpstreamSettings.from_env()
+        self._policy = _UpstreamPolicy(self.settings)
+        self._client = openai.AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            max_retries=0,
+            http_client=httpx.AsyncClient(limits=self.settings.limits(), timeout=self.settings.timeout())
+        )
+        self._semaphores = {}
+
+    def stats(self):
+        return self._policy.snapshot()
+
+    def _semaphore(self, model):
+        limit = self.settings.concurrency_limit(model)
+        if not limit:
+            return None
+        if model not in self._semaphores:
+            self._semaphores[model] = asyncio.Semaphore(limit)
+        return self._semaphores[model]
+
+    async def chat_completion(self, **kwargs):
+        """Same arguments and result as await client.chat.completions.create"""
+        deadline = self._policy.begin()
+        semaphore = self._semaphore(kwargs.get('model'))
+        if semaphore:
+            try:
+                await asyncio.wait_for(semaphore.acquire(), min(self.settings.queue_timeout, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                self._policy.stats['queue_timeouts'] += 1
+                raise UpstreamUnavailable(f"Too many concurrent calls to {kwargs.get('model')}")
+        try:
+            trial = self._policy.admit()
+            try:
+                result = await self._call(kwargs, deadline)
+            finally:
+                if trial:
+                    self._policy.breaker.end_trial()
+        except BaseException:
+            if semaphore:
+                semaphore.release()
+            raise
+        if semaphore and kwargs.get('stream'):
+            return AsyncSlotStream(result, semaphore)
+        if semaphore:
+            semaphore.release()
+        return result
+
+    async def _call(self, kwargs, deadline):
+        attempt = 0
+        while True:
+            try:
+                result = await self._client.chat.completions.create(
+                    timeout=self.settings.timeout(deadline - time.monotonic()), **kwargs
+                )
+                self._policy.breaker.record_success()
+                return result
+            except Exception as e:
+                delay = self._policy.retry_delay(e, attempt, deadline)
+                if delay is None:
+                    self._policy.failed()
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+
+class AsyncSlotStream:
+    """Async twin of SlotStream"""
+
+    def __init__(self, stream, semaphore):
+        self._stream = stream
+        self._semaphore = semaphore
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        finally:
+            await self.aclose()
+
+    async def aclose(self):
+        semaphore, self._semaphore = self._semaphore, None
+        if semaphore is not None:
+            try:
+                await self._stream.close()
+            finally:
+                semaphore.release()
+
+    close = aclose
+
+    def __del__(self):
+        semaphore, self._semaphore = self._semaphore, None
+        if semaphore is not None:
+            semaphore.release()